@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: algebra.py
+## desc: Boolean algebra over gene sets. Expressions combining gs_ids using union,
+##       intersection, and difference are evaluated on sorted ode_gene_id arrays,
+##       optionally after translating every set into a single species using
+##       homology, and results are output as gene set objects for BatchWriter.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+from heapq import merge
+from itertools import groupby
+import re
+
+from gwlib import db
+from gwlib.batch import BatchWriter
+from gwlib.geneindex import intersect_postings
+from gwlib.store import INT64
+
+## Expression operators. Intersection binds tighter than union and difference,
+## which are evaluated left to right.
+UNION = '|'
+INTERSECTION = '&'
+DIFFERENCE = '-'
+
+## gs_ids (optionally prefixed by GS), operators, and parentheses
+_token = re.compile(r'\s*(?:(?:GS)?(\d+)|([|&()-]))', re.IGNORECASE)
+
+def union(arrays):
+    """
+    Merges sorted gene arrays.
+
+    arguments
+        arrays: list of sorted sequences
+
+    returns
+        a sorted int64 array of the genes in any of the arrays
+    """
+
+    return array(INT64, [ode for ode, _ in groupby(merge(*arrays))])
+
+def intersection(arrays):
+    """
+    Intersects sorted gene arrays.
+
+    arguments
+        arrays: list of sorted sequences
+
+    returns
+        a sorted int64 array of the genes in every array
+    """
+
+    return array(INT64, intersect_postings(arrays))
+
+def difference(a, b):
+    """
+    Subtracts one sorted gene array from another.
+
+    arguments
+        a: sorted sequence
+        b: sorted sequence
+
+    returns
+        a sorted int64 array of the genes in a that aren't in b
+    """
+
+    result = array(INT64)
+    j = 0
+
+    for ode in a:
+        while j < len(b) and b[j] < ode:
+            j += 1
+
+        if j == len(b) or b[j] != ode:
+            result.append(ode)
+
+    return result
+
+def parse_expression(expression):
+    """
+    Parses a gene set expression, e.g. '(GS1 | GS2) & 3 - 4'. Intersection (&)
+    binds tighter than union (|) and difference (-), which are evaluated left to
+    right.
+
+    arguments
+        expression: expression string
+
+    returns
+        an expression tree. Leaves are gs_ids and nodes are (operator, operands)
+        tuples; unions and intersections are flattened so they can have any number
+        of operands.
+    """
+
+    tokens = []
+    position = 0
+    expression = expression.strip()
+
+    while position < len(expression):
+        match = _token.match(expression, position)
+
+        if not match:
+            raise ValueError(
+                'Invalid gene set expression at position %s: %s' %
+                (position, expression)
+            )
+
+        tokens.append(int(match.group(1)) if match.group(1) else match.group(2))
+
+        position = match.end()
+
+    ## Recursive descent over the token list
+    def parse_factor(i):
+
+        if i >= len(tokens):
+            raise ValueError('Incomplete gene set expression: %s' % expression)
+
+        if tokens[i] == '(':
+            tree, i = parse_expr(i + 1)
+
+            if i >= len(tokens) or tokens[i] != ')':
+                raise ValueError('Unbalanced parentheses: %s' % expression)
+
+            return tree, i + 1
+
+        if isinstance(tokens[i], int):
+            return tokens[i], i + 1
+
+        raise ValueError(
+            'Unexpected %s in gene set expression: %s' % (tokens[i], expression)
+        )
+
+    def parse_term(i):
+
+        operands = []
+        tree, i = parse_factor(i)
+
+        operands.append(tree)
+
+        while i < len(tokens) and tokens[i] == INTERSECTION:
+            tree, i = parse_factor(i + 1)
+
+            operands.append(tree)
+
+        return (operands[0] if len(operands) == 1 else (INTERSECTION, operands)), i
+
+    def parse_expr(i):
+
+        tree, i = parse_term(i)
+
+        while i < len(tokens) and tokens[i] in (UNION, DIFFERENCE):
+            operator = tokens[i]
+            right, i = parse_term(i + 1)
+
+            if operator == UNION and isinstance(tree, tuple) and tree[0] == UNION:
+                tree[1].append(right)
+
+            elif operator == UNION:
+                tree = (UNION, [tree, right])
+
+            else:
+                tree = (DIFFERENCE, [tree, right])
+
+        return tree, i
+
+    tree, i = parse_expr(0)
+
+    if i != len(tokens):
+        raise ValueError(
+            'Unexpected %s in gene set expression: %s' % (tokens[i], expression)
+        )
+
+    return tree
+
+def expression_gs_ids(tree):
+    """
+    Returns the set of gs_ids used in an expression tree.
+    """
+
+    if isinstance(tree, tuple):
+        gs_ids = set()
+
+        for operand in tree[1]:
+            gs_ids.update(expression_gs_ids(operand))
+
+        return gs_ids
+
+    return set([tree])
+
+class GenesetAlgebra(object):
+    """
+    Evaluates gene set expressions. Genes are loaded in bulk for every gene set
+    used by a batch of expressions, from a binary gene set store if one is given
+    or from the DB, and kept as sorted arrays.
+
+    public
+        store:     optional store.GenesetStore genes are loaded from
+        sp_id:     species gene sets are translated into using homology before
+                   they're combined, None disables translation
+        threshold: if true, only genes whose values are in the gene set threshold
+                   are used
+        source:    homology mapping data source
+        warns:     warnings about genes left out of gene set objects (see
+                   iter_genesets)
+    """
+
+    def __init__(self, store=None, sp_id=None, threshold=False, source='Homologene'):
+
+        if threshold and store is not None and not store.has_thresholds:
+            raise ValueError(
+                'The gene set store has no threshold flags so it cannot be used '
+                'with threshold=True'
+            )
+
+        self.store = store
+        self.sp_id = sp_id
+        self.threshold = threshold
+        self.source = source
+        self.warns = []
+
+        ## gs_id -> sorted gene array, after translation
+        self._genes = {}
+        ## gs_id -> sp_id
+        self._species = {}
+
+    def __read_genes(self, gs_ids):
+        """
+        Reads gene arrays from the store or DB.
+
+        returns
+            a dict of gs_id -> sorted gene array
+        """
+
+        genes = {}
+
+        if self.store is not None:
+            for gs_id in gs_ids:
+                odes = self.store.get_genes(gs_id)
+
+                if odes is None:
+                    continue
+
+                if self.threshold:
+                    odes = array(INT64, [
+                        o for o, f in zip(odes, self.store.get_thresholds(gs_id))
+                        if f
+                    ])
+
+                genes[gs_id] = odes
+
+            return genes
+
+        rows = db.iter_geneset_value_rows(gs_ids)
+
+        for gs_id, gs_rows in groupby(rows, key=lambda row: row[0]):
+            genes[gs_id] = array(INT64, sorted(set(
+                row[1] for row in gs_rows if row[3] or not self.threshold
+            )))
+
+        return genes
+
+    def __translate(self, genes):
+        """
+        Translates gene arrays from other species into the algebra's species.
+        Genes without homologs in the species are dropped.
+        """
+
+        foreign = [gs_id for gs_id in genes if self._species[gs_id] != self.sp_id]
+
+        if not foreign:
+            return genes
+
+        odes = set()
+
+        for gs_id in foreign:
+            odes.update(genes[gs_id])
+
+        homologs = db.get_gene_homologs(list(odes), self.source) if odes else {}
+        targets = db.get_homolog_genes(
+            list(set(homologs.values())), self.sp_id, self.source
+        ) if homologs else {}
+
+        for gs_id in foreign:
+            translated = set()
+
+            for ode in genes[gs_id]:
+                translated.update(targets.get(homologs.get(ode), ()))
+
+            genes[gs_id] = array(INT64, sorted(translated))
+
+        return genes
+
+    def load(self, gs_ids):
+        """
+        Loads (and translates) the genes for gene sets that haven't been loaded.
+
+        arguments
+            gs_ids: a list of gs_ids
+        """
+
+        missing = [gs_id for gs_id in set(gs_ids) if gs_id not in self._genes]
+
+        if not missing:
+            return
+
+        self._species.update(db.get_geneset_species(missing))
+
+        unknown = [gs_id for gs_id in missing if gs_id not in self._species]
+
+        if unknown:
+            raise ValueError('Gene sets do not exist: %s' % ', '.join(
+                str(gs_id) for gs_id in sorted(unknown)
+            ))
+
+        genes = self.__read_genes(missing)
+
+        ## Sets without values are empty
+        for gs_id in missing:
+            genes.setdefault(gs_id, array(INT64))
+
+        if self.sp_id is not None:
+            genes = self.__translate(genes)
+
+        self._genes.update(genes)
+
+    def get_genes(self, gs_id):
+        """
+        Returns a loaded gene set's sorted gene array.
+        """
+
+        self.load([gs_id])
+
+        return self._genes[gs_id]
+
+    def __evaluate(self, tree):
+
+        if not isinstance(tree, tuple):
+            return self._genes[tree]
+
+        operator, operands = tree
+        arrays = [self.__evaluate(operand) for operand in operands]
+
+        if operator == UNION:
+            return union(arrays)
+
+        if operator == INTERSECTION:
+            return intersection(arrays)
+
+        return difference(arrays[0], arrays[1])
+
+    def get_species(self, tree):
+        """
+        Returns the species of an expression's result.
+
+        arguments
+            tree: expression tree or string
+
+        returns
+            the species ID
+        """
+
+        if not isinstance(tree, (tuple, int)):
+            tree = parse_expression(tree)
+
+        if self.sp_id is not None:
+            return self.sp_id
+
+        gs_ids = expression_gs_ids(tree)
+
+        self.load(gs_ids)
+
+        species = set(self._species[gs_id] for gs_id in gs_ids)
+
+        if len(species) > 1:
+            raise ValueError(
+                'Gene sets from different species can only be combined when '
+                'they are translated using homology (sp_id)'
+            )
+
+        return species.pop()
+
+    def evaluate(self, expression):
+        """
+        Evaluates a gene set expression.
+
+        arguments
+            expression: expression string or tree, see parse_expression
+
+        returns
+            a sorted int64 array of ode_gene_ids
+        """
+
+        tree = expression
+
+        if not isinstance(tree, (tuple, int)):
+            tree = parse_expression(expression)
+
+        self.load(expression_gs_ids(tree))
+
+        return self.__evaluate(tree)
+
+    def iter_genesets(self, expressions, gene_type=None, **metadata):
+        """
+        Evaluates expressions and converts each result into a gene set object for
+        BatchWriter. Every gene set used by the expressions is loaded at once.
+        Results are binary gene sets whose genes are output using their references
+        for the given gene type. Genes without a reference are left out and a
+        warning is added to warns.
+
+        arguments
+            expressions: list of expression strings, or dicts containing the
+                         expression and optionally gs_name, gs_abbreviation, and
+                         gs_description
+            gene_type:   gene type ID (gdb_id) used for gene references, defaults
+                         to gene symbols
+            metadata:    other gene set fields, e.g. cur_id or gs_groups. Results
+                         are private unless gs_groups is given.
+
+        returns
+            a generator of gene set objects
+        """
+
+        expressions = [
+            e if isinstance(e, dict) else {'expression': e} for e in expressions
+        ]
+        trees = [parse_expression(e['expression']) for e in expressions]
+        gs_ids = set()
+
+        for tree in trees:
+            gs_ids.update(expression_gs_ids(tree))
+
+        self.load(gs_ids)
+
+        if gene_type is None:
+            gene_type = db.get_gene_types().get('Gene Symbol')
+
+        for expr, tree in zip(expressions, trees):
+            genes = self.__evaluate(tree)
+            refs = db.get_gene_refs(list(genes), gene_type) if len(genes) else {}
+            name = expr['expression']
+            missing = len(genes) - sum(1 for ode in genes if refs.get(ode))
+
+            if missing:
+                self.warns.append(
+                    '%s of the genes in the set %s have no gene references and '
+                    'were left out' % (missing, expr.get('gs_name', name))
+                )
+
+            gs = {
+                'gs_name': expr.get('gs_name', name),
+                'gs_abbreviation': expr.get('gs_abbreviation', name),
+                'gs_description': expr.get(
+                    'gs_description', 'Gene set expression: %s' % name
+                ),
+                'sp_id': self.get_species(tree),
+                'gs_gene_id_type': -gene_type,
+                'gs_threshold_type': 3,
+                'gs_threshold': '1',
+                'gs_groups': '-1',
+                'geneset_values': [
+                    (sorted(refs[ode])[0], 1) for ode in genes if refs.get(ode)
+                ]
+            }
+
+            gs.update(metadata)
+
+            yield gs
+
+def export_expressions(
+    expressions, out, store=None, sp_id=None, threshold=False, gene_type=None,
+    versioning='', **metadata
+):
+    """
+    Evaluates gene set expressions and writes the results into a batch file.
+
+    arguments
+        expressions: list of expressions, see GenesetAlgebra.iter_genesets
+        out:         a writable text, binary, or gzip file object
+        store:       optional store.GenesetStore genes are loaded from
+        sp_id:       species gene sets are translated into using homology
+        threshold:   if true, only genes in the gene set thresholds are used
+        gene_type:   gene type ID (gdb_id) used for gene references
+        versioning:  optional version string added to the batch file header
+        metadata:    other gene set fields, see GenesetAlgebra.iter_genesets
+
+    returns
+        a summary object containing the number of gene sets written (genesets)
+        and the errors for gene sets that couldn't be written or had genes left
+        out because they have no gene references (errors)
+    """
+
+    algebra = GenesetAlgebra(store=store, sp_id=sp_id, threshold=threshold)
+    writer = BatchWriter(None, None)
+    count = writer.write(
+        out,
+        algebra.iter_genesets(expressions, gene_type=gene_type, **metadata),
+        versioning
+    )
+
+    writer.errors.extend(algebra.warns)
+
+    return {'genesets': count, 'errors': writer.errors}
@@ -13,18 +13,56 @@
 from __future__ import print_function
 from collections import Counter as mset
 from collections import defaultdict as dd
-from copy import deepcopy
-import json
+from decimal import Decimal
+from itertools import islice
+from multiprocessing import Pool
+import gzip
+import hashlib
+import io
 import re
-import urllib2 as url2
 
-from ncbi import get_pubmed_articles
-import db
-import util
+from gwlib import db
+from gwlib import util
+from gwlib.journal import geneset_keys
+from gwlib.ncbi import PubMedClient
+from gwlib.ncbi import get_pubmed_articles
+from gwlib.probes import get_platform_index
+from gwlib.varindex import get_variant_index
+
+try:
+    _text_type = unicode
+except NameError:
+    _text_type = str
+
+## Threshold regexes used by the score type parser. These are taken from the original
+## GW1 code.
+THRESHOLD_REGEX = re.compile(r"([0-9.-]{2,})")
+## This one doesn't work on some input. It doesn't properly parse integers (only
+## floats) and you must have two threshold values (you can't do something like
+## Correlation < 5.0). Too lazy to change it though since the score types using it
+## aren't widely used.
+RANGE_THRESHOLD_REGEX = re.compile(r"([0-9.-]{2,})[^0-9.-]*([0-9.-]{2,})")
+
+## Batch line prefixes that are treated as gene values when the line contains tabs
+TABBED_PREFIXES = ('P', 'A')
+
+## Prefixes for gene set header lines. Two character prefixes require the trailing
+## space.
+HEADER_PREFIXES = (
+    'T ', 'U ', 'D ', ':', '=', '+', '!', '@', '$ ', '%', 'P ', 'A ', '~ ', '> '
+)
+
+## Header fields that carry over to every following gene set in the file until they
+## are encountered again
+STICKY_PREFIXES = ('!', '@', '%', 'A ', 'T ', 'U ', 'D ', 'P ', '$ ')
+
+## Error for gene values missing required gene set fields. It's only reported once.
+MISSING_FIELDS_ERROR = 'One or more of the required fields are missing.'
 
 def get_pubmed_info(pmid):
     """
-    Retrieves PubMed article metadata for a given PMID.
+    Retrieves PubMed article metadata for a given PMID. Use
+    ncbi.get_pubmed_articles to retrieve many articles at once.
 
     arguments
         pmid: an int PubMed ID
@@ -32,63 +70,13 @@ def get_pubmed_info(pmid):
     returns
         a dict where each key corresponds to a column in the publication table.
     """
-    ## Sumarry info includes everything but the abstract
-    sum_url = ('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?'
-               'retmode=json&db=pubmed&id=%s') % pmid
-    ## Abstract only
-    abs_url = ('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
-               '?rettype=abstract&retmode=text&db=pubmed&id=%s') % pmid
-
-    ## Sometimes the NCBI servers shit the bed and return errors that kill
-    ## the python script, we catch these and just return blank pubmed info
-    for attempt in range(5):
-        try:
-            sum_res = url2.urlopen(sum_url).read()
-            abs_res = url2.urlopen(abs_url).read()
-
-        except url2.HTTPError:
-            continue
-
-        break
-
-    ## for-else construct, if the loop doesn't break (in our case this
-    ## indicates success) then this statement is executed
-    else:
-        return {}
-
-    pinfo = {}
-    sum_res = json.loads(sum_res)
-
-    ## Key errors will indicate an crucial metadata component of the article is
-    ## missing. If this occurs we won't insert any new pubs.
-    try:
-        pub = sum_res[u'result']
-
-        pub = pub[pmid]
-
-        pinfo['pub_title'] = pub['title']
-        pinfo['pub_abstract'] = abs_res
-        pinfo['pub_journal'] = pub['fulljournalname']
-        pinfo['pub_volume'] = pub.get('volume', '')
-        pinfo['pub_pages'] = pub.get('pages', '')
-        pinfo['pub_pubmed'] = pmid
-        pinfo['pub_authors'] = []
-
-        ## Author struct {name, authtype, clustid}
-        for auth in pub['authors']:
-            pinfo[u'pub_authors'].append(auth['name'])
-
-        pinfo['pub_authors'] = ','.join(pinfo['pub_authors'])
-
-    except KeyError:
-        return {}
-
-    return pinfo
 
+    return get_pubmed_articles([pmid]).get(str(pmid), {})
 
 def make_digrams(s):
     """
-    Recursively creates an exhaustive list of digrams from the given string.
+    Creates an exhaustive list of digrams from the given string. Strings with two
+    or fewer characters are their own digram.
 
     arguments
         s: string to generate digrams with
@@ -100,10 +88,7 @@ def make_digrams(s):
     if len(s) <= 2:
         return [s]
 
-    b = make_digrams(s[1:])
-    b.insert(0, s[:2])
-
-    return b
+    return [s[i:i + 2] for i in range(len(s) - 1)]
 
 def calculate_str_similarity(s1, s2):
     """
@@ -130,6 +115,269 @@ def calculate_str_similarity(s1, s2):
 
     return (2 * len(intersect)) / float(len(sd1) + len(sd2))
 
+class PlatformMatcher(object):
+    """
+    Finds the expression platform whose name is most similar to a given string.
+    Produces the same matches as comparing the string to every platform name using
+    calculate_str_similarity, but digram profiles for the platform names are
+    computed once and an inverted digram index is used so only platforms sharing
+    at least one digram with the string are scored. Results are memoized.
+
+    public
+        platforms: the platform names -> pf_ids mapping the matcher was built from
+        threshold: platforms must be more similar than this to be matched
+    """
+
+    def __init__(self, platforms, threshold=0.65):
+        """
+        arguments
+            platforms: dict mapping platform names -> pf_ids
+            threshold: similarity threshold
+        """
+
+        self.platforms = platforms
+        self.threshold = threshold
+        self._names = []
+        self._sizes = []
+        self._index = dd(list)
+        self._matches = {}
+
+        ## Candidates keep the mapping's iteration order, ties go to the first
+        for i, name in enumerate(platforms.keys()):
+            digrams = make_digrams(name.lower())
+
+            self._names.append(name)
+            self._sizes.append(len(digrams))
+
+            for digram, count in mset(digrams).items():
+                self._index[digram].append((i, count))
+
+    def match(self, s):
+        """
+        Finds the platform most similar to the given string.
+
+        arguments
+            s: string to match
+
+        returns
+            a tuple of the platform name and pf_id, both are None if no platform
+            is more similar than the threshold
+        """
+
+        s = s.lower()
+
+        if s in self._matches:
+            return self._matches[s]
+
+        digrams = make_digrams(s)
+        intersect = dd(int)
+
+        for digram, count in mset(digrams).items():
+            for i, pcount in self._index.get(digram, ()):
+                intersect[i] += min(count, pcount)
+
+        best = self.threshold
+        name = None
+
+        for i in sorted(intersect):
+            sim = (2 * intersect[i]) / float(len(digrams) + self._sizes[i])
+
+            if sim > best:
+                best = sim
+                name = self._names[i]
+
+        match = (name, self.platforms[name] if name is not None else None)
+
+        self._matches[s] = match
+
+        return match
+
+class BatchScanner(object):
+    """
+    Scans the lines of a batch file, in order, for gene set boundaries without
+    parsing them, i.e. the first header line following a gene set's values. The
+    !, @, %, A, T, U, D, P, and $ header fields carry over to later gene sets so
+    the last valid line for each of them is tracked. Replaying those lines before
+    a gene set block produces the same header fields as parsing every line that
+    precedes it.
+
+    public
+        sticky:    sticky prefix -> (line number, line) for the last valid line
+                   with that prefix
+        in_values: true if gene values have been seen since the last header line
+    """
+
+    def __init__(self, reader=None):
+        """
+        arguments
+            reader: BatchReader whose reference data is used to validate sticky
+                    header lines (see BatchReader.is_valid_header_line). Without
+                    it every line is assumed to be valid.
+        """
+
+        self.sticky = {}
+        self.in_values = False
+        self._reader = reader
+
+    def scan(self, lnum, ln):
+        """
+        Scans the next line of the batch file.
+
+        arguments
+            lnum: the line number
+            ln:   the stripped line
+
+        returns
+            a tuple of the line's header prefix, None if it isn't a header line,
+            and a list of (line number, line) tuples for the sticky header lines
+            inherited by the gene set block this line starts, None if it doesn't
+            start one
+        """
+
+        prefix = ln[:2] if ln[:2] in HEADER_PREFIXES else ln[:1]
+
+        if prefix in HEADER_PREFIXES and\
+           not (ln[:1] in TABBED_PREFIXES and '\t' in ln):
+
+            inherited = None
+
+            ## Genome builds only complete the gene set being parsed if one was
+            ## already given
+            if self.in_values and (prefix != '$ ' or '$ ' in self.sticky):
+                self.in_values = False
+                inherited = sorted(self.sticky.values())
+
+            ## Invalid lines don't change the parsed fields
+            if prefix in STICKY_PREFIXES and (
+                self._reader is None or self._reader.is_valid_header_line(ln)
+            ):
+                self.sticky[prefix] = (lnum, ln)
+
+            return (prefix, inherited)
+
+        if ln.count('\t') == 1:
+            self.in_values = True
+
+        return (None, None)
+
+def find_batch_chunks(lns, size=100000, reader=None):
+    """
+    Splits the lines of a batch file into chunks that can be parsed independently of
+    one another. Chunks are only split at gene set boundaries (see BatchScanner) and
+    contain at least size lines (except for the last chunk). The last valid line of
+    each sticky header field preceding a chunk is returned with it.
+
+    arguments
+        lns:    list of strings, one for each line in the batch file
+        size:   the minimum number of lines in each chunk
+        reader: BatchReader whose reference data is used to validate sticky header
+                lines, see BatchScanner
+
+    returns
+        a list of (offset, inherited, lines) tuples. The offset is the number of
+        lines preceding the chunk. inherited is a list of (line number, line)
+        tuples, in file order, for the sticky header lines in effect at the start
+        of the chunk.
+    """
+
+    scanner = BatchScanner(reader)
+    chunks = []
+    inherited = []
+    start = 0
+
+    for i, ln in enumerate(lns):
+        _, block = scanner.scan(i + 1, ln.strip())
+
+        if block is not None and i - start >= size:
+            chunks.append((start, inherited, lns[start:i]))
+
+            start = i
+            inherited = block
+
+    chunks.append((start, inherited, lns[start:]))
+
+    return chunks
+
+def parse_batch_chunk(chunk):
+    """
+    Parses a single batch file chunk. This is used by the worker processes spawned
+    during parallel parsing so it needs to be a top level function.
+
+    arguments
+        chunk: a tuple containing the (gene types, species, platforms) reference
+               data followed by the chunk offset, inherited lines, and lines
+               returned by find_batch_chunks
+
+    returns
+        a tuple of the parsed gene sets, errors, and warnings
+    """
+
+    reference, offset, inherited, lns = chunk
+
+    reader = BatchReader(None)
+    reader._gene_types, reader._species, reader._platforms = reference
+
+    reader.parse_batch_lines(lns, offset, inherited)
+
+    return (reader.genesets, reader.errors, reader.warns)
+
+def _canonical_number(n):
+    """
+    Formats a gene value or threshold so equal numbers always produce the same
+    string, regardless of how they were written or stored.
+    """
+
+    try:
+        return repr(float(n))
+
+    except (TypeError, ValueError):
+        return str(n).strip()
+
+def _decimal_number(n):
+    """
+    Converts a gene value, either a parsed string or a float or Decimal retrieved
+    from the DB, into a Decimal so values can be compared exactly. Floats are
+    converted using their shortest representation.
+
+    raises
+        ArithmeticError or ValueError if the value isn't numeric
+    """
+
+    if isinstance(n, float):
+        return Decimal(repr(n))
+
+    return Decimal(str(n).strip())
+
+def geneset_fingerprint(sp_id, gene_type, threshold_type, threshold, values):
+    """
+    Generates a canonical fingerprint of a gene set's contents. Gene sets with the
+    same species, gene type, threshold type, threshold, and (ode_gene_id, value)
+    pairs have the same fingerprint no matter how their values are ordered or
+    formatted.
+
+    arguments
+        sp_id:          species ID
+        gene_type:      gs_gene_id_type
+        threshold_type: gs_threshold_type
+        threshold:      gs_threshold string, ranges are separated by a comma
+        values:         a list of (ode_gene_id, value) tuples
+
+    returns
+        a hex digest string
+    """
+
+    threshold = ','.join(
+        _canonical_number(t) for t in str(threshold or '').split(',')
+    )
+    pairs = sorted((int(ode), _canonical_number(v)) for ode, v in values)
+
+    content = '%s|%s|%s|%s|%s' % (
+        sp_id, gene_type, _canonical_number(threshold_type), threshold,
+        ';'.join('%s:%s' % (ode, v) for ode, v in pairs)
+    )
+
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
 class BatchReader(object):
     """
     Class used to read and parse batch geneset files.
@@ -142,27 +390,67 @@ class BatchReader(object):
                     parsing
         warns:      list of strings indicating non-crit errors found during
                     parsing
+        pubmed:     ncbi.PubMedClient used to retrieve publications that aren't
+                    in the DB
 
     private
         _parse_set:         the gene set currently being parsed
-        _pub_map:           PMID -> pub_id mapping
+        _pub_map:           PMID -> pub_id mapping for the publications
+                            looked up so far
         _symbol_cache:      a series of nested dicts used to map species
                             specific gene symbols to GW identifiers. The
                             structure is:
                                 sp_id -> gdb_id -> ode_ref_id -> ode_gene_id
         _annotation_cache:  mapping of ontology term IDs -> ont_ids
+        _gene_types:        gene type names -> gdb_ids
+        _species:           species names -> sp_ids
+        _platforms:         expression platform names -> pf_ids
+        _attributions:      attribution abbreviations -> at_ids
+        _platform_matcher:  PlatformMatcher for the expression platforms
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, shared=None, pubmed=None):
+        """
+        arguments
+            filepath: path to the batch file
+            shared:   another BatchReader whose reference data, publication
+                      mapping, identifier caches, and PubMed client are reused by
+                      this one
+            pubmed:   optional ncbi.PubMedClient, e.g. one configured with a
+                      cache directory or API key. A default client is used
+                      otherwise.
+        """
 
         self.filepath = filepath
+        self.pubmed = pubmed
         self.genesets = []
         self.errors = []
         self.warns = []
         self._parse_set = {}
-        self._pub_map = None
+        self._pub_map = {}
         self._symbol_cache = dd(lambda: dd(lambda: dd(int)))
         self._annotation_cache = dd(int)
+        self._gene_types = None
+        self._species = None
+        self._platforms = None
+        self._attributions = None
+        self._platform_matcher = None
+
+        if shared:
+            self._pub_map = shared._pub_map
+            self._symbol_cache = shared._symbol_cache
+            self._annotation_cache = shared._annotation_cache
+            self._gene_types = shared._gene_types
+            self._species = shared._species
+            self._platforms = shared._platforms
+            self._attributions = shared._attributions
+            self._platform_matcher = shared._platform_matcher
+
+            if pubmed is None:
+                self.pubmed = shared.pubmed
+
+        if self.pubmed is None:
+            self.pubmed = PubMedClient()
 
     def __read_file(self, fp=None):
         """
@@ -182,8 +470,10 @@ class BatchReader(object):
         assumption is checked later) and store it in the list of parsed sets.
         """
 
+        ## A shallow copy is enough since the mutable fields (values and
+        ## annotations) are replaced below
         if 'values' in self._parse_set and self._parse_set['values']:
-            self.genesets.append(deepcopy(self._parse_set))
+            self.genesets.append(dict(self._parse_set))
 
         if 'pmid' not in self._parse_set:
             self._parse_set['pmid'] = ''
@@ -248,16 +538,15 @@ class BatchReader(object):
         stype = ''
         ## Default theshold values
         thresh = '0.05'
+        sl = s.lower()
 
         ## Binary threshold is left at the default of 1
-        if s.lower() == 'binary':
+        if sl == 'binary':
             stype = '3'
             thresh = '1'
 
-        elif s.lower().find('p-value') != -1:
-            ## All the regexs used in this function are taken from the
-            ## original GW1 code
-            m = re.search(r"([0-9.-]{2,})", s.lower())
+        elif 'p-value' in sl:
+            m = THRESHOLD_REGEX.search(sl)
             stype = '1'
 
             if m:
@@ -265,8 +554,8 @@ class BatchReader(object):
             else:
                 self.warns.append('Invalid threshold. Using p < 0.05.')
 
-        elif s.lower().find('q-value') != -1:
-            m = re.search(r"([0-9.-]{2,})", s.lower())
+        elif 'q-value' in sl:
+            m = THRESHOLD_REGEX.search(sl)
             stype = '2'
 
             if m:
@@ -274,13 +563,8 @@ class BatchReader(object):
             else:
                 self.warns.append('Invalid threshold. Using q < 0.05.')
 
-        elif s.lower().find('correlation') != -1:
-            ## This regex doesn't work on some input. It doesn't properly parse
-            ## integers (only floats) and you must have two threshold values
-            ## (you can't do something like Correlation < 5.0).
-            ## Too lazy to change it though since this score type isn't widely
-            ## used.
-            m = re.search(r"([0-9.-]{2,})[^0-9.-]*([0-9.-]{2,})", s.lower())
+        elif 'correlation' in sl:
+            m = RANGE_THRESHOLD_REGEX.search(sl)
             stype = '4'
 
             if m:
@@ -292,9 +576,8 @@ class BatchReader(object):
                     'Invalid threshold. Using -0.75 < Correlation < 0.75'
                 )
 
-        elif s.lower().find('effect') != -1:
-            ## Same comments as the correlation regex
-            m = re.search(r"([0-9.-]{2,})[^0-9.-]*([0-9.-]{2,})", s.lower())
+        elif 'effect' in sl:
+            m = RANGE_THRESHOLD_REGEX.search(sl)
             stype = '5'
 
             if m:
@@ -334,26 +617,24 @@ class BatchReader(object):
             gtype = gtype[len('microarray'):].strip()
             original = gtype
 
-            ## Determine the closest microarry platform match above a 70%
-            ## similarity threshold.
-            best = 0.65
+            matcher = self._platform_matcher
 
-            for plat, pid in platforms.items():
-                sim = calculate_str_similarity(plat.lower(), original.lower())
+            if matcher is None or matcher.platforms is not platforms:
+                self._platform_matcher = PlatformMatcher(platforms)
 
-                if sim > best:
-                    best = sim
-                    gtype = plat
+            ## Determine the closest microarry platform match above a 65%
+            ## similarity threshold.
+            plat, pid = self._platform_matcher.match(original)
 
-            ## Convert to the parsed gene ID type to an actual ID.
-            ## gene will now be an integer
-            gtype = platforms.get(gtype, 'unknown')
+            ## Without a match the original name may still be a platform
+            if plat is None:
+                pid = platforms.get(original, 'unknown')
 
-            if type(gtype) != int:
+            if type(pid) != int:
                 self.errors.append('%s is an invalid platform' % original)
 
             else:
-                return gtype
+                return pid
 
         ## Otherwise the user specified one of the gene types, not a
         ## microarray platform
@@ -364,7 +645,7 @@ class BatchReader(object):
         else:
             gtype = gtype.lower()
 
-            if gtype not in gene_types.keys():
+            if gtype not in gene_types:
                 self.errors.append('%s is an invalid gene type' % gtype)
 
             else:
@@ -373,237 +654,342 @@ class BatchReader(object):
 
         return None
 
-    def __parse_batch_syntax(self, lns):
+    def load_reference_data(self):
         """
-        Parses a batch file according to the format listed on
-        http://geneweaver.org/index.php?action=manage&cmd=batchgeneset
-        The results (gene set objects) and any errors or warnings are stored in
-        their respective class attributes.
+        Retrieves the gene types, species, expression platforms, and attributions
+        used to validate and map batch files. Lower cased keys are provided for each
+        mapping, otherwise batch files must use case sensitive fields which would be
+        annoying.
+        """
+
+        self._gene_types = {}
+        self._species = {}
+        self._platforms = {}
+        self._attributions = {}
+
+        for gdb_name, gdb_id in db.get_gene_types().items():
+            self._gene_types[gdb_name] = gdb_id
+            self._gene_types[gdb_name.lower()] = gdb_id
+
+        for sp_name, sp_id in db.get_species().items():
+            self._species[sp_name] = sp_id
+            self._species[sp_name.lower()] = sp_id
+
+        for pf_name, pf_id in db.get_platform_names().items():
+            self._platforms[pf_name] = pf_id
+            self._platforms[pf_name.lower()] = pf_id
+
+        for abbrev, at_id in db.get_attributions().items():
+            self._attributions[abbrev] = at_id
+
+            ## Fucking NULL row in the db, this needs to be removed
+            if abbrev:
+                self._attributions[abbrev.lower()] = at_id
+
+    def get_reference_data(self):
+        """
+        Returns the reference data needed to parse batch files in other processes
+        (see parse_batch_chunk), loading it if necessary.
+
+        returns
+            a tuple of gene type, species, and platform mappings
+        """
+
+        if self._species is None:
+            self.load_reference_data()
+
+        return (self._gene_types, self._species, self._platforms)
+
+    def is_valid_header_line(self, ln):
+        """
+        Determines if a header line can be parsed without errors, e.g. that its
+        species or gene type exists. The gene set currently being parsed, errors,
+        and warnings are left untouched.
 
         arguments
-            lns: list of strings, one for each line in the batch file
+            ln: the header line
+
+        returns
+            true if the line is valid
         """
 
+        if self._species is None:
+            self.load_reference_data()
+
+        parse_set = self._parse_set
+        nerrors = len(self.errors)
+        nwarns = len(self.warns)
+
+        self._parse_set = {}
         self.__reset_parsed_set()
 
-        gene_types = db.get_gene_types()
-        species = db.get_species()
-        platforms = db.get_platform_names()
+        try:
+            self.__parse_lines([ln])
 
-        ## Provide lower cased keys for gene types, species, and expression
-        ## platformrs. Otherwise batch files must use case sensitive fields
-        ## which would be annoying.
-        for gdb_name, gdb_id in gene_types.items():
-            gene_types[gdb_name.lower()] = gdb_id
+            valid = len(self.errors) == nerrors
 
-        for sp_name, sp_id in species.items():
-            species[sp_name.lower()] = sp_id
+        ## Tier and user IDs that aren't integers
+        except ValueError:
+            valid = False
 
-        for pf_name, pf_id in platforms.items():
-            platforms[pf_name.lower()] = pf_id
+        finally:
+            self._parse_set = parse_set
 
-        for i in range(len(lns)):
-            lns[i] = lns[i].strip()
+            del self.errors[nerrors:]
+            del self.warns[nwarns:]
 
-            ## These are special (dev only) additions to the batch file that
-            ## allow tiers, user IDs, and attributions to be specified. These
-            ## are only used in the public resource uploader scripts.
-            #
-            ## Lines beginning with 'T' are Tier IDs
-            if lns[i][:2] == 'T ':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        return valid
 
-                self._parse_set['cur_id'] = int(lns[i][1:].strip())
+    ## These are special (dev only) additions to the batch file that allow tiers,
+    ## user IDs, and attributions to be specified. These are only used in the public
+    ## resource uploader scripts.
+    #
+    ## Lines beginning with 'T' are Tier IDs
+    def __parse_tier_line(self, ln, lnum):
 
-            ## Lines beginning with 'U' are user IDs
-            elif lns[i][:2] == 'U ':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        self._parse_set['cur_id'] = int(ln[1:].strip())
 
-                self._parse_set['usr_id'] = int(lns[i][1:].strip())
+    ## Lines beginning with 'U' are user IDs
+    def __parse_user_line(self, ln, lnum):
 
-            ## Lines beginning with 'D' are attribution abbrevations
-            elif lns[i][:2] == 'D ':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        self._parse_set['usr_id'] = int(ln[1:].strip())
 
-                self._parse_set['at_id'] = lns[i][1:].strip()
+    ## Lines beginning with 'D' are attribution abbrevations
+    def __parse_attribution_line(self, ln, lnum):
 
-            ## :, =, + is required for each geneset in the batch file
-            #
-            ## Lines beginning with ':' are geneset abbreviations (REQUIRED)
-            elif lns[i][:1] == ':':
-                ## This checks to see if we've already read, parsed, and stored
-                ## some gene values. If we have, that means we can save the
-                ## currently parsed geneset, clear out any REQUIRED fields before
-                ## we do more parsing, and begin parsing this new set.
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        self._parse_set['at_id'] = ln[1:].strip()
 
-                self._parse_set['gs_abbreviation'] = lns[i][1:].strip()
+    ## :, =, + is required for each geneset in the batch file
+    #
+    ## Lines beginning with ':' are geneset abbreviations (REQUIRED)
+    def __parse_abbreviation_line(self, ln, lnum):
 
-            ## Lines beginning with '=' are geneset names (REQUIRED)
-            elif lns[i][:1] == '=':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        self._parse_set['gs_abbreviation'] = ln[1:].strip()
 
-                self._parse_set['gs_name'] = lns[i][1:].strip()
+    ## Lines beginning with '=' are geneset names (REQUIRED)
+    def __parse_name_line(self, ln, lnum):
 
-            ## Lines beginning with '+' are geneset descriptions (REQUIRED)
-            elif lns[i][:1] == '+':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        self._parse_set['gs_name'] = ln[1:].strip()
 
-                self._parse_set['gs_description'] += lns[i][1:].strip()
-                self._parse_set['gs_description'] += ' '
-
-            ## !, @, %, are required but can be omitted from later sections if
-            ## they don't differ from the first. Meaning, these fields can be
-            ## specified once and will apply to all gene sets in the file unless
-            ## this field is encountered again.
-            #
-            ## Lines beginning with '!' are score types (REQUIRED)
-            elif lns[i][:1] == '!':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+    ## Lines beginning with '+' are geneset descriptions (REQUIRED)
+    def __parse_description_line(self, ln, lnum):
 
-                ttype, threshold = self.__parse_score_type(lns[i][1:].strip())
+        self._parse_set['gs_description'] += ln[1:].strip()
+        self._parse_set['gs_description'] += ' '
 
-                ## An error ocurred
-                if not ttype:
-                    ## Appends the line number to the last error which should
-                    ## be the error indicating an unknown score type was used
-                    self.errors[-1] = 'LINE %s: %s' % (i + 1, self.errors[-1])
+    ## !, @, %, are required but can be omitted from later sections if they don't
+    ## differ from the first. Meaning, these fields can be specified once and will
+    ## apply to all gene sets in the file unless this field is encountered again.
+    #
+    ## Lines beginning with '!' are score types (REQUIRED)
+    def __parse_score_line(self, ln, lnum):
 
-                else:
-                    self._parse_set['gs_threshold_type'] = ttype
-                    self._parse_set['gs_threshold'] = threshold
+        ttype, threshold = self.__parse_score_type(ln[1:].strip())
 
-            ## Lines beginning with '@' are species types (REQUIRED)
-            elif lns[i][:1] == '@':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        ## An error ocurred
+        if not ttype:
+            ## Appends the line number to the last error which should be the error
+            ## indicating an unknown score type was used
+            self.errors[-1] = 'LINE %s: %s' % (lnum, self.errors[-1])
 
-                spec = lns[i][1:].strip()
+        else:
+            self._parse_set['gs_threshold_type'] = ttype
+            self._parse_set['gs_threshold'] = threshold
 
-                if spec.lower() not in species.keys():
-                    self.errors.append(
-                        'LINE %s: %s is an invalid species' % (i + 1, spec)
-                    )
+    ## Lines beginning with '@' are species types (REQUIRED)
+    def __parse_species_line(self, ln, lnum):
 
-                else:
-                    ## Convert to sp_id
-                    self._parse_set['sp_id'] = species[spec.lower()]
+        spec = ln[1:].strip()
+        sp_id = self._species.get(spec.lower())
 
-            ## Lines beginning with '$' specify a genome build (REQUIRED)
-            elif lns[i][:2] == '$ ':
-                if self._parse_set.get('genome_build', None):
-                    self.__reset_parsed_set()
+        if sp_id is None:
+            self.errors.append('LINE %s: %s is an invalid species' % (lnum, spec))
 
-                self._parse_set['genome_build'] = lns[i][1:].strip()
+        else:
+            self._parse_set['sp_id'] = sp_id
 
-            ## Lines beginning with '%' are gene ID types (REQUIRED)
-            elif lns[i][:1] == '%':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+    ## Lines beginning with '$' specify a genome build (REQUIRED)
+    def __parse_genome_build_line(self, ln, lnum):
 
-                gene = lns[i][1:].strip()
-                gene = self.__parse_gene_type(gene, platforms, gene_types)
+        if self._parse_set.get('genome_build', None):
+            self.__reset_parsed_set()
 
-                ## An error ocurred
-                if not gene:
-                    ## Appends the line number to the last error which should
-                    ## be the error indicating an invalid gene type
-                    self.errors[-1] = 'LINE %s: %s' % (i + 1, self.errors[-1])
+        self._parse_set['genome_build'] = ln[1:].strip()
 
-                else:
-                    self._parse_set['gs_gene_id_type'] = gene
+    ## Lines beginning with '%' are gene ID types (REQUIRED)
+    def __parse_gene_type_line(self, ln, lnum):
 
-            ## Lines beginning with 'P ' are PubMed IDs (OPTIONAL)
-            elif (lns[i][:2] == 'P ') and (len(lns[i].split('\t')) == 1):
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        gene = self.__parse_gene_type(
+            ln[1:].strip(), self._platforms, self._gene_types
+        )
 
-                self._parse_set['pmid'] = lns[i][1:].strip()
+        ## An error ocurred
+        if not gene:
+            ## Appends the line number to the last error which should be the error
+            ## indicating an invalid gene type
+            self.errors[-1] = 'LINE %s: %s' % (lnum, self.errors[-1])
 
-            ## Lines beginning with 'A' are groups, default is private (OPTIONAL)
-            elif lns[i][:2] == 'A ' and (len(lns[i].split('\t')) == 1):
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        else:
+            self._parse_set['gs_gene_id_type'] = gene
 
-                group = lns[i][1:].strip()
+    ## Lines beginning with 'P ' are PubMed IDs (OPTIONAL)
+    def __parse_pubmed_line(self, ln, lnum):
 
-                ## If the user gives something other than private/public,
-                ## automatically make it private
-                if group.lower() != 'private' and group.lower() != 'public':
-                    self._parse_set['gs_groups'] = '-1'
-                    self._parse_set['cur_id'] = 5
+        self._parse_set['pmid'] = ln[1:].strip()
 
-                ## Public data sets are initially thrown into the provisional
-                ## Tier IV. Tier should never be null.
-                elif group.lower() == 'public':
-                    self._parse_set['gs_groups'] = '0'
-                    self._parse_set['cur_id'] = 4
+    ## Lines beginning with 'A' are groups, default is private (OPTIONAL)
+    def __parse_access_line(self, ln, lnum):
 
-                ## Private
-                else:
-                    self._parse_set['gs_groups'] = '-1'
-                    self._parse_set['cur_id'] = 5
+        group = ln[1:].strip().lower()
 
-            ## Lines beginning with '~' are ontology annotations (OPTIONAL)
-            elif lns[i][:2] == '~ ':
-                if self._parse_set['values']:
-                    self.__reset_parsed_set()
+        ## Public data sets are initially thrown into the provisional Tier IV. Tier
+        ## should never be null.
+        if group == 'public':
+            self._parse_set['gs_groups'] = '0'
+            self._parse_set['cur_id'] = 4
+
+        ## If the user gives something other than private/public, automatically
+        ## make it private
+        else:
+            self._parse_set['gs_groups'] = '-1'
+            self._parse_set['cur_id'] = 5
+
+    ## Lines beginning with '~' are ontology annotations (OPTIONAL)
+    def __parse_annotation_line(self, ln, lnum):
+
+        self._parse_set['annotations'].append(ln[1:].strip())
+
+    ## Lines beginning with '>' point to a URI (OPTIONAL)
+    def __parse_uri_line(self, ln, lnum):
+
+        self._parse_set['gs_uri'] = ln[1:].strip()
+
+    def __parse_batch_syntax(self, lns, offset=0, inherited=()):
+        """
+        Parses a batch file according to the format listed on
+        http://geneweaver.org/index.php?action=manage&cmd=batchgeneset
+        The results (gene set objects) and any errors or warnings are stored in
+        their respective class attributes.
+
+        The lines can also be a chunk of a larger batch file (see
+        find_batch_chunks). In that case the header lines the chunk inherits from
+        earlier in the file are replayed first; any errors or warnings they cause
+        were already reported by the chunk they came from.
+
+        arguments
+            lns:       list of strings, one for each line in the batch file
+            offset:    the number of lines preceding lns in the batch file
+            inherited: list of (line number, line) tuples for the sticky header
+                       lines in effect at the start of lns
+        """
+
+        self.__reset_parsed_set()
+
+        if self._species is None:
+            self.load_reference_data()
+
+        if inherited:
+            nerrors = len(self.errors)
+            nwarns = len(self.warns)
 
-                self._parse_set['annotations'].append(lns[i][1:].strip())
+            self.__parse_lines([ln for _, ln in inherited])
 
-            ## Lines beginning with '>' point to a URI (OPTIONAL)
-            elif lns[i][:2] == '> ':
-                if self._parse_set['values']:
+            del self.errors[nerrors:]
+            del self.warns[nwarns:]
+
+        self.__parse_lines(lns, offset)
+
+        ## awwww shit, we're finally finished! Make the final parsed geneset.
+        self.genesets.append(self._parse_set)
+
+    def __parse_lines(self, lns, offset=0):
+        """
+        Parses batch file lines into the gene set currently being parsed. Each line
+        is dispatched on its prefix to one of the __parse_*_line handlers above.
+        Every header line, except genome builds, completes the gene set being
+        parsed if gene values have already been read for it.
+
+        arguments
+            lns:    list of strings, one for each line in the batch file
+            offset: the number of lines preceding lns in the batch file
+        """
+
+        handlers = {
+            'T ': self.__parse_tier_line,
+            'U ': self.__parse_user_line,
+            'D ': self.__parse_attribution_line,
+            ':': self.__parse_abbreviation_line,
+            '=': self.__parse_name_line,
+            '+': self.__parse_description_line,
+            '!': self.__parse_score_line,
+            '@': self.__parse_species_line,
+            '$ ': self.__parse_genome_build_line,
+            '%': self.__parse_gene_type_line,
+            'P ': self.__parse_pubmed_line,
+            'A ': self.__parse_access_line,
+            '~ ': self.__parse_annotation_line,
+            '> ': self.__parse_uri_line,
+        }
+
+        ## Whether the set being parsed has all its required fields. This only
+        ## changes when a header line is parsed so it's cached between value lines.
+        complete = None
+        values = self._parse_set['values']
+
+        for lnum, ln in enumerate(lns, offset + 1):
+            ln = ln.strip()
+
+            handler = handlers.get(ln[:2]) or handlers.get(ln[:1])
+
+            ## PubMed IDs and groups containing tabs are actually gene values
+            if handler and not (ln[:1] in TABBED_PREFIXES and '\t' in ln):
+
+                ## This checks to see if we've already read, parsed, and stored
+                ## some gene values. If we have, that means we can save the
+                ## currently parsed geneset, clear out any REQUIRED fields before
+                ## we do more parsing, and begin parsing this new set. Genome
+                ## builds handle this themselves.
+                if self._parse_set['values'] and ln[:2] != '$ ':
                     self.__reset_parsed_set()
 
-                self._parse_set['gs_uri'] = lns[i][1:].strip()
+                handler(ln, lnum)
+
+                complete = None
+                values = self._parse_set['values']
 
             ## If the lines are tab separated, we assume it's the gene data that
             ## will become part of the geneset_values
-            elif len(lns[i].split('\t')) == 2:
+            elif ln.count('\t') == 1:
+
+                if complete is None:
+                    complete = self.__check_parsed_set()
 
                 ## Check to see if all the required data was specified, if not
                 ## this set can't get uploaded. Let the user figure out what the
                 ## hell they're missing cause telling them is too much work on
                 ## our part.
-                if not self.__check_parsed_set():
-
-                    err = 'One or more of the required fields are missing.'
+                if not complete:
 
                     ## Otherwise this string will get appended a bajillion times
-                    if err not in self.errors:
-                        self.errors.append(err)
+                    if MISSING_FIELDS_ERROR not in self.errors:
+                        self.errors.append(MISSING_FIELDS_ERROR)
 
                 else:
-                    lns[i] = lns[i].split('\t')
-
-                    self._parse_set['values'].append((lns[i][0], lns[i][1]))
+                    gene, _, value = ln.partition('\t')
 
-            ## Lines beginning with '#' are comments
-            elif lns[i][:1] == '#':
-                continue
+                    values.append((gene, value))
 
-            ## Skip blank lines
-            elif lns[i][:1] == '':
+            ## Lines beginning with '#' are comments and blank lines are skipped
+            elif ln[:1] == '#' or not ln:
                 continue
 
             ## Who knows what the fuck this line is, just skip it
             else:
                 self.warns.append(
                     'LINE %s: Skipping line with unknown identifiers (%s)' %
-                    ((i + 1), lns[i])
+                    (lnum, ln)
                 )
 
-        ## awwww shit, we're finally finished! Make the final parsed geneset.
-        self.genesets.append(self._parse_set)
-
     def __insert_geneset_file(self, genes):
         """
         Modifies the geneset_values into the proper format for storage in the file
@@ -671,7 +1057,7 @@ class BatchReader(object):
         """
 
         ## Isolate gene symbols (ode_ref_ids)
-        gene_refs = map(lambda x: x[0], gs['values'])
+        gene_refs = [ref for ref, _ in gs['values']]
         gene_type = gs['gs_gene_id_type']
         sp_id = gs['sp_id']
         gs['geneset_values'] = []
@@ -709,10 +1095,19 @@ class BatchReader(object):
 
                         gs['values'][i] = (gene, value)
 
-                    gene_refs = map(lambda x: x[0], gs['values'])
+                    gene_refs = [ref for ref, _ in gs['values']]
+
+                    ## Use the local variant index for the build if one has
+                    ## been registered
+                    index = get_variant_index(gs['genome_build'])
 
                     ## Should check to see if the genome build is valid...
-                    ref2ode = db.get_variant_odes_by_refs(gene_refs, gs['genome_build'])
+                    if index is not None:
+                        ref2ode = index.get_variant_odes(gene_refs)
+                    else:
+                        ref2ode = db.get_variant_odes_by_refs(
+                            gene_refs, gs['genome_build']
+                        )
 
                     ## The variant ode retrieval function returns variant
                     ## references as integers, we convert them back to strings
@@ -726,17 +1121,9 @@ class BatchReader(object):
 
         ## It's a damn expression platform :/
         else:
-            ## This is a mapping of (symbols) prb_ref_ids -> prb_ids for the
-            ## given platform
-            ref2prbid = db.get_all_platform_probes(gene_type)
-            ## This is a mapping of prb_ids -> ode_gene_ids
-            prbid2ode = db.get_probe2gene(ref2prbid.values())
-
-            ## Just throw everything in the same dict, shouldn't matter since
-            ## the prb_refs will be strings and the prb_ids will be ints
-            self._symbol_cache[sp_id][gene_type] = dd(int)
-            self._symbol_cache[sp_id][gene_type].update(ref2prbid)
-            self._symbol_cache[sp_id][gene_type].update(prbid2ode)
+            ## prb_ref_ids -> prb_ids -> ode_gene_ids, this is only loaded once
+            ## per platform
+            index = get_platform_index(gene_type)
 
         ref2ode = self._symbol_cache[sp_id][gene_type]
 
@@ -747,10 +1134,9 @@ class BatchReader(object):
 
             ## Platform handling
             if gs['gs_gene_id_type'] > 0:
-                prb_id = ref2ode[ref]
-                odes = ref2ode[prb_id]
+                odes = index.get_genes(ref)
 
-                if not prb_id or not odes:
+                if not odes:
                     self.warns.append('No gene/locus data exists for %s' % ref)
                     continue
 
@@ -801,17 +1187,17 @@ class BatchReader(object):
 
     def __insert_geneset_values(self, gs):
         """
+        Inserts the mapped gene set values into the DB. Failed inserts raise an
+        exception so the caller can roll back the partially inserted set.
+
+        arguments
+            gs: gene set object
         """
 
         for ref, ode, value in gs['geneset_values']:
-            try:
-                db.insert_geneset_value(
-                    gs['gs_id'], ode, value, ref, gs['gs_threshold']
-                )
-            except Exception as e:
-                print(e)
-                print(gs)
-                exit()
+            db.insert_geneset_value(
+                gs['gs_id'], ode, value, ref, gs['gs_threshold']
+            )
 
     def __insert_annotations(self, gs):
         """
@@ -827,122 +1213,594 @@ class BatchReader(object):
                     gs['gs_id'], ont_id, 'GeneWeaver Primary Annotation'
                 )
 
-    def parse_batch_file(self):
+    def __parse_batch_chunks(self, lns, processes, chunk_size):
         """
-        Parses a batch file to completion.
+        Splits a batch file into chunks at gene set boundaries and parses them in
+        parallel using a pool of worker processes. Gene sets, errors, and warnings
+        from each chunk are merged back in their original order.
 
         arguments
-            fp: a string, the filepath to a batch file
-
-        returns
-            A list of gene set objects (dicts) with properly filled out fields,
-            ready for insertion into the GW DB.
+            lns:        list of strings, one for each line in the batch file
+            processes:  the number of worker processes to use
+            chunk_size: the minimum number of lines in each chunk
         """
 
-        self.errors = []
-        self.warns = []
+        reference = self.get_reference_data()
+        chunks = [
+            (reference,) + c for c in find_batch_chunks(lns, chunk_size, self)
+        ]
 
-        if not self.filepath:
-            self.errors('No batch file was provided.')
-            return []
+        pool = Pool(processes)
 
-        self.__parse_batch_syntax(self.__read_file())
+        try:
+            results = pool.map(parse_batch_chunk, chunks)
 
-        if self.errors:
-            return []
+        finally:
+            pool.close()
+            pool.join()
 
-        attributions = db.get_attributions()
+        for genesets, errors, warns in results:
+            self.genesets.extend(genesets)
+            self.warns.extend(warns)
 
-        for abbrev, at_id in attributions.items():
-            ## Fucking NULL row in the db, this needs to be removed
-            if abbrev:
-                attributions[abbrev.lower()] = at_id
+            for err in errors:
+                ## Each chunk reports this one separately
+                if err == MISSING_FIELDS_ERROR and err in self.errors:
+                    continue
 
-        ## Geneset post-processing: mapping gene -> ode_gene_ids, attributions,
-        ## and annotations
-        for gs in self.genesets:
+                self.errors.append(err)
 
-            gs['gs_count'] = self.__map_gene_identifiers(gs)
+    def parse_batch_lines(self, lns, offset=0, inherited=()):
+        """
+        Parses the lines of a batch file, or a chunk of one, into gene sets without
+        doing any of the gene identifier, attribution, or annotation mapping.
 
-            if 'at_id' in gs and gs['at_id']:
-                gs['gs_attribution'] = attributions.get(gs['at_id'], None)
-            else:
-                gs['gs_attribution'] = None
+        arguments
+            lns:       list of strings, one for each line in the batch file
+            offset:    the number of lines preceding lns in the batch file
+            inherited: list of (line number, line) tuples for the sticky header
+                       lines in effect at the start of lns
+
+        returns
+            a list of parsed gene set objects (dicts)
+        """
 
-            self.__map_ontology_annotations(gs)
+        self.__parse_batch_syntax(lns, offset, inherited)
 
         return self.genesets
 
-    def get_geneset_pubmeds(self):
-        """
+    def parse_batch_file(self, processes=1, chunk_size=100000):
         """
+        Parses a batch file to completion. Large files can be parsed using multiple
+        processes, in which case the file is split into chunks at gene set
+        boundaries. Mapping gene identifiers and annotations always happens in this
+        process.
+
+        arguments
+            processes:  the number of processes to use for parsing the batch file
+            chunk_size: the minimum number of lines each process parses at once
 
-        if not self._pub_map:
-            self._pub_map = db.get_publication_mapping()
+        returns
+            A list of gene set objects (dicts) with properly filled out fields,
+            ready for insertion into the GW DB.
+        """
 
-        found = filter(lambda g: g['pmid'] in self._pub_map, self.genesets)
+        self.errors = []
+        self.warns = []
 
-        for gs in found:
-            gs['pub_id'] = self._pub_map[gs['pmid']]
-            gs['pub'] = gs['pmid']
+        if not self.filepath:
+            self.errors.append('No batch file was provided.')
+            return []
 
-        pubs = map(lambda g: g['pmid'], self.genesets)
+        if processes > 1:
+            self.__parse_batch_chunks(self.__read_file(), processes, chunk_size)
 
-        if pubs:
-            pubs = get_pubmed_articles(map(lambda g: g['pmid'], self.genesets))
         else:
-            pubs = {}
+            self.__parse_batch_syntax(self.__read_file())
+
+        if self.errors:
+            return []
+
+        return self.map_genesets()
+
+    def iter_batch_file(self, chunk_size=10000):
+        """
+        Parses a batch file incrementally, yielding each gene set as soon as it
+        has been completely parsed. The file is read chunk_size lines at a time and
+        parsed sets aren't kept by the reader so memory use doesn't depend on the
+        size of the file. Gene sets are not mapped (see map_geneset) and errors are
+        only complete once the generator is exhausted.
+
+        arguments
+            chunk_size: the number of lines read from the file at once
+
+        returns
+            a generator of parsed gene set objects (dicts)
+        """
+
+        self.errors = []
+        self.warns = []
+        self.genesets = []
+
+        if not self.filepath:
+            self.errors.append('No batch file was provided.')
+            return
+
+        self.__reset_parsed_set()
+
+        if self._species is None:
+            self.load_reference_data()
+
+        with open(self.filepath, 'r') as fl:
+            offset = 0
+
+            while True:
+                lns = list(islice(fl, chunk_size))
+
+                if not lns:
+                    break
+
+                self.__parse_lines(lns, offset)
+
+                offset += len(lns)
+                genesets = self.genesets
+                self.genesets = []
+
+                for gs in genesets:
+                    yield gs
+
+        yield self._parse_set
+
+    def map_geneset(self, gs):
+        """
+        Maps the genes in a single parsed gene set to ode_gene_ids, and maps its
+        attribution and ontology annotations to their GW identifiers.
+
+        arguments
+            gs: a parsed gene set object
+
+        returns
+            the mapped gene set object
+        """
+
+        if self._attributions is None:
+            self.load_reference_data()
+
+        gs['gs_count'] = self.__map_gene_identifiers(gs)
+
+        if 'at_id' in gs and gs['at_id']:
+            gs['gs_attribution'] = self._attributions.get(gs['at_id'], None)
+        else:
+            gs['gs_attribution'] = None
+
+        self.__map_ontology_annotations(gs)
+
+        gs['gs_fingerprint'] = geneset_fingerprint(
+            gs['sp_id'],
+            gs['gs_gene_id_type'],
+            gs.get('gs_threshold_type'),
+            gs.get('gs_threshold'),
+            [(ode, value) for _, ode, value in gs['geneset_values']]
+        )
+
+        return gs
+
+    def map_genesets(self):
+        """
+        Geneset post-processing: maps the genes in each parsed gene set to
+        ode_gene_ids, and maps attributions and ontology annotations to their GW
+        identifiers.
+
+        returns
+            the list of mapped gene set objects (dicts)
+        """
 
         for gs in self.genesets:
-            if gs['pmid'] not in pubs:
+            self.map_geneset(gs)
+
+        return self.genesets
+
+    def __map_publications(self, pmids):
+        """
+        Looks up the pub_ids for PMIDs that aren't in the publication mapping
+        yet. Only the given PMIDs are retrieved from the DB.
+
+        arguments
+            pmids: list of PMIDs
+        """
+
+        pmids = set(p for p in pmids if p) - set(self._pub_map.keys())
+
+        if pmids:
+            self._pub_map.update(db.get_publications(sorted(pmids)))
+
+    def get_geneset_pubmeds(self, genesets=None):
+        """
+        Retrieves the publication info for each gene set's PubMed ID. Gene sets
+        whose publication is already in the DB are given its pub_id, metadata for
+        the rest is retrieved from NCBI using the reader's PubMed client.
+
+        arguments
+            genesets: the gene sets to retrieve publications for, defaults to every
+                      set parsed by this reader
+        """
+
+        if genesets is None:
+            genesets = self.genesets
+
+        self.__map_publications([gs['pmid'] for gs in genesets])
+
+        missing = set(
+            gs['pmid'] for gs in genesets
+            if gs['pmid'] and gs['pmid'] not in self._pub_map
+        )
+        pubs = self.pubmed.get_articles(missing) if missing else {}
+
+        for gs in genesets:
+            if gs['pmid'] in self._pub_map:
+                gs['pub_id'] = self._pub_map[gs['pmid']]
+                gs['pub'] = gs['pmid']
+
+            elif gs['pmid'] in pubs:
                 gs['pub_id'] = None
-                gs['pub'] = None
+                gs['pub'] = pubs[gs['pmid']]
 
             else:
                 gs['pub_id'] = None
-                gs['pub'] = pubs[gs['pmid']]
+                gs['pub'] = None
 
-    def insert_genesets(self, genesets=None):
+    def insert_geneset_publication(self, gs):
         """
+        Sets the pub_id for a gene set whose publication was retrieved by
+        get_geneset_pubmeds, inserting the publication if it isn't in the DB yet.
+
+        arguments
+            gs: gene set object
         """
 
-        ids = []
+        if not gs['pub_id'] and gs['pub']:
+            pmid = gs['pub']['pub_pubmed']
+
+            self.__map_publications([pmid])
+
+            if pmid not in self._pub_map:
+                self._pub_map[pmid] = db.insert_publication(gs['pub'])
+
+            gs['pub_id'] = self._pub_map[pmid]
+
+    def insert_geneset_publications(self, genesets=None):
+        """
+        Like insert_geneset_publication but inserts every new publication at once.
+
+        arguments
+            genesets: optional list of gene sets, defaults to all the parsed gene
+                      sets
+        """
+
+        if genesets is None:
+            genesets = self.genesets
+
+        genesets = [gs for gs in genesets if not gs['pub_id'] and gs['pub']]
+
+        self.__map_publications([gs['pub']['pub_pubmed'] for gs in genesets])
+
+        pubs = dict(
+            (gs['pub']['pub_pubmed'], gs['pub']) for gs in genesets
+            if gs['pub']['pub_pubmed'] not in self._pub_map
+        )
+
+        if pubs:
+            self._pub_map.update(db.insert_publications(list(pubs.values())))
+
+        for gs in genesets:
+            gs['pub_id'] = self._pub_map.get(gs['pub']['pub_pubmed'])
+
+    def insert_geneset(self, gs):
+        """
+        Inserts a single parsed and mapped gene set along with its publication,
+        values, and annotations.
+
+        arguments
+            gs: gene set object
+
+        returns
+            the gs_id of the new gene set or None if it wasn't inserted
+        """
+
+        if not gs['gs_count']:
+
+            self.errors.append((
+                'No genes in the set %s mapped to GW identifiers so it '
+                'was not uploaded'
+            ) % gs['gs_name'])
+
+            return None
+
+        self.insert_geneset_publication(gs)
+
+        gs['file_id'] = self.__insert_geneset_file(gs['values'])
+        gs['gs_id'] = db.insert_geneset(gs)
+        self.__insert_geneset_values(gs)
+        self.__insert_annotations(gs)
+
+        return gs['gs_id']
+
+    def find_duplicate_genesets(self, genesets=None):
+        """
+        Finds stored gene sets that are identical to parsed and mapped ones by
+        comparing their content fingerprints (see geneset_fingerprint). Only stored
+        sets with the same species, gene type, and size are retrieved and
+        fingerprinted, in bulk. The gs_id of the matching stored set is saved in
+        each duplicate set object (gs_duplicate).
+
+        arguments
+            genesets: optional list of gene sets to check, defaults to all the
+                      parsed gene sets
+
+        returns
+            a list of the duplicate gene set objects
+        """
 
         if not genesets:
             genesets = self.genesets
 
-        if not self._pub_map:
-            self._pub_map = db.get_publication_mapping()
+        keys = set(
+            (gs['sp_id'], gs['gs_gene_id_type'], gs['gs_count'])
+            for gs in genesets if gs.get('gs_count')
+        )
+        stored = {}
+
+        for chunk in util.chunk_list(sorted(keys), 1000):
+            for sgs in db.get_geneset_values_by_size(chunk):
+                fingerprint = geneset_fingerprint(
+                    sgs['sp_id'],
+                    sgs['gs_gene_id_type'],
+                    sgs['gs_threshold_type'],
+                    sgs['gs_threshold'],
+                    sgs['values']
+                )
+
+                ## Keep the oldest copy if there are already duplicates
+                if fingerprint not in stored or sgs['gs_id'] < stored[fingerprint]:
+                    stored[fingerprint] = sgs['gs_id']
+
+        duplicates = []
 
         for gs in genesets:
+            gs['gs_duplicate'] = stored.get(gs.get('gs_fingerprint'))
 
-            if not gs['gs_count']:
+            if gs['gs_duplicate'] is not None:
+                duplicates.append(gs)
 
-                self.errors.append((
-                    'No genes in the set %s mapped to GW identifiers so it '
-                    'was not uploaded'
-                ) % gs['gs_name'])
+        return duplicates
 
-                continue
+    def insert_genesets(self, genesets=None, journal=None, duplicates=None):
+        """
+        Inserts parsed and mapped gene sets into the DB.
 
-            if not gs['pub_id'] and gs['pub']:
-                if gs['pub']['pub_pubmed'] not in self._pub_map:
-                    gs['pub_id'] = db.insert_publication(gs['pub'])
+        If a journal is given, each gene set is committed as soon as it's inserted
+        and recorded in the journal. Sets already recorded in the journal are
+        skipped so an upload that died can be rerun and continue where it stopped.
+        A set that fails to insert is rolled back and reported as an error.
 
-                    self._pub_map[gs['pub']['pub_pubmed']] = gs['pub_id']
+        Gene sets identical to ones already in the DB (see find_duplicate_genesets)
+        can be skipped (duplicates='skip') or skipped and have the "last updated"
+        date of the stored set reset (duplicates='touch').
 
-                else:
-                    gs['pub_id'] = self._pub_map[gs['pub']['pub_pubmed']]
+        arguments
+            genesets:   optional list of gene sets to insert, defaults to all the
+                        parsed gene sets
+            journal:    optional BatchJournal used to checkpoint committed sets
+            duplicates: None to insert every set, 'skip' or 'touch'
 
-            gs['file_id'] = self.__insert_geneset_file(gs['values'])
-            gs['gs_id'] = db.insert_geneset(gs)
-            self.__insert_geneset_values(gs)
-            self.__insert_annotations(gs)
+        returns
+            a list of the gs_ids for the newly inserted gene sets, including those
+            previously inserted according to the journal
+        """
 
-            ids.append(gs['gs_id'])
+        ids = []
+
+        if not genesets:
+            genesets = self.genesets
+
+        ## Keys depend on every set in the file so they're generated before any
+        ## sets are skipped
+        if journal is not None:
+            for gs, key in zip(genesets, geneset_keys(genesets)):
+                gs['journal_key'] = key
+
+        if duplicates:
+            ## Sets committed by a previous run would be duplicates of themselves
+            if journal is not None:
+                pending = [
+                    gs for gs in genesets if journal.get(gs['journal_key']) is None
+                ]
+            else:
+                pending = genesets
+
+            dups = self.find_duplicate_genesets(pending) if pending else []
+
+            for gs in dups:
+                self.warns.append(
+                    'The set %s is identical to GS%s so it was not uploaded'
+                    % (gs['gs_name'], gs['gs_duplicate'])
+                )
+
+            if dups and duplicates == 'touch':
+                db.update_geneset_dates(
+                    sorted(set(gs['gs_duplicate'] for gs in dups))
+                )
+
+                if journal is not None:
+                    db.commit()
+
+            genesets = [gs for gs in genesets if gs.get('gs_duplicate') is None]
+
+        ## Publications are committed up front when journaling so a set that
+        ## fails and is rolled back doesn't take a shared publication with it
+        self.insert_geneset_publications([gs for gs in genesets if gs['gs_count']])
+
+        if journal is not None:
+            db.commit()
+
+        for gs in genesets:
+
+            if journal is None:
+                gs_id = self.insert_geneset(gs)
+
+            else:
+                gs_id = self.__insert_journaled_geneset(gs, journal)
+
+            if gs_id is not None:
+                ids.append(gs_id)
 
         return ids
 
+    def __insert_journaled_geneset(self, gs, journal):
+        """
+        Inserts and commits a single gene set unless the journal says it has
+        already been committed.
+
+        arguments
+            gs:      gene set object
+            journal: BatchJournal
+
+        returns
+            the gs_id of the gene set or None if it wasn't inserted
+        """
+
+        key = gs['journal_key']
+        gs_id = journal.get(key)
+
+        if gs_id is not None:
+            gs['gs_id'] = gs_id
+
+            return gs_id
+
+        try:
+            gs_id = self.insert_geneset(gs)
+
+            db.commit()
+
+        except Exception as e:
+            db.rollback()
+
+            self.errors.append(
+                'Failed to insert the set %s: %s' % (gs['gs_name'], e)
+            )
+
+            return None
+
+        if gs_id is not None:
+            journal.record(key, gs_id)
+
+        return gs_id
+
+    def __in_threshold(self, value, threshold):
+        """
+        Determines whether a gene value falls within the gene set threshold. Uses
+        the same comparison as db.insert_geneset_value but compares numbers when
+        both the value and threshold are numeric.
+        """
+
+        try:
+            return float(value) <= float(threshold)
+
+        except (TypeError, ValueError):
+            return value <= threshold
+
+    def update_geneset(self, gs_id, gs):
+        """
+        Updates a stored gene set so its values match those of a parsed gene set.
+        Rather than deprecating the stored set and inserting a new one, only the
+        differences are applied: new genes are inserted, missing genes are deleted,
+        and changed scores are updated. The gene set size and "last updated" date
+        are adjusted and everything is committed in a single transaction. Failed
+        updates are rolled back and reported as an error, and sets with non-numeric
+        values aren't updated at all. Scores are compared as decimals so values
+        that are stored differently (e.g. 0.0100 and 0.01) aren't updated.
+
+        arguments
+            gs_id: ID of the stored gene set
+            gs:    parsed gene set object, it's mapped if necessary
+
+        returns
+            a dict of the ode_gene_ids that were added, removed, and updated or None
+            if the update failed
+        """
+
+        if 'geneset_values' not in gs:
+            self.map_geneset(gs)
+
+        if not gs['geneset_values']:
+            self.errors.append((
+                'No genes in the set %s mapped to GW identifiers so GS%s was not '
+                'updated'
+            ) % (gs['gs_name'], gs_id))
+
+            return None
+
+        new = dict((ode, (ref, value)) for ref, ode, value in gs['geneset_values'])
+        numbers = {}
+
+        for ode, (ref, value) in new.items():
+            try:
+                numbers[ode] = _decimal_number(value)
+
+            except (ArithmeticError, ValueError):
+                self.errors.append(
+                    'The value (%s) for %s in the set %s is not a number' %
+                    (value, ref, gs['gs_name'])
+                )
+
+        if len(numbers) != len(new):
+            self.errors.append('GS%s was not updated' % gs_id)
+
+            return None
+
+        stored = dict(
+            (gsv['ode_gene_id'], gsv['gsv_value'])
+            for gsv in db.get_geneset_values([gs_id])
+        )
+        threshold = gs.get('gs_threshold', 1)
+
+        added = sorted(set(new) - set(stored))
+        removed = sorted(set(stored) - set(new))
+        updated = sorted(
+            ode for ode in set(new) & set(stored)
+            if stored[ode] is None or numbers[ode] != _decimal_number(stored[ode])
+        )
+
+        try:
+            db.delete_geneset_values(gs_id, removed)
+
+            db.update_geneset_values(gs_id, [
+                (ode, new[ode][1], self.__in_threshold(new[ode][1], threshold))
+                for ode in updated
+            ])
+
+            if added:
+                db.insert_geneset_values([
+                    (
+                        gs_id, ode, float(new[ode][1]), new[ode][0],
+                        self.__in_threshold(new[ode][1], threshold)
+                    )
+                    for ode in added
+                ])
+
+            db.update_geneset_size(gs_id, len(new))
+            db.update_geneset_dates([gs_id])
+            db.commit()
+
+        except Exception as e:
+            db.rollback()
+
+            self.errors.append('Failed to update GS%s: %s' % (gs_id, e))
+
+            return None
+
+        return {'added': added, 'removed': removed, 'updated': updated}
+
     def finalize(self):
         """
         Commits DB changes.
@@ -981,27 +1839,22 @@ class BatchWriter(object):
         self.errors = []
 
         if not self.no_db:
-            self.species = db.get_species()
-            self.gene_types = db.get_gene_types()
-            self.platforms = db.get_platform_names()
-            self.attributions = db.get_attributions()
-
             ## Reverse each of the mappings
-            for sp_name, sp_id in self.species.items():
-                self.species[sp_id] = sp_name
-                del self.species[sp_name]
-
-            for gdb_name, gdb_id in self.gene_types.items():
-                self.gene_types[gdb_id] = gdb_name
-                del self.gene_types[gdb_name]
-
-            for pf_name, pf_id in self.platforms.items():
-                self.platforms[pf_id] = pf_name
-                del self.platforms[pf_name]
-
-            for at_abbrev, at_id in self.attributions.items():
-                self.attributions[at_id] = at_abbrev
-                del self.attributions[at_abbrev]
+            self.species = dict(
+                (sp_id, sp_name) for sp_name, sp_id in db.get_species().items()
+            )
+            self.gene_types = dict(
+                (gdb_id, gdb_name)
+                for gdb_name, gdb_id in db.get_gene_types().items()
+            )
+            self.platforms = dict(
+                (pf_id, pf_name)
+                for pf_name, pf_id in db.get_platform_names().items()
+            )
+            self.attributions = dict(
+                (at_id, at_abbrev)
+                for at_abbrev, at_id in db.get_attributions().items()
+            )
 
     def __format_threshold(self, threshold_type, threshold=''):
         """
@@ -1253,14 +2106,12 @@ class BatchWriter(object):
 
         return passes
 
-    def serialize(self, versioning=''):
+    def __format_header(self, versioning=''):
         """
-        Formats the list of genesets into a single batch file and outputs the
-        result.
+        Formats the comment block at the start of every batch file.
         """
 
-        serial = []
-        serial.append('## Machine generated BGF file')
+        serial = ['## Machine generated BGF file']
 
         if versioning:
             serial.append('## %s' % versioning)
@@ -1268,97 +2119,213 @@ class BatchWriter(object):
         serial.append('#')
         serial.append('')
 
-        threshold_type = None
-        threshold = None
-        species = None
-        gene_type = None
-        tier = None
-        access = None
-        pmid = None
-        usr_id = None
-        pub_id = None
-        at_id = None
-        annos = None
-        gs_uri = None
+        return '\n'.join(serial)
 
-        for gs in self.genesets:
+    def __format_geneset(self, gs, state):
+        """
+        Formats a single gene set into a batch file block. General parameters
+        (threshold, species, etc.) are only output when they differ from the
+        previous gene set.
 
-            if not self.__passes_sanity_check(gs):
-                continue
+        arguments
+            gs:    gene set object
+            state: dict of the general parameters currently in effect, it's
+                   updated in place
 
-            ## General parameters are allowed to change in between geneset
-            ## definitions
-            if threshold_type != gs['gs_threshold_type'] or\
-               threshold != gs.get('gs_threshold', threshold):
+        returns
+            the formatted block
+        """
 
-                threshold_type = gs['gs_threshold_type']
-                threshold = gs.get('gs_threshold', threshold)
+        serial = []
 
-                serial.append(
-                    self.__format_threshold(threshold_type, threshold)
-                )
+        ## General parameters are allowed to change in between geneset
+        ## definitions
+        if state['threshold_type'] != gs['gs_threshold_type'] or\
+           state['threshold'] != gs.get('gs_threshold', state['threshold']):
+
+            state['threshold_type'] = gs['gs_threshold_type']
+            state['threshold'] = gs.get('gs_threshold', state['threshold'])
+
+            serial.append(
+                self.__format_threshold(state['threshold_type'], state['threshold'])
+            )
+
+        if state['species'] != gs['sp_id']:
+            state['species'] = gs['sp_id']
+
+            serial.append(self.__format_species(state['species']))
+
+        if state['gene_type'] != gs['gs_gene_id_type']:
+            state['gene_type'] = gs['gs_gene_id_type']
+
+            serial.append(self.__format_gene_type(state['gene_type']))
+
+        if gs.get('pmid', None) and state['pmid'] != gs['pmid']:
+            state['pmid'] = gs['pmid']
+
+            serial.append(self.__format_publication(None, state['pmid']))
+
+        if gs.get('pub_id', None) and state['pub_id'] != gs['pub_id']:
+            state['pub_id'] = gs['pub_id']
+
+            serial.append(self.__format_publication(state['pub_id']))
+
+        if gs.get('annotations', None) and state['annos'] != gs['annotations']:
+            state['annos'] = gs['annotations']
+
+            serial.append(self.__format_annotations(state['annos']))
+
+        if gs.get('gs_uri', None) and state['gs_uri'] != gs['gs_uri']:
+            state['gs_uri'] = gs['gs_uri']
+
+            serial.append(self.__format_uri(state['gs_uri']))
+
+        if not state['access']:
+            state['access'] = True
+
+            serial.append(self.__format_access(
+                gs.get('gs_groups', ''), gs.get('cur_id', None)
+            ))
+
+        ## Enable developer parameters
+        if self.is_dev:
+            if gs.get('cur_id', None) and state['tier'] != gs['cur_id']:
+                state['tier'] = gs['cur_id']
+
+                serial.append(self.__format_tier(state['tier']))
+
+            if gs.get('at_id', None) and state['at_id'] != gs['at_id']:
+                state['at_id'] = gs['at_id']
+
+                serial.append(self.__format_attribution(state['at_id']))
+
+            if gs.get('usr_id', None) and state['usr_id'] != gs['usr_id']:
+                state['usr_id'] = gs['usr_id']
+
+                serial.append(self.__format_user(state['usr_id']))
+
+        serial.append('')
+        serial.append(self.__format_label(gs['gs_abbreviation']))
+        serial.append(self.__format_name(gs['gs_name']))
+        serial.append(self.__format_description(gs['gs_description']))
+        serial.append('')
+        serial.append(self.__format_geneset_values(gs['geneset_values']))
+        serial.append('')
+
+        return '\n'.join(serial)
 
-            if species != gs['sp_id']:
-                species = gs['sp_id']
+    def iter_serialize(self, genesets=None, versioning='', strict=False):
+        """
+        Lazily formats gene sets into batch file blocks. Each gene set is
+        validated as it's formatted. Gene sets that fail validation are skipped,
+        and the errors are added to the errors list, so the remaining sets
+        can still be output.
 
-                serial.append(self.__format_species(species))
+        arguments
+            genesets:   an iterable of gene set objects, defaults to the gene sets
+                        given to the constructor
+            versioning: optional version string added to the header
+            strict:     if true, blocks for gene sets that fail validation are
+                        still generated. This is used by serialize, which doesn't
+                        output anything if there are any errors.
 
-            if gene_type != gs['gs_gene_id_type']:
-                gene_type = gs['gs_gene_id_type']
+        returns
+            a generator of strings, the file header followed by one block per
+            gene set
+        """
 
-                serial.append(self.__format_gene_type(gene_type))
+        if genesets is None:
+            genesets = self.genesets
 
-            if gs.get('pmid', None) and pmid != gs['pmid']:
-                pmid = gs['pmid']
+        state = dict.fromkeys([
+            'threshold_type', 'threshold', 'species', 'gene_type', 'tier',
+            'access', 'pmid', 'usr_id', 'pub_id', 'at_id', 'annos', 'gs_uri'
+        ])
 
-                serial.append(self.__format_publication(None, pmid))
+        yield self.__format_header(versioning)
 
-            if gs.get('pub_id', None) and pub_id != gs['pub_id']:
-                pub_id = gs['pub_id']
+        for gs in genesets:
+
+            if not self.__passes_sanity_check(gs):
+                continue
 
-                serial.append(self.__format_publication(pub_id))
+            nerrors = len(self.errors)
+            new_state = dict(state)
+            block = self.__format_geneset(gs, new_state)
 
-            if gs.get('annotations', None) and annos != gs['annotations']:
-                annos = gs['annotations']
+            ## Formatting errors mean the set contains invalid IDs
+            if len(self.errors) > nerrors and not strict:
+                continue
 
-                serial.append(self.__format_annotations(annos))
+            state = new_state
 
-            if gs.get('gs_uri', None) and gs_uri != gs['gs_uri']:
-                gs_uri = gs['gs_uri']
+            yield block
 
-                serial.append(self.__format_uri(gs_uri))
+    def write(self, out, genesets=None, versioning=''):
+        """
+        Streams gene sets into a batch file. Each gene set block is written as
+        soon as it's formatted so memory use doesn't depend on the number of gene
+        sets. Gene sets that fail validation are skipped and their errors are
+        added to the errors list.
 
-            if not access:
-                access = True
+        arguments
+            out:        a writable text or binary file object, e.g. an open file,
+                        sys.stdout, or a gzip.GzipFile
+            genesets:   an iterable of gene set objects, defaults to the gene sets
+                        given to the constructor
+            versioning: optional version string added to the header
 
-                serial.append(self.__format_access(
-                    gs.get('gs_groups', ''), gs.get('cur_id', None)
-                ))
+        returns
+            the number of gene sets written
+        """
 
-            ## Enable developer parameters
-            if self.is_dev:
-                if gs.get('cur_id', None) and tier != gs['cur_id']:
-                    tier = gs['cur_id']
+        binary = _is_binary_file(out)
+        ## The first block is the file header
+        count = -1
 
-                    serial.append(self.__format_tier(tier))
+        for block in self.iter_serialize(genesets, versioning):
+            if binary and isinstance(block, _text_type):
+                block = block.encode('utf-8')
 
-                if gs.get('at_id', None) and at_id != gs['at_id']:
-                    at_id = gs['at_id']
+            out.write(block)
+            out.write(b'\n' if binary else '\n')
 
-                    serial.append(self.__format_attribution(at_id))
+            count += 1
 
-                if gs.get('usr_id', None) and usr_id != gs['usr_id']:
-                    usr_id = gs['usr_id']
+        return count
 
-                    serial.append(self.__format_user(usr_id))
+    def write_file(self, filepath=None, genesets=None, versioning=''):
+        """
+        Streams gene sets into a batch file at the given filepath. Files ending in
+        .gz are gzip compressed. See write.
 
-            serial.append('')
-            serial.append(self.__format_label(gs['gs_abbreviation']))
-            serial.append(self.__format_name(gs['gs_name']))
-            serial.append(self.__format_description(gs['gs_description']))
-            serial.append('')
-            serial.append(self.__format_geneset_values(gs['geneset_values']))
-            serial.append('')
+        arguments
+            filepath:   output filepath, defaults to the filepath given to the
+                        constructor
+            genesets:   an iterable of gene set objects
+            versioning: optional version string added to the header
+
+        returns
+            the number of gene sets written
+        """
+
+        filepath = filepath or self.filepath
+
+        if filepath.endswith('.gz'):
+            with gzip.open(filepath, 'wb') as fl:
+                return self.write(fl, genesets, versioning)
+
+        with open(filepath, 'w') as fl:
+            return self.write(fl, genesets, versioning)
+
+    def serialize(self, versioning=''):
+        """
+        Formats the list of genesets into a single batch file and outputs the
+        result. Nothing is output if any gene set has errors, use write_file to
+        skip invalid gene sets and stream large numbers of gene sets.
+        """
+
+        serial = list(self.iter_serialize(versioning=versioning, strict=True))
 
         if self.errors:
             return False
@@ -1368,6 +2335,20 @@ class BatchWriter(object):
 
         return True
 
+def _is_binary_file(fl):
+    """
+    Determines if a file object requires bytes rather than text.
+    """
+
+    if isinstance(fl, (gzip.GzipFile, io.BufferedIOBase, io.RawIOBase)):
+        return True
+
+    if isinstance(fl, io.TextIOBase):
+        return False
+
+    ## python 2 file objects accept both
+    return 'b' in str(getattr(fl, 'mode', ''))
+
 if __name__ == '__main__':
     pass
 
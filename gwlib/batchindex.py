@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: batchindex.py
+## desc: Random access indexes for batch files. An index records where each gene
+##       set is in the file along with the sticky header lines (!, @, %, etc.) in
+##       effect for it, so single gene sets can be read from large batch files
+##       without parsing everything that precedes them.
+## auth: TR
+#
+
+from __future__ import print_function
+import json
+import os
+
+from gwlib.batch import BatchReader
+from gwlib.batch import BatchScanner
+
+## Index file format version
+VERSION = 1
+
+def _make_entry(offset, length, line, inherited, abbreviation, name):
+    """
+    Creates an index entry, see build_batch_index.
+    """
+
+    return {
+        'gs_abbreviation': abbreviation,
+        'gs_name': name,
+        'offset': offset,
+        'length': length,
+        'line': line,
+        'inherited': inherited
+    }
+
+def build_batch_index(filepath, reader=None):
+    """
+    Builds a random access index for a batch file. The file is split into gene
+    set blocks exactly as it is for parallel parsing (see batch.BatchScanner);
+    each block starts at the first header line following the previous gene set's
+    values.
+
+    arguments
+        filepath: path to the batch file
+        reader:   optional BatchReader whose reference data is used to validate
+                  the inherited header lines, it's loaded from the DB if necessary
+
+    returns
+        a BatchIndex
+    """
+
+    if reader is None:
+        reader = BatchReader(filepath)
+
+    if reader._species is None:
+        reader.load_reference_data()
+
+    scanner = BatchScanner(reader)
+    entries = []
+    inherited = []
+    ## Byte offset and line number of the current block
+    start = 0
+    start_line = 0
+    position = 0
+    abbreviation = None
+    name = None
+
+    with open(filepath, 'rb') as fl:
+        for i, raw in enumerate(fl):
+            ln = raw.decode('utf-8', 'replace').strip()
+            prefix, block = scanner.scan(i + 1, ln)
+
+            if block is not None:
+                entries.append(_make_entry(
+                    start, position - start, start_line, inherited,
+                    abbreviation, name
+                ))
+
+                start = position
+                start_line = i
+                inherited = block
+                abbreviation = None
+                name = None
+
+            if prefix == ':':
+                abbreviation = ln[1:].strip()
+
+            elif prefix == '=':
+                name = ln[1:].strip()
+
+            position += len(raw)
+
+    ## Trailing comments or header lines without a gene set aren't indexed
+    if scanner.in_values or abbreviation is not None or name is not None:
+        entries.append(_make_entry(
+            start, position - start, start_line, inherited, abbreviation, name
+        ))
+
+    stat = os.stat(filepath)
+
+    return BatchIndex(filepath, entries, stat.st_size, stat.st_mtime)
+
+class BatchIndex(object):
+    """
+    Random access index for a single batch file.
+
+    public
+        filepath: path to the batch file
+        entries:  list of index entries in file order. Each entry is a dict
+                  containing the gene set abbreviation and name (gs_abbreviation,
+                  gs_name), the byte offset and length of the gene set's block,
+                  the number of lines preceding the block (line), and the
+                  (line number, line) tuples for the sticky header lines in effect
+                  at the start of the block (inherited).
+        size:     size of the batch file when it was indexed
+        mtime:    modification time of the batch file when it was indexed
+        errors:   parsing errors from the last read_genesets call
+        warns:    parsing warnings from the last read_genesets call
+    """
+
+    def __init__(self, filepath, entries, size=None, mtime=None):
+
+        self.filepath = filepath
+        self.entries = entries
+        self.size = size
+        self.mtime = mtime
+        self.errors = []
+        self.warns = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_stale(self):
+        """
+        Determines if the batch file has changed since it was indexed.
+
+        returns
+            true if the file's size or modification time differ
+        """
+
+        try:
+            stat = os.stat(self.filepath)
+
+        except OSError:
+            return True
+
+        return stat.st_size != self.size or stat.st_mtime != self.mtime
+
+    def save(self, filepath=None):
+        """
+        Saves the index as JSON lines, a header followed by one line per entry.
+
+        arguments
+            filepath: index filepath, defaults to the batch filepath with an .idx
+                      extension
+        """
+
+        filepath = filepath or self.filepath + '.idx'
+
+        with open(filepath, 'w') as fl:
+            print(json.dumps({
+                'version': VERSION,
+                'filepath': self.filepath,
+                'size': self.size,
+                'mtime': self.mtime
+            }), file=fl)
+
+            for entry in self.entries:
+                print(json.dumps(entry), file=fl)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Loads a saved index.
+
+        arguments
+            filepath: index filepath
+
+        returns
+            a BatchIndex
+        """
+
+        with open(filepath, 'r') as fl:
+            header = json.loads(fl.readline())
+
+            if header.get('version') != VERSION:
+                raise ValueError('%s is not a batch file index' % filepath)
+
+            entries = []
+
+            for ln in fl:
+                entry = json.loads(ln)
+                entry['inherited'] = [tuple(t) for t in entry['inherited']]
+
+                entries.append(entry)
+
+        return cls(header['filepath'], entries, header['size'], header['mtime'])
+
+    def find(self, key):
+        """
+        Finds the index entries for gene sets with the given abbreviation or name.
+
+        arguments
+            key: gene set abbreviation or name
+
+        returns
+            a list of matching entries in file order
+        """
+
+        return [
+            e for e in self.entries
+            if e['gs_abbreviation'] == key or e['gs_name'] == key
+        ]
+
+    def read_lines(self, entry):
+        """
+        Reads the lines of a single gene set's block from the batch file.
+
+        arguments
+            entry: index entry
+
+        returns
+            a list of strings, one for each line in the block
+        """
+
+        with open(self.filepath, 'rb') as fl:
+            fl.seek(entry['offset'])
+
+            data = fl.read(entry['length']).decode('utf-8')
+
+        ## Only newlines end lines, like they do when the whole file is parsed
+        return data.split('\n')
+
+    def read_genesets(self, keys, reader=None):
+        """
+        Reads and parses only the requested gene sets. Each gene set's block is
+        read directly from its offset and parsed after its inherited header lines.
+        Gene sets are not mapped (see BatchReader.map_geneset).
+
+        arguments
+            keys:   list of gene set abbreviations, names, or entry positions
+            reader: optional BatchReader whose reference data is used for parsing,
+                    it's loaded from the DB if necessary
+
+        returns
+            a list of parsed gene set objects (dicts) in the order they were
+            requested. Errors and warnings are stored in the errors and warns
+            attributes.
+        """
+
+        self.errors = []
+        self.warns = []
+
+        if reader is None:
+            reader = BatchReader(self.filepath)
+
+        if reader._species is None:
+            reader.load_reference_data()
+
+        genesets = []
+
+        for key in keys:
+            if isinstance(key, int):
+                entries = [self.entries[key]]
+            else:
+                entries = self.find(key)
+
+            if not entries:
+                self.errors.append('No gene set matches %s' % key)
+
+            for entry in entries:
+                parser = BatchReader(self.filepath, shared=reader)
+
+                parser.parse_batch_lines(
+                    self.read_lines(entry), entry['line'], entry['inherited']
+                )
+
+                genesets.extend(parser.genesets)
+                self.errors.extend(parser.errors)
+                self.warns.extend(parser.warns)
+
+        return genesets
+
+def load_batch_index(filepath, index_path=None, reader=None):
+    """
+    Loads the saved index for a batch file, building and saving a new one if it
+    doesn't exist or the batch file has changed since it was indexed.
+
+    arguments
+        filepath:   path to the batch file
+        index_path: index filepath, defaults to the batch filepath with an .idx
+                    extension
+        reader:     optional BatchReader used to build the index, see
+                    build_batch_index
+
+    returns
+        a BatchIndex
+    """
+
+    index_path = index_path or filepath + '.idx'
+
+    if os.path.exists(index_path):
+        try:
+            index = BatchIndex.load(index_path)
+
+            if index.filepath == filepath and not index.is_stale():
+                return index
+
+        except (ValueError, KeyError):
+            pass
+
+    index = build_batch_index(filepath, reader)
+
+    index.save(index_path)
+
+    return index
@@ -7,27 +7,56 @@
 #
 
 from collections import OrderedDict as od
+from itertools import count, islice
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import psycopg2
+import threading
+import time
+
+try:
+    _text_type = unicode
+except NameError:
+    _text_type = str
 
 ## Global connection variable
 conn = None
 
+## Global connection pool, used by threads that need their own connection
+pool = None
+
+## Connections checked out of the pool and bound to the current thread
+local_conn = threading.local()
+
+## Credentials used by the last connect or connect_pool call, see get_connect_args
+_connect_args = None
+
+## Unique names for server side cursors
+_cursor_ids = count()
+
+## Lookups with more keys than this are run as a join against a temp table of keys
+## instead of using an IN list, see set_join_threshold
+JOIN_THRESHOLD = 10000
+
+## Lookup instrumentation, lookup name -> stats, see get_lookup_stats
+_lookup_stats = {}
+_stats_lock = threading.Lock()
+
+## In-memory gene -> gene set index used by get_genesets_by_genes, see the
+## geneindex module
+_gene_index = None
+
 class PooledCursor(object):
     """
     Small class that encapsulates psycopg2's connection and cursor objects.
-    On instantiation the class will create a new DB connection if one doesn't exist and
-    creates a new cursor when entered (e.g. using in a with statement).
+    On instantiation the class will use the connection bound to the current thread
+    (see PooledConnection) or the global connection if the thread doesn't have one,
+    and creates a new cursor when entered (e.g. using in a with statement).
     """
 
     def __init__(self, new_conn=None):
 
-        if not new_conn:
-            global conn
-        else:
-            conn = new_conn
-
-        self.connection = conn
+        self.connection = new_conn if new_conn else get_connection()
         self.cursor = None
 
     def __enter__(self):
@@ -45,6 +74,37 @@ class PooledCursor(object):
 
             self.cursor = None
 
+class PooledConnection(object):
+    """
+    Checks a connection out of the global connection pool and binds it to the current
+    thread when entered. Every query made by this module from the thread then uses
+    that connection until the context exits, at which point uncommitted changes are
+    rolled back and the connection is returned to the pool.
+    """
+
+    def __init__(self):
+
+        self.connection = None
+
+    def __enter__(self):
+
+        self.connection = pool.getconn()
+
+        local_conn.conn = self.connection
+
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        local_conn.conn = None
+
+        if self.connection:
+            self.connection.rollback()
+
+            pool.putconn(self.connection)
+
+            self.connection = None
+
     ## UTILITY ##
     #############
 
@@ -66,6 +126,7 @@ def connect(host, db, user, password, port=5432):
     """
 
     global conn
+    global _connect_args
 
     try:
         conn = psycopg2.connect(
@@ -76,8 +137,70 @@ def connect(host, db, user, password, port=5432):
 
         return (False, e)
 
+    _connect_args = {
+        'host': host, 'db': db, 'user': user, 'password': password, 'port': port
+    }
+
+    return (True, '')
+
+def connect_pool(host, db, user, password, port=5432, minconn=1, maxconn=8):
+    """
+    Creates a thread safe pool of DB connections using the given credentials.
+    Connections are checked out of the pool using PooledConnection.
+
+    arguments
+        host:     DB host/server
+        db:       DB name
+        user:     user name
+        password: password
+        port:     optional port the DB server is using
+        minconn:  the number of connections created along with the pool
+        maxconn:  the maximum number of connections the pool will create
+
+    returns
+        a tuple indicating success. The first element is a boolean which indicates
+        whether the pool was created or not. In the case of an unsuccessful
+        connection, the second element contains the error or exception.
+    """
+
+    global pool
+    global _connect_args
+
+    try:
+        pool = ThreadedConnectionPool(
+            minconn, maxconn,
+            host=host, dbname=db, user=user, password=password, port=port
+        )
+
+    except Exception as e:
+
+        return (False, e)
+
+    _connect_args = {
+        'host': host, 'db': db, 'user': user, 'password': password, 'port': port
+    }
+
     return (True, '')
 
+def get_connect_args():
+    """
+    Returns the credentials used by the last successful connect or connect_pool
+    call. Used by worker processes which need their own connections.
+
+    returns
+        a dict of connect arguments or None if a connection hasn't been made
+    """
+
+    return dict(_connect_args) if _connect_args else None
+
+def get_connection():
+    """
+    Returns the connection bound to the current thread, or the global connection if
+    the thread doesn't have one.
+    """
+
+    return getattr(local_conn, 'conn', None) or conn
+
 def dictify(cursor, ordered=False):
     """
     Converts each row returned by the cursor into a list of dicts, where
@@ -225,12 +348,236 @@ def associate_duplicate(cursor):
 
     return d
 
+def format_copy_value(value):
+    """
+    Formats a single value using the text format read by COPY ... FROM STDIN.
+
+    arguments
+        value: some value, None is converted to NULL
+
+    returns
+        a string
+    """
+
+    if value is None:
+        return '\\N'
+
+    ## python 2 unicode strings
+    if isinstance(value, _text_type) and _text_type is not str:
+        value = value.encode('utf-8')
+
+    elif isinstance(value, float):
+        value = repr(value)
+
+    elif not isinstance(value, str):
+        value = str(value)
+
+    return (
+        value.replace('\\', '\\\\')
+             .replace('\t', '\\t')
+             .replace('\n', '\\n')
+             .replace('\r', '\\r')
+    )
+
+class CopyRows(object):
+    """
+    File-like object which formats rows for COPY ... FROM STDIN as they are read.
+    Rows can be streamed from any iterable (e.g. a generator reading a huge file)
+    without the entire input being held in memory.
+
+    public
+        count: the number of rows read so far
+    """
+
+    def __init__(self, rows):
+        """
+        arguments
+            rows: an iterable of row tuples
+        """
+
+        self.count = 0
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+
+        parts = [self._buffer]
+        length = len(self._buffer)
+
+        while size < 0 or length < size:
+            try:
+                row = next(self._rows)
+
+            except StopIteration:
+                break
+
+            line = '\t'.join(format_copy_value(v) for v in row) + '\n'
+
+            parts.append(line)
+            length += len(line)
+            self.count += 1
+
+        data = ''.join(parts)
+
+        if size < 0:
+            self._buffer = ''
+
+            return data
+
+        self._buffer = data[size:]
+
+        return data[:size]
+
+def copy_rows(cursor, table, columns, rows, size=65536):
+    """
+    Streams rows into a table using COPY.
+
+    arguments
+        cursor:  an active psycopg cursor
+        table:   table name
+        columns: list of column names in the same order as the row values
+        rows:    an iterable of row tuples
+        size:    the size of each chunk of data sent to the DB
+
+    returns
+        the number of rows copied
+    """
+
+    data = CopyRows(rows)
+
+    cursor.copy_expert(
+        'COPY %s (%s) FROM STDIN;' % (table, ', '.join(columns)), data, size
+    )
+
+    return data.count
+
+def create_staging_table(cursor, table, columns):
+    """
+    Creates an empty temporary table used to stage data loaded by COPY. The table
+    is dropped when the transaction is committed.
+
+    arguments
+        cursor:  an active psycopg cursor
+        table:   staging table name
+        columns: list of column definitions, e.g. ['prb_ref_id VARCHAR']
+    """
+
+    cursor.execute('DROP TABLE IF EXISTS pg_temp.%s;' % table)
+    cursor.execute(
+        'CREATE TEMP TABLE %s (%s) ON COMMIT DROP;' % (table, ', '.join(columns))
+    )
+
+def set_join_threshold(threshold):
+    """
+    Sets the number of keys above which lookups (e.g. get_gene_ids) COPY their keys
+    into a temp table and join against it instead of sending an IN list.
+
+    arguments
+        threshold: key count, None disables the join strategy
+    """
+
+    global JOIN_THRESHOLD
+
+    JOIN_THRESHOLD = threshold
+
+def get_lookup_stats():
+    """
+    Returns instrumentation for lookups that choose between the IN list and temp
+    table join strategies.
+
+    returns
+        a dict containing the current join threshold and, for each lookup, the
+        number of calls and keys and the time spent (in seconds) using each
+        strategy
+    """
+
+    with _stats_lock:
+        lookups = dict(
+            (name, dict(stats)) for name, stats in _lookup_stats.items()
+        )
+
+    return {'threshold': JOIN_THRESHOLD, 'lookups': lookups}
+
+def reset_lookup_stats():
+    """
+    Clears the lookup instrumentation.
+    """
+
+    with _stats_lock:
+        _lookup_stats.clear()
+
+def _record_lookup(name, strategy, keys, elapsed):
+    """
+    Updates the instrumentation for a lookup.
+    """
+
+    with _stats_lock:
+        stats = _lookup_stats.setdefault(name, {
+            'in_calls': 0,
+            'in_keys': 0,
+            'in_time': 0.0,
+            'join_calls': 0,
+            'join_keys': 0,
+            'join_time': 0.0
+        })
+
+        stats[strategy + '_calls'] += 1
+        stats[strategy + '_keys'] += keys
+        stats[strategy + '_time'] += elapsed
+
+def _execute_lookup(cursor, name, query, keys, key_type, params=None):
+    """
+    Executes a lookup query for a list of keys. The query must reference the keys
+    using an IN condition on the %(keys)s parameter. Small key lists are sent as
+    an IN list. Lists larger than the join threshold are COPYed into a temp table,
+    which is analyzed so the planner can estimate its size, and the IN list is
+    replaced by a subquery over the table which is planned as a join.
+
+    arguments
+        cursor:   an active psycopg cursor
+        name:     lookup name used for instrumentation
+        query:    SQL query
+        keys:     list of keys
+        key_type: SQL type of the keys, e.g. VARCHAR
+        params:   optional dict of other query parameters
+    """
+
+    params = dict(params or {})
+    keys = set(keys)
+    start = time.time()
+
+    if JOIN_THRESHOLD is not None and len(keys) > JOIN_THRESHOLD:
+        strategy = 'join'
+
+        create_staging_table(cursor, 'lookup_keys', ['key %s' % key_type])
+        copy_rows(cursor, 'lookup_keys', ['key'], ((key,) for key in keys))
+        cursor.execute('ANALYZE lookup_keys;')
+
+        query = query.replace(
+            '%(keys)s', '(SELECT key FROM pg_temp.lookup_keys)'
+        )
+
+    else:
+        strategy = 'in'
+        params['keys'] = tuple(keys)
+
+    cursor.execute(query, params)
+
+    _record_lookup(name, strategy, len(keys), time.time() - start)
+
 def commit():
     """
     Commits the transaction.
     """
 
-    conn.commit()
+    get_connection().commit()
+
+def rollback():
+    """
+    Rolls back the transaction.
+    """
+
+    get_connection().rollback()
 
     ## SELECTIONS ##
     ################
@@ -366,7 +713,9 @@ def get_gene_ids(refs, sp_id=None, gdb_id=None):
 
     with PooledCursor() as cursor:
 
-        cursor.execute(
+        _execute_lookup(
+            cursor,
+            'get_gene_ids',
             '''
             WITH symbol_type AS (
                 SELECT gdb_id
@@ -381,7 +730,7 @@ def get_gene_ids(refs, sp_id=None, gdb_id=None):
             )
             SELECT  ode_ref_id, ode_gene_id
             FROM    extsrc.gene
-            WHERE   ode_ref_id IN %(refs)s AND
+            WHERE   ode_ref_id IN %(keys)s AND
                     CASE
                         WHEN %(spid)s IS NOT NULL AND %(gdbid)s IS NOT NULL
                         THEN sp_id = %(spid)s AND gdb_id = %(gdbid)s
@@ -411,7 +760,10 @@ def get_gene_ids(refs, sp_id=None, gdb_id=None):
                     -- We don't want to match gene IDs that are representing variants
                     --
                     gdb_id <> (SELECT * FROM variant_type);
-            ''', {'refs': refs, 'spid': sp_id, 'gdbid': gdb_id}
+            ''',
+            refs,
+            'VARCHAR',
+            {'spid': sp_id, 'gdbid': gdb_id}
         )
 
         return associate(cursor)
@@ -633,6 +985,181 @@ def get_geneset_ids(tiers=[1, 2, 3, 4, 5], at_id=None, size=0, sp_id=0):
 
         return listify(cursor)
 
+def get_geneset_partition_info(gs_ids):
+    """
+    Returns the curation tier, species, attribution, and size of each given gene
+    set. Used to partition gene sets for parallel exports and to build gene
+    indexes.
+
+    arguments
+        gs_ids: a list of gs_ids
+
+    returns
+        a list of dicts containing gs_id, cur_id, sp_id, gs_attribution, and
+        gs_count
+    """
+
+    gs_ids = tuplify(gs_ids)
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            SELECT  gs_id, cur_id, sp_id, gs_attribution, gs_count
+            FROM    production.geneset
+            WHERE   gs_id IN %s;
+            ''', (gs_ids,)
+        )
+
+        return dictify(cursor)
+
+def get_geneset_update_dates():
+    """
+    Returns the "last updated" date of every normal (i.e. their status is not
+    deleted or deprecated) gene set. Used to find gene sets that changed since an
+    index was built.
+
+    returns
+        a mapping of gs_ids -> gs_updated
+    """
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            SELECT  gs_id, gs_updated
+            FROM    production.geneset
+            WHERE   gs_status NOT LIKE 'de%';
+            '''
+        )
+
+        return associate(cursor)
+
+def set_gene_index(index):
+    """
+    Sets the in-memory index used to find the gene sets containing genes instead
+    of querying the DB (see get_genesets_by_genes and the geneindex module). Only
+    complete indexes, i.e. those containing every normal gene set, are used.
+
+    arguments
+        index: a geneindex.GeneIndex, None removes the index
+    """
+
+    global _gene_index
+
+    _gene_index = index
+
+def get_gene_index():
+    """
+    Returns the in-memory gene index or None if one hasn't been set.
+    """
+
+    return _gene_index
+
+def get_genesets_by_genes(
+    genes,
+    match='any',
+    tiers=[1, 2, 3, 4, 5],
+    at_id=None,
+    size=0,
+    sp_id=0,
+    min_overlap=1,
+    threshold=False
+):
+    """
+    Finds the normal (i.e. their status is not deleted or deprecated) gene sets
+    containing any or all of the given genes. Gene sets are filtered the same way
+    get_geneset_ids filters them. If a complete in-memory gene index built with
+    the same threshold setting has been set (see set_gene_index), it is used
+    instead of the DB. The index is a snapshot: gene sets deprecated, deleted, or
+    edited after it was built are returned as they were until the index is
+    rebuilt.
+
+    arguments
+        genes:       a list of ode_gene_ids
+        match:       any returns sets containing at least min_overlap of the genes,
+                     all returns sets containing every gene
+        tiers:       a list of curation tiers
+        at_id:       public resource attribution ID
+        size:        indicates the maximum size a set should be during retrieval
+        sp_id:       species identifier
+        min_overlap: the minimum number of genes a set must contain when matching
+                     any gene
+        threshold:   if true, only genes whose values are in the gene set
+                     threshold are considered
+
+    returns
+        a list of (gs_id, overlap) tuples, where overlap is the number of the genes
+        in the set, sorted by overlap (largest first) and gs_id
+    """
+
+    if match not in ('any', 'all'):
+        raise ValueError('Gene sets can only match any or all genes')
+
+    genes = set(genes)
+
+    if not genes:
+        return []
+
+    if match == 'all':
+        min_overlap = len(genes)
+
+    index = _gene_index
+
+    if index is not None and index.complete and index.threshold == threshold:
+        return index.find_genesets(
+            genes,
+            min_overlap=min_overlap,
+            tiers=tiers,
+            at_id=at_id,
+            size=size,
+            sp_id=sp_id
+        )
+
+    with PooledCursor() as cursor:
+
+        _execute_lookup(
+            cursor,
+            'get_genesets_by_genes',
+            '''
+            SELECT      gv.gs_id, COUNT(DISTINCT gv.ode_gene_id) AS overlap
+            FROM        extsrc.geneset_value gv
+            INNER JOIN  production.geneset g
+            USING       (gs_id)
+            WHERE       gv.ode_gene_id IN %(keys)s AND
+                        (gv.gsv_in_threshold OR NOT %(threshold)s) AND
+                        g.gs_status NOT LIKE 'de%%' AND
+                        g.cur_id IN %(tiers)s AND
+                        CASE
+                            WHEN %(at_id)s IS NOT NULL THEN g.gs_attribution = %(at_id)s
+                            ELSE TRUE
+                        END AND
+                        CASE
+                            WHEN %(size)s > 0 THEN g.gs_count < %(size)s
+                            ELSE TRUE
+                        END AND
+                        CASE
+                            WHEN %(sp_id)s > 0 THEN g.sp_id = %(sp_id)s
+                            ELSE TRUE
+                        END
+            GROUP BY    gv.gs_id
+            HAVING      COUNT(DISTINCT gv.ode_gene_id) >= %(min_overlap)s
+            ORDER BY    overlap DESC, gv.gs_id;
+            ''',
+            genes,
+            'BIGINT',
+            {
+                'threshold': threshold,
+                'tiers': tuplify(tiers),
+                'at_id': at_id,
+                'size': size,
+                'sp_id': sp_id,
+                'min_overlap': min_overlap
+            }
+        )
+
+        return [(row[0], row[1]) for row in cursor]
+
 ## Remove this
 def get_geneset_ids_by_attribute(attrib, size=0, sp_id=0):
     """
@@ -701,6 +1228,131 @@ def get_geneset_values(gs_ids):
 
         return results
 
+def iter_geneset_values(gs_ids, itersize=100000):
+    """
+    Streams the values for the given gene sets along with the gene reference each
+    value was uploaded with. This is used to export gene sets.
+    Values that don't have an uploaded reference use the gene's reference for the
+    gene set's gene type (preferring ode_pref references), or the ode_gene_id if
+    that doesn't exist.
+
+    arguments
+        gs_ids:   a list of gs_ids
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a generator of (gs_id, ode_gene_id, reference, gsv_value) tuples sorted by
+        gs_id
+    """
+
+    return _iter_rows(
+        '''
+        SELECT      v.gs_id, v.ode_gene_id,
+                    COALESCE(
+                        v.gsv_source_list[1],
+                        (SELECT   g.ode_ref_id
+                         FROM     extsrc.gene g
+                         WHERE    g.ode_gene_id = v.ode_gene_id AND
+                                  g.gdb_id = -gs.gs_gene_id_type
+                         ORDER BY g.ode_pref DESC
+                         LIMIT    1),
+                        v.ode_gene_id :: VARCHAR
+                    ),
+                    v.gsv_value
+        FROM        extsrc.geneset_value v
+        INNER JOIN  production.geneset gs
+        USING       (gs_id)
+        WHERE       v.gs_id IN %s
+        ORDER BY    v.gs_id, v.ode_gene_id;
+        ''',
+        (tuplify(gs_ids),),
+        itersize
+    )
+
+def iter_geneset_value_rows(gs_ids=None, itersize=100000):
+    """
+    Streams gene set values. Used to export gene sets into binary stores (see the
+    store module).
+
+    arguments
+        gs_ids:   a list of gs_ids, if None the values for every normal (i.e. not
+                  deleted or deprecated) gene set are returned
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a generator of (gs_id, ode_gene_id, gsv_value, gsv_in_threshold) tuples
+        sorted by gs_id and ode_gene_id
+    """
+
+    if gs_ids is None:
+        return _iter_rows(
+            '''
+            SELECT      v.gs_id, v.ode_gene_id, v.gsv_value, v.gsv_in_threshold
+            FROM        extsrc.geneset_value v
+            INNER JOIN  production.geneset g
+            USING       (gs_id)
+            WHERE       g.gs_status NOT LIKE %s
+            ORDER BY    v.gs_id, v.ode_gene_id;
+            ''',
+            ('de%',),
+            itersize
+        )
+
+    return _iter_rows(
+        '''
+        SELECT      gs_id, ode_gene_id, gsv_value, gsv_in_threshold
+        FROM        extsrc.geneset_value
+        WHERE       gs_id IN %s
+        ORDER BY    gs_id, ode_gene_id;
+        ''',
+        (tuplify(gs_ids),),
+        itersize
+    )
+
+def get_geneset_values_by_size(keys):
+    """
+    Returns the values of every normal (i.e. not deleted or deprecated) gene set
+    with a matching species, gene type, and size. Used to find stored gene sets
+    that could be identical to new ones.
+
+    arguments
+        keys: a list of (sp_id, gs_gene_id_type, gs_count) tuples
+
+    returns
+        a list of dicts, each dict contains the gene set id, species, gene type,
+        threshold type, threshold, and a list of (ode_gene_id, gsv_value) tuples
+        (values)
+    """
+
+    keys = tuple(tuple(k) for k in keys)
+
+    if not keys:
+        return []
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            SELECT      g.gs_id, g.sp_id, g.gs_gene_id_type, g.gs_threshold_type,
+                        g.gs_threshold,
+                        ARRAY_AGG(v.ode_gene_id) AS ode_gene_ids,
+                        ARRAY_AGG(v.gsv_value) AS gsv_values
+            FROM        production.geneset g
+            INNER JOIN  extsrc.geneset_value v
+            USING       (gs_id)
+            WHERE       g.gs_status NOT LIKE 'de%%' AND
+                        (g.sp_id, g.gs_gene_id_type, g.gs_count) IN %s
+            GROUP BY    g.gs_id;
+            ''', (keys,)
+        )
+
+        results = dictify(cursor)
+
+        for gs in results:
+            gs['values'] = list(zip(gs.pop('ode_gene_ids'), gs.pop('gsv_values')))
+
+        return results
+
 def get_gene_homologs(genes, source='Homologene'):
     """
     Returns all homology IDs for the given list of gene IDs.
@@ -758,6 +1410,36 @@ def get_homolog_species(hom_ids):
 
         return associate_duplicate(cursor)
 
+def get_homolog_genes(hom_ids, sp_id, source='Homologene'):
+    """
+    Returns the genes belonging to the given homology IDs in a single species. Used
+    to translate genes between species.
+
+    arguments
+        hom_ids: a list of hom_ids
+        sp_id:   species identifier
+        source:  the homology mapping data source to use, default is Homologene
+
+    returns
+        a 1:N mapping of homology IDs to gene IDs (ode_gene_id)
+    """
+
+    hom_ids = tuplify(hom_ids)
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            SELECT  hom_id, ode_gene_id
+            FROM    extsrc.homology
+            WHERE   hom_id IN %s AND
+                    sp_id = %s AND
+                    hom_source_name = %s;
+            ''', (hom_ids, sp_id, source)
+        )
+
+        return associate_duplicate(cursor)
+
 def get_publication(pmid):
     """
     Returns the GW publication ID associated with the given PubMed ID.
@@ -1083,7 +1765,7 @@ def get_all_platform_probes(pf_id):
         pf_id: platform ID
 
     returns
-        a list of probe references
+        a mapping of probe references to GW probe identifiers
     """
 
     with PooledCursor() as cursor:
@@ -1096,7 +1778,35 @@ def get_all_platform_probes(pf_id):
             ''', (pf_id,)
         )
 
-        return listify(cursor)
+        return associate(cursor)
+
+def get_platform_probe_genes(pf_id):
+    """
+    Returns every probe for the given platform along with the genes each probe is
+    supposed to map to. Probes that don't map to any genes are included.
+
+    arguments
+        pf_id: platform ID
+
+    returns
+        a list of (prb_ref_id, prb_id, ode_gene_id) tuples sorted by prb_id. The
+        ode_gene_id is None for probes that don't map to any genes.
+    """
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            SELECT      p.prb_ref_id, p.prb_id, p2g.ode_gene_id
+            FROM        odestatic.probe p
+            LEFT JOIN   extsrc.probe2gene p2g
+            USING       (prb_id)
+            WHERE       p.pf_id = %s
+            ORDER BY    p.prb_id, p2g.ode_gene_id;
+            ''', (pf_id,)
+        )
+
+        return cursor.fetchall()
 
 ## Idk if this is ever used anywhere
 def get_all_platform_genes(pf_id):
@@ -1244,7 +1954,7 @@ def get_geneset_annotations(gs_ids):
             SELECT      go.gs_id, go.ont_id, o.ont_ref_id
             FROM        extsrc.geneset_ontology AS go
             INNER JOIN  extsrc.ontology AS o
-            ON          USING (ont_id)
+            USING       (ont_id)
             WHERE       gs_id IN %s;
             ''', (gs_ids,)
         )
@@ -1594,6 +2304,50 @@ def insert_publication(pub):
 
         return cursor.fetchone()[0]
 
+def insert_publications(pubs):
+    """
+    Inserts many new publications into the database using a single statement.
+
+    arguments
+        pubs: a list of dicts with fields matching the columns in the publication
+              table
+
+    returns
+        a dict mapping PMIDs -> pub_ids
+    """
+
+    if not pubs:
+        return {}
+
+    with PooledCursor() as cursor:
+
+        ## execute_values can't return results in our version of psycopg2 so the
+        ## VALUES list is built manually
+        values = b','.join(
+            cursor.mogrify(
+                '''
+                (%(pub_authors)s, %(pub_title)s, %(pub_abstract)s,
+                %(pub_journal)s, %(pub_volume)s, %(pub_pages)s, %(pub_month)s,
+                %(pub_year)s, %(pub_pubmed)s)
+                ''', pub
+            ) for pub in pubs
+        )
+
+        cursor.execute(
+            b'''
+            INSERT INTO publication
+
+                (pub_authors, pub_title, pub_abstract, pub_journal,
+                pub_volume, pub_pages, pub_month, pub_year, pub_pubmed)
+
+            VALUES %s
+
+            RETURNING pub_pubmed, pub_id;
+            ''' % values
+        )
+
+        return associate(cursor)
+
 def insert_file(size, contents, comments=''):
     """
     Inserts a new file into the database.
@@ -1705,6 +2459,139 @@ def insert_probe2gene(prb_id, ode_id):
 
         return cursor.fetchone()[0]
 
+def import_platform(platform, probes, probe_gene_links, diff=False):
+    """
+    Bulk loads an expression platform along with its probes and the genes each
+    probe maps to. Probes and probe -> gene links are streamed into staging
+    tables using COPY and inserted using a few set based statements, all within
+    the current transaction. Nothing is committed; call commit() once the import
+    succeeds or rollback() if it fails.
+
+    Probes and links already stored for an existing platform are never inserted
+    again, so imports can be rerun. If diff is true, stored links for the imported
+    probes that are missing from the import are also deleted. Stored probes are
+    never deleted.
+
+    The platform's cached probe index (see probes.py) is cleared so it's rebuilt
+    from the imported probes the next time it's used.
+
+    arguments
+        platform:         a dict whose keys should match those of the platform
+                          table (see insert_platform). If it contains a pf_id, the
+                          existing platform is used instead of inserting a new one.
+        probes:           an iterable of probe reference IDs
+        probe_gene_links: an iterable of (probe reference, ode_gene_id) tuples.
+                          Links for references missing from probes are skipped.
+        diff:             delete stored links for the imported probes that are
+                          missing from the import
+
+    returns
+        a mapping of the imported probe references to their prb_ids. The pf_id of
+        a new platform is added to the platform object.
+    """
+
+    ## New platforms can't have stored probes so they aren't checked for
+    existing = bool(platform.get('pf_id'))
+
+    if not existing:
+        platform['pf_id'] = insert_platform(platform)
+
+    pf_id = platform['pf_id']
+
+    with PooledCursor() as cursor:
+
+        create_staging_table(cursor, 'probe_staging', ['prb_ref_id VARCHAR'])
+        create_staging_table(
+            cursor, 'probe2gene_staging', ['prb_ref_id VARCHAR', 'ode_gene_id BIGINT']
+        )
+
+        copy_rows(cursor, 'probe_staging', ['prb_ref_id'], ((p,) for p in probes))
+        copy_rows(
+            cursor,
+            'probe2gene_staging',
+            ['prb_ref_id', 'ode_gene_id'],
+            probe_gene_links
+        )
+
+        cursor.execute('ANALYZE probe_staging;')
+        cursor.execute('ANALYZE probe2gene_staging;')
+
+        cursor.execute(
+            '''
+            INSERT INTO odestatic.probe (prb_ref_id, pf_id)
+
+            SELECT DISTINCT s.prb_ref_id, %(pf_id)s
+            FROM            probe_staging s
+            WHERE           NOT %(existing)s OR
+                            NOT EXISTS (
+                                SELECT 1
+                                FROM   odestatic.probe p
+                                WHERE  p.pf_id = %(pf_id)s AND
+                                       p.prb_ref_id = s.prb_ref_id
+                            );
+            ''', {'pf_id': pf_id, 'existing': existing}
+        )
+
+        ## Used to resolve probe references for the links
+        cursor.execute(
+            '''
+            CREATE TEMP TABLE probe_ids ON COMMIT DROP AS
+
+            SELECT      p.prb_ref_id, MIN(p.prb_id) AS prb_id
+            FROM        odestatic.probe p
+            INNER JOIN  (SELECT DISTINCT prb_ref_id FROM probe_staging) s
+            USING       (prb_ref_id)
+            WHERE       p.pf_id = %s
+            GROUP BY    p.prb_ref_id;
+            ''', (pf_id,)
+        )
+
+        if diff:
+            cursor.execute(
+                '''
+                DELETE FROM extsrc.probe2gene p2g
+                USING       probe_ids p
+                WHERE       p2g.prb_id = p.prb_id AND
+                            NOT EXISTS (
+                                SELECT 1
+                                FROM   probe2gene_staging s
+                                WHERE  s.prb_ref_id = p.prb_ref_id AND
+                                       s.ode_gene_id = p2g.ode_gene_id
+                            );
+                '''
+            )
+
+        cursor.execute(
+            '''
+            INSERT INTO extsrc.probe2gene (prb_id, ode_gene_id)
+
+            SELECT DISTINCT p.prb_id, s.ode_gene_id
+            FROM            probe2gene_staging s
+            INNER JOIN      probe_ids p
+            USING           (prb_ref_id)
+            WHERE           NOT %s OR
+                            NOT EXISTS (
+                                SELECT 1
+                                FROM   extsrc.probe2gene p2g
+                                WHERE  p2g.prb_id = p.prb_id AND
+                                       p2g.ode_gene_id = s.ode_gene_id
+                            );
+            ''', (existing,)
+        )
+
+        cursor.execute('SELECT prb_ref_id, prb_id FROM probe_ids;')
+
+        ref2prb = associate(cursor)
+
+        cursor.execute('DROP TABLE probe_ids;')
+
+    ## probes imports this module so it can't be imported at the top
+    from gwlib.probes import clear_platform_index
+
+    clear_platform_index(pf_id)
+
+    return ref2prb
+
 def insert_jaccard(lid, rid, jac):
     """
     Inserts an entry into the jaccard table.
@@ -1912,6 +2799,51 @@ def update_geneset_size(gsid, size):
 
         return cursor.rowcount
 
+def update_geneset_values(gsid, values):
+    """
+    Updates the scores of existing gene set values.
+
+    arguments
+        gsid:   gene set ID
+        values: a list of (ode_gene_id, value, in_threshold) tuples
+
+    returns
+        the number of rows affected by the update
+    """
+
+    values = [
+        (gsid, ode, float(value), [float(value)], thresh)
+        for ode, value, thresh in values
+    ]
+
+    if not values:
+        return 0
+
+    with PooledCursor() as cursor:
+
+        ## A single page so the rowcount covers every value
+        execute_values(
+            cursor,
+            '''
+            UPDATE extsrc.geneset_value AS gsv
+            SET    gsv_value = v.value,
+                   gsv_value_list = v.value_list,
+                   gsv_in_threshold = v.in_threshold,
+                   gsv_date = NOW()
+            FROM   (VALUES %s) AS v (gs_id, ode_gene_id, value, value_list,
+                                     in_threshold)
+            WHERE  gsv.gs_id = v.gs_id AND
+                   gsv.ode_gene_id = v.ode_gene_id;
+            ''',
+            values,
+            '''
+            (%s, %s, %s::NUMERIC, %s::NUMERIC[], %s::BOOLEAN)
+            ''',
+            page_size=len(values)
+        )
+
+        return cursor.rowcount
+
 def update_ontology_term_by_ref(ref_id, name, description, children, parents):
     """
     Updates an ontology term using its reference identifier. The reference identifier
@@ -2015,6 +2947,36 @@ def delete_ontology_relations(ont_ids):
 
         return cursor.rowcount
 
+def delete_geneset_values(gsid, genes):
+    """
+    Deletes gene set values for the given genes.
+
+    arguments
+        gsid:  gene set ID
+        genes: list of ode_gene_ids to remove from the gene set
+
+    returns
+        the number of rows deleted
+    """
+
+    genes = tuplify(genes)
+
+    if not genes:
+        return 0
+
+    with PooledCursor() as cursor:
+
+        cursor.execute(
+            '''
+            DELETE
+            FROM   extsrc.geneset_value
+            WHERE  gs_id = %s AND
+                   ode_gene_id IN %s;
+            ''', (gsid, genes)
+        )
+
+        return cursor.rowcount
+
     ## VARIANT RELATED ##
     #####################
 
@@ -2105,7 +3067,9 @@ def get_variants_by_refs(refs, build):
 
     with PooledCursor() as cursor:
 
-        cursor.execute(
+        _execute_lookup(
+            cursor,
+            'get_variants_by_refs',
             '''
             SELECT     v.var_ref_id, v.var_id
             FROM       extsrc.variant v
@@ -2114,10 +3078,13 @@ def get_variants_by_refs(refs, build):
             WHERE      vi.gb_id = (
                             SELECT gb_id
                             FROM   odestatic.genome_build
-                            WHERE  gb_ref_id = %s
+                            WHERE  gb_ref_id = %(build)s
                         ) AND
-                        v.var_ref_id IN %s;
-            ''', (build, refs)
+                        v.var_ref_id IN %(keys)s;
+            ''',
+            refs,
+            'BIGINT',
+            {'build': build}
         )
 
         return associate(cursor)
@@ -2146,7 +3113,9 @@ def get_variant_odes_by_refs(refs, build):
 
     with PooledCursor() as cursor:
 
-        cursor.execute(
+        _execute_lookup(
+            cursor,
+            'get_variant_odes_by_refs',
             '''
             SELECT     v.var_ref_id, g.ode_gene_id
             FROM       extsrc.variant v
@@ -2160,10 +3129,13 @@ def get_variant_odes_by_refs(refs, build):
             ---- index on the gene table
             --
             ON         v.var_id :: varchar = g.ode_ref_id
-            WHERE      gb.gb_ref_id = %s AND
+            WHERE      gb.gb_ref_id = %(build)s AND
                        g.sp_id = gb.sp_id AND
-                       v.var_ref_id IN %s;
-            ''', (build, refs)
+                       v.var_ref_id IN %(keys)s;
+            ''',
+            refs,
+            'BIGINT',
+            {'build': build}
         )
 
         return associate(cursor)
@@ -2202,6 +3174,98 @@ def get_variant_refs_by_odes(odes, build):
 
         return associate(cursor)
 
+def _iter_rows(query, args, itersize):
+    """
+    Executes a query using a named (server side) cursor and yields the results one
+    row at a time, so large results don't have to fit in memory.
+
+    arguments
+        query:    SQL query
+        args:     query arguments
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a generator of row tuples
+    """
+
+    ## Named cursors don't support multiple statements so the search path can't be
+    ## set, queries should use schema qualified table names
+    cursor = get_connection().cursor(name='gwlib_iter_%s' % next(_cursor_ids))
+    cursor.itersize = itersize
+
+    try:
+        cursor.execute(query, args)
+
+        for row in cursor:
+            yield row
+
+    finally:
+        cursor.close()
+
+def iter_variant_genes(build, itersize=100000):
+    """
+    Retrieves every variant for a genome build along with its variant gene ID.
+    This is used to export variant indexes (see the varindex module).
+
+    arguments
+        build:    genome build
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a generator of (var_ref_id, var_id, ode_gene_id) tuples sorted by
+        var_ref_id. The ode_gene_id is None for variants without variant genes.
+    """
+
+    return _iter_rows(
+        '''
+        SELECT     v.var_ref_id, v.var_id, g.ode_gene_id
+        FROM       extsrc.variant v
+        INNER JOIN extsrc.variant_info vi
+        USING      (vri_id)
+        INNER JOIN odestatic.genome_build gb
+        USING      (gb_id)
+        LEFT JOIN  extsrc.gene g
+        ON         v.var_id :: varchar = g.ode_ref_id AND
+                   g.sp_id = gb.sp_id
+        WHERE      gb.gb_ref_id = %s
+        ORDER BY   v.var_ref_id, v.var_id;
+        ''',
+        (build,),
+        itersize
+    )
+
+def iter_variant_gene_refs(build, itersize=100000):
+    """
+    Retrieves every variant gene ID for a genome build along with its variant
+    reference identifier (rsID). This is used to export variant indexes (see the
+    varindex module).
+
+    arguments
+        build:    genome build
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a generator of (ode_gene_id, var_ref_id) tuples sorted by ode_gene_id
+    """
+
+    return _iter_rows(
+        '''
+        SELECT     g.ode_gene_id, v.var_ref_id
+        FROM       extsrc.variant v
+        INNER JOIN extsrc.variant_info vi
+        USING      (vri_id)
+        INNER JOIN odestatic.genome_build gb
+        USING      (gb_id)
+        INNER JOIN extsrc.gene g
+        ON         v.var_id :: varchar = g.ode_ref_id AND
+                   g.sp_id = gb.sp_id
+        WHERE      gb.gb_ref_id = %s
+        ORDER BY   g.ode_gene_id;
+        ''',
+        (build,),
+        itersize
+    )
+
 def roll_up_variants_from_odes(odes, mapping=('Variant',)):
     """
     Rolls the given list of variants up to the gene level using the given variant mapping
@@ -2310,31 +3374,17 @@ def insert_variant(var):
 
 def insert_variants_and_info(variants):
     """
+    Inserts variants and their variant_info records. This uses load_variants and
+    doesn't commit.
+
+    arguments
+        variants: a list of variant objects (see load_variants)
+
+    returns
+        the number of variants inserted
     """
-    with PooledCursor() as cursor:
-        execute_values(
-            cursor,
-            '''
-            INSERT INTO extsrc.variant
-                (
-                    var_ref_id, var_allelel, var_obs_alleles, var_ma, var_maf,
-                    vt_id, var_clinsig, vri_id
-                )
-            VALUES %s;
-            ''',
-            variants,
-            '''
-            (%(rsid)s, %(allele)s, %(observed)s, %(ma)s, %(maf)s, %(effect)s,
-            %(clinsig)s,
-            (
-                INSERT INTO extsrc.variant_info
-                    (vri_chromosome, vri_position, gb_id)
-                VALUES
-                    (%(chrom)s, %(coord)s, %(build)s)
-                RETURNING vri_id
-            ))
-            '''
-        )
+
+    return load_variants(variants, commit=False)
 
 def insert_variants(variants):
     """
@@ -2345,7 +3395,7 @@ def insert_variants(variants):
             '''
             INSERT INTO extsrc.variant
                 (
-                    var_ref_id, var_allelel, var_obs_alleles, var_ma, var_maf,
+                    var_ref_id, var_allele, var_obs_alleles, var_ma, var_maf,
                     vt_id, var_clinsig, vri_id
                 )
             VALUES %s;
@@ -2360,8 +3410,21 @@ def insert_variants(variants):
 
 def insert_variant_infos(variants):
     """
+    Inserts variant_info records. Use load_variants for large numbers of variants.
+
+    arguments
+        variants: a list of variant objects (see load_variants)
+
+    returns
+        the list of vri_ids, in the same order as the variants
     """
+
+    if not variants:
+        return []
+
     with PooledCursor() as cursor:
+        ## Everything must be inserted using a single page otherwise only the IDs
+        ## from the last page are returned
         execute_values(
             cursor,
             '''
@@ -2373,10 +3436,11 @@ def insert_variant_infos(variants):
             variants,
             '''
             (%(chrom)s, %(coord)s, %(build)s)
-            '''
+            ''',
+            page_size=len(variants)
         )
 
-        return map(lambda t: t[0], cursor.fetchall())
+        return [row[0] for row in cursor.fetchall()]
 
 def insert_variant_info(variant):
     """
@@ -2395,6 +3459,146 @@ def insert_variant_info(variant):
         return cursor.fetchone()[0]
 
 
+## Variant object fields and their staging table column types, in COPY order
+VARIANT_STAGING_COLUMNS = (
+    ('rsid', 'BIGINT'),
+    ('allele', 'VARCHAR'),
+    ('observed', 'VARCHAR'),
+    ('ma', 'VARCHAR'),
+    ('maf', 'NUMERIC'),
+    ('effect', 'INTEGER'),
+    ('clinsig', 'VARCHAR'),
+    ('chrom', 'VARCHAR'),
+    ('coord', 'BIGINT'),
+    ('build', 'INTEGER')
+)
+
+def _load_variant_batch(cursor, variants):
+    """
+    Loads a single batch of variants. See load_variants.
+
+    arguments
+        cursor:   an active psycopg cursor
+        variants: a list of variant objects
+
+    returns
+        the number of variants inserted
+    """
+
+    fields = [f for f, _ in VARIANT_STAGING_COLUMNS]
+
+    create_staging_table(
+        cursor,
+        'variant_staging',
+        ['%s %s' % column for column in VARIANT_STAGING_COLUMNS]
+    )
+
+    copy_rows(
+        cursor,
+        'variant_staging',
+        fields,
+        (tuple(var.get(f) for f in fields) for var in variants)
+    )
+
+    cursor.execute('ANALYZE variant_staging;')
+
+    ## variant_info records are shared by every variant at the same location
+    cursor.execute(
+        '''
+        INSERT INTO extsrc.variant_info (vri_chromosome, vri_position, gb_id)
+
+        SELECT DISTINCT s.chrom, s.coord, s.build
+        FROM            variant_staging s
+        WHERE           NOT EXISTS (
+                            SELECT 1
+                            FROM   extsrc.variant_info vi
+                            WHERE  vi.vri_chromosome = s.chrom AND
+                                   vi.vri_position = s.coord AND
+                                   vi.gb_id = s.build
+                        );
+        '''
+    )
+
+    cursor.execute('DROP TABLE IF EXISTS pg_temp.variant_info_staging;')
+    cursor.execute(
+        '''
+        CREATE TEMP TABLE variant_info_staging ON COMMIT DROP AS
+
+        SELECT      vi.vri_chromosome, vi.vri_position, vi.gb_id,
+                    MIN(vi.vri_id) AS vri_id
+        FROM        extsrc.variant_info vi
+        INNER JOIN  (SELECT DISTINCT chrom, coord, build FROM variant_staging) s
+        ON          vi.vri_chromosome = s.chrom AND
+                    vi.vri_position = s.coord AND
+                    vi.gb_id = s.build
+        GROUP BY    vi.vri_chromosome, vi.vri_position, vi.gb_id;
+        '''
+    )
+
+    cursor.execute(
+        '''
+        INSERT INTO extsrc.variant
+
+            (var_ref_id, var_allele, var_obs_alleles, var_ma, var_maf, vt_id,
+            var_clinsig, vri_id)
+
+        SELECT      s.rsid, s.allele, s.observed, s.ma, s.maf, s.effect,
+                    s.clinsig, vi.vri_id
+        FROM        variant_staging s
+        INNER JOIN  variant_info_staging vi
+        ON          vi.vri_chromosome = s.chrom AND
+                    vi.vri_position = s.coord AND
+                    vi.gb_id = s.build;
+        '''
+    )
+
+    return cursor.rowcount
+
+def load_variants(variants, batch_size=500000, commit=True, progress=None):
+    """
+    Bulk loads variants and their variant_info records. Variants are streamed in
+    batches into a staging table using COPY. For each batch, missing variant_info
+    records are inserted and vri_ids are assigned using set based SQL, then the
+    variants are inserted. Only a single batch is held in memory so any number of
+    variants can be loaded from e.g. a generator reading a dbSNP file.
+
+    arguments
+        variants:   an iterable of variant objects. Each object is a dict with the
+                    following keys: rsid, allele, observed, ma, maf, effect (vt_id),
+                    clinsig, chrom, coord, and build (gb_id).
+        batch_size: the number of variants loaded at once
+        commit:     if true, each batch is committed once it's loaded, otherwise
+                    nothing is committed
+        progress:   optional function called after each batch with the total
+                    number of variants read and inserted so far
+
+    returns
+        the number of variants inserted
+    """
+
+    variants = iter(variants)
+    read = 0
+    inserted = 0
+
+    while True:
+        batch = list(islice(variants, batch_size))
+
+        if not batch:
+            break
+
+        with PooledCursor() as cursor:
+            inserted += _load_variant_batch(cursor, batch)
+
+        if commit:
+            get_connection().commit()
+
+        read += len(batch)
+
+        if progress:
+            progress(read, inserted)
+
+    return inserted
+
 def insert_variant_with_id(var):
     """
     """
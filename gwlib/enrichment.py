@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: enrichment.py
+## desc: Hypergeometric enrichment of a query gene list against every gene set in
+##       a gene x gene set matrix. Overlaps for all sets are computed with a single
+##       sparse matrix-vector product over the query's rows, p-values are only
+##       evaluated for sets that overlap the query and are memoized by (overlap,
+##       set size), and results are corrected using Benjamini-Hochberg.
+## auth: TR
+#
+
+from __future__ import print_function
+from math import exp
+from math import lgamma
+
+from gwlib import db
+from gwlib import matrix as gwmatrix
+
+def log_choose(n, k):
+    """
+    Calculates the natural log of the binomial coefficient n choose k.
+    """
+
+    return lgamma(n + 1) - lgamma(k + 1) - lgamma(n - k + 1)
+
+def hypergeometric_sf(k, population, successes, draws):
+    """
+    Calculates the probability of drawing at least k successes, i.e. the upper
+    tail of the hypergeometric distribution. This is also the p-value of a one
+    sided Fisher's exact test for over-representation.
+
+    arguments
+        k:          the number of observed successes (the overlap)
+        population: the population size (background genes)
+        successes:  the number of successes in the population (gene set size)
+        draws:      the number of draws (query size)
+
+    returns
+        the p-value
+    """
+
+    lo = max(0, draws - (population - successes))
+    hi = min(successes, draws)
+
+    if k <= lo:
+        return 1.0
+
+    if k > hi:
+        return 0.0
+
+    ## Terms are summed starting next to the mode, where they're largest, so the
+    ## first term doesn't underflow when the other tail holds almost all the mass.
+    ## Below the mode the lower tail is summed and subtracted from 1.
+    mode = (draws + 1) * (successes + 1) // (population + 2)
+    upper = k > mode
+    x = k if upper else k - 1
+
+    ## Probability of exactly x successes, successive terms are found using the
+    ## ratio between consecutive probabilities
+    log_pmf = log_choose(successes, x)
+    log_pmf += log_choose(population - successes, draws - x)
+    log_pmf -= log_choose(population, draws)
+    pmf = exp(log_pmf)
+    total = 0.0
+
+    if upper:
+        for x in range(k, hi + 1):
+            total += pmf
+            pmf *= float((successes - x) * (draws - x)) / (
+                (x + 1) * (population - successes - draws + x + 1)
+            )
+
+            if pmf < total * 1e-16:
+                break
+
+        return min(total, 1.0)
+
+    for x in range(k - 1, lo - 1, -1):
+        total += pmf
+        pmf *= float(x * (population - successes - draws + x)) / (
+            (successes - x + 1) * (draws - x + 1)
+        )
+
+        if pmf < total * 1e-16:
+            break
+
+    return max(1.0 - total, 0.0)
+
+def benjamini_hochberg(pvalues, tests=None):
+    """
+    Adjusts p-values for multiple testing using the Benjamini-Hochberg procedure.
+
+    arguments
+        pvalues: list of p-values
+        tests:   the total number of tests, defaults to the number of p-values.
+                 This is used when p-values for tests that can't be significant
+                 (e.g. sets which don't overlap the query) are left out.
+
+    returns
+        a list of adjusted p-values (q-values) in the same order as the p-values
+    """
+
+    tests = tests or len(pvalues)
+    order = sorted(range(len(pvalues)), key=lambda i: pvalues[i])
+    qvalues = [1.0] * len(pvalues)
+    minimum = 1.0
+
+    for rank in range(len(order), 0, -1):
+        i = order[rank - 1]
+        minimum = min(minimum, pvalues[i] * tests / float(rank))
+        qvalues[i] = minimum
+
+    return qvalues
+
+class EnrichmentEngine(object):
+    """
+    Tests a gene list for over-representation in every gene set of a matrix.
+    Gene set sizes are restricted to the background once, when the engine is
+    created, so each query only touches the matrix rows of its own genes.
+
+    public
+        matrix:     a matrix.GenesetMatrix
+        population: the number of background genes
+    """
+
+    def __init__(self, matrix, background=None):
+        """
+        arguments
+            matrix:     a matrix.GenesetMatrix
+            background: list of background ode_gene_ids, e.g. a species' genes.
+                        Defaults to every gene in the matrix.
+        """
+
+        self.matrix = matrix
+
+        if background is None:
+            self._background = set(matrix.genes)
+        else:
+            self._background = set(background)
+
+        self.population = len(self._background)
+
+        ## Matrix rows that are part of the background
+        self._in_background = bytearray(
+            1 if ode in self._background else 0 for ode in matrix.genes
+        )
+        self._sizes = [0] * len(matrix.gs_ids)
+
+        for j in range(len(matrix.gs_ids)):
+            for k in range(matrix.indptr[j], matrix.indptr[j + 1]):
+                self._sizes[j] += self._in_background[matrix.indices[k]]
+
+        self._tests = sum(1 for size in self._sizes if size)
+
+    def overlaps(self, genes):
+        """
+        Computes the overlap between a gene list and every gene set, i.e. the
+        product of the (transposed) matrix and the list's indicator vector.
+
+        arguments
+            genes: list of ode_gene_ids, genes outside the background are ignored
+
+        returns
+            a dict of column index -> overlap for sets with a non-zero overlap
+        """
+
+        indptr, indices, _ = self.matrix.to_csr()
+        overlaps = {}
+
+        for ode in set(genes):
+            i = self.matrix.get_row(ode)
+
+            if i is None or not self._in_background[i]:
+                continue
+
+            for j in indices[indptr[i]:indptr[i + 1]]:
+                overlaps[j] = overlaps.get(j, 0) + 1
+
+        return overlaps
+
+    def enrich(self, genes, min_overlap=1, alpha=None):
+        """
+        Tests a gene list for over-representation in every gene set.
+
+        arguments
+            genes:       list of ode_gene_ids
+            min_overlap: sets sharing fewer genes with the list aren't returned
+            alpha:       if given, only sets whose adjusted p-value is at most
+                         alpha are returned
+
+        returns
+            a list of result objects sorted by p-value and gs_id. Each object is a
+            dict containing the gs_id, overlap, gene set size within the
+            background (size), p-value (pvalue), and Benjamini-Hochberg adjusted
+            p-value (qvalue). Adjustment accounts for every gene set with genes in
+            the background, including those that don't overlap the list.
+        """
+
+        draws = len(set(genes) & self._background)
+        overlaps = self.overlaps(genes)
+        pvalues = {}
+        results = []
+
+        for j, overlap in overlaps.items():
+            key = (overlap, self._sizes[j])
+
+            if key not in pvalues:
+                pvalues[key] = hypergeometric_sf(
+                    overlap, self.population, self._sizes[j], draws
+                )
+
+            results.append({
+                'gs_id': self.matrix.gs_ids[j],
+                'overlap': overlap,
+                'size': self._sizes[j],
+                'pvalue': pvalues[key]
+            })
+
+        qvalues = benjamini_hochberg(
+            [r['pvalue'] for r in results], max(self._tests, len(results))
+        )
+
+        for result, qvalue in zip(results, qvalues):
+            result['qvalue'] = qvalue
+
+        results = [
+            r for r in results
+            if r['overlap'] >= min_overlap and (alpha is None or r['qvalue'] <= alpha)
+        ]
+
+        results.sort(key=lambda r: (r['pvalue'], r['gs_id']))
+
+        return results
+
+def build_enrichment_engine(
+    sp_id,
+    tiers=[1, 2, 3, 4, 5],
+    at_id=None,
+    size=0,
+    threshold=True,
+    gdb_id=None,
+    symbol=True,
+    itersize=100000
+):
+    """
+    Builds an enrichment engine for a species' gene sets from the DB. The species'
+    genes (see db.get_species_genes) are used as the background.
+
+    arguments
+        sp_id:     species identifier
+        tiers:     a list of curation tiers
+        at_id:     public resource attribution ID
+        size:      indicates the maximum size a set should be
+        threshold: if true, only genes whose values are in the gene set threshold
+                   are considered part of the set
+        gdb_id:    optional gene type used to select background genes
+        symbol:    if true, background genes are limited to those with symbols
+        itersize:  the number of rows fetched from the DB at once
+
+    returns
+        an EnrichmentEngine
+    """
+
+    gs_ids = db.get_geneset_ids(tiers=tiers, at_id=at_id, size=size, sp_id=sp_id)
+    gsm = gwmatrix.build_matrix(
+        gs_ids, values=False, thresholds=threshold, itersize=itersize
+    ) if gs_ids else gwmatrix.GenesetMatrix(values=False, thresholds=threshold)
+
+    if threshold:
+        gsm = gsm.threshold_only()
+
+    background = db.get_species_genes(sp_id, gdb_id=gdb_id, symbol=symbol)
+
+    return EnrichmentEngine(gsm, set(background.values()))
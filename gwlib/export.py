@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: export.py
+## desc: Exports gene sets from the DB into batch files. Gene set metadata,
+##       publications, and annotations are retrieved in bulk chunks and values are
+##       streamed using server side cursors, then each gene set is written by the
+##       streaming BatchWriter as soon as it has been assembled. Large exports can
+##       be partitioned into shards which are written in parallel by worker
+##       processes, each using its own DB connection.
+## auth: TR
+#
+
+from __future__ import print_function
+from collections import defaultdict as dd
+from multiprocessing import Pool
+import gzip
+import json
+import os
+import threading
+
+from gwlib import db
+from gwlib.batch import BatchWriter
+
+## Ways gene sets can be partitioned into shards
+PARTITIONS = ('species', 'attribution', 'size')
+
+## DB connections inherited from the parent process. Workers hold on to these so
+## they're never garbage collected, since closing them would also close the
+## parent's connections.
+_inherited = []
+
+def _make_geneset(row, values, pmid, annotations):
+    """
+    Converts a geneset table row into the gene set object used by BatchWriter.
+
+    arguments
+        row:         geneset table row
+        values:      list of (reference, value) tuples
+        pmid:        the gene set's PMID or None
+        annotations: list of ontology term references
+
+    returns
+        a gene set object
+    """
+
+    gs = dict(row)
+
+    ## The PMID is given so the writer doesn't look up the publication ID
+    gs.pop('pub_id', None)
+
+    gs['pmid'] = pmid
+    gs['annotations'] = annotations
+    gs['geneset_values'] = values
+    gs['at_id'] = gs.get('gs_attribution')
+    gs['gs_groups'] = gs.get('gs_groups') or ''
+    gs['gs_threshold'] = gs.get('gs_threshold') or ''
+
+    return gs
+
+def iter_export_genesets(gs_ids, chunk_size=1000, itersize=100000):
+    """
+    Retrieves gene sets and their values, publications, and annotations from the
+    DB. Only a single chunk of gene set metadata is held in memory and values are
+    streamed, so any number of gene sets can be exported.
+
+    arguments
+        gs_ids:     a list of gs_ids
+        chunk_size: the number of gene sets retrieved at once
+        itersize:   the number of value rows fetched from the DB at once
+
+    returns
+        a generator of gene set objects sorted by gs_id. gs_ids that don't exist
+        are skipped.
+    """
+
+    gs_ids = sorted(set(gs_ids))
+
+    for i in range(0, len(gs_ids), chunk_size):
+        chunk = gs_ids[i:i + chunk_size]
+        rows = dict((row['gs_id'], row) for row in db.get_genesets(chunk))
+        pmids = db.get_geneset_pmids(chunk)
+        annotations = db.get_geneset_annotations(chunk)
+        values = db.iter_geneset_values(chunk, itersize=itersize)
+        value = next(values, None)
+
+        for gs_id in chunk:
+            gs_values = []
+
+            ## Values are sorted by gs_id so each set's values are consecutive
+            while value is not None and value[0] <= gs_id:
+                if value[0] == gs_id:
+                    gsv_value = value[3]
+
+                    ## Convert Decimal values to floats
+                    if gsv_value is not None:
+                        gsv_value = float(gsv_value)
+
+                    gs_values.append((value[2], gsv_value))
+
+                value = next(values, None)
+
+            if gs_id not in rows:
+                continue
+
+            yield _make_geneset(
+                rows[gs_id],
+                gs_values,
+                pmids.get(gs_id),
+                [ref for _, ref in annotations.get(gs_id, [])]
+            )
+
+def export_genesets(
+    gs_ids, out, is_dev=False, versioning='', chunk_size=1000, itersize=100000
+):
+    """
+    Exports gene sets from the DB into a batch file.
+
+    arguments
+        gs_ids:     a list of gs_ids
+        out:        a writable text, binary, or gzip file object
+        is_dev:     output tiers, attributions, and user IDs
+        versioning: optional version string added to the batch file header
+        chunk_size: the number of gene sets retrieved at once
+        itersize:   the number of value rows fetched from the DB at once
+
+    returns
+        a summary object containing the number of gene sets written (genesets)
+        and the errors for gene sets that couldn't be written (errors)
+    """
+
+    writer = BatchWriter(None, None, is_dev=is_dev)
+    count = writer.write(
+        out,
+        iter_export_genesets(gs_ids, chunk_size=chunk_size, itersize=itersize),
+        versioning
+    )
+
+    return {'genesets': count, 'errors': writer.errors}
+
+def partition_genesets(genesets, by='size', shards=8):
+    """
+    Partitions gene sets into shards.
+
+    arguments
+        genesets: a list of gene set objects containing gs_id, sp_id,
+                  gs_attribution, and gs_count (see db.get_geneset_partition_info)
+        by:       species and attribution create one shard per species or
+                  attribution. size creates the given number of shards with
+                  (roughly) equal numbers of gene set values.
+        shards:   the number of shards created when partitioning by size
+
+    returns
+        a list of shard objects sorted by their number of values, largest first.
+        Each object is a dict containing the shard number (shard), partition key
+        (key), sorted gs_ids, and total number of values (size).
+    """
+
+    if by not in PARTITIONS:
+        raise ValueError('Gene sets can only be partitioned by %s' % ', '.join(
+            PARTITIONS
+        ))
+
+    if by == 'size':
+        parts = [
+            {'key': i, 'gs_ids': [], 'size': 0} for i in range(max(shards, 1))
+        ]
+
+        ## Largest sets first, each going to the smallest shard
+        for gs in sorted(
+            genesets, key=lambda gs: (-(gs['gs_count'] or 0), gs['gs_id'])
+        ):
+            part = min(parts, key=lambda part: (part['size'], part['key']))
+
+            part['gs_ids'].append(gs['gs_id'])
+            part['size'] += gs['gs_count'] or 0
+
+        parts = [part for part in parts if part['gs_ids']]
+
+    else:
+        column = 'sp_id' if by == 'species' else 'gs_attribution'
+        groups = dd(lambda: {'gs_ids': [], 'size': 0})
+
+        for gs in genesets:
+            groups[gs[column]]['gs_ids'].append(gs['gs_id'])
+            groups[gs[column]]['size'] += gs['gs_count'] or 0
+
+        parts = []
+
+        for key, group in groups.items():
+            group['key'] = key
+
+            parts.append(group)
+
+    parts.sort(key=lambda part: (-part['size'], str(part['key'])))
+
+    for i, part in enumerate(parts):
+        part['shard'] = i
+        part['gs_ids'].sort()
+
+    return parts
+
+def _init_export_worker(connect_args):
+    """
+    Connects a worker process to the DB. Connections inherited from the parent are
+    replaced but kept alive.
+    """
+
+    _inherited.extend([db.conn, db.pool, getattr(db.local_conn, 'conn', None)])
+
+    db.local_conn = threading.local()
+    db.pool = None
+
+    db.connect(**connect_args)
+
+def _export_shard(args):
+    """
+    Exports a single shard to a batch file. This is used by the worker processes
+    so it must be a top level function.
+
+    arguments
+        args: a tuple containing the shard object, output filepath, and a dict of
+              export_genesets keyword arguments
+
+    returns
+        a shard summary, see export_genesets_parallel
+    """
+
+    shard, filepath, kwargs = args
+
+    try:
+        if filepath.endswith('.gz'):
+            with gzip.open(filepath, 'wb') as fl:
+                summary = export_genesets(shard['gs_ids'], fl, **kwargs)
+
+        else:
+            with open(filepath, 'w') as fl:
+                summary = export_genesets(shard['gs_ids'], fl, **kwargs)
+
+    finally:
+        ## Exports are read only
+        db.rollback()
+
+    summary['shard'] = shard['shard']
+    summary['key'] = shard['key']
+    summary['filepath'] = filepath
+
+    return summary
+
+def concatenate_shards(summaries, filepath, manifest=None):
+    """
+    Concatenates shard files into a single batch file and writes a manifest
+    containing the location of each shard within it. Compressed shards are
+    concatenated as-is, which produces a valid gzip file whose shards can also be
+    decompressed individually.
+
+    arguments
+        summaries: shard summaries, see export_genesets_parallel
+        filepath:  output filepath
+        manifest:  manifest filepath, defaults to the output filepath with a
+                   .manifest.json extension
+
+    returns
+        the manifest object. It contains the output filepath and a list of shards,
+        each containing the shard number, partition key, byte offset and length
+        within the output file, and number of gene sets.
+    """
+
+    manifest = manifest or filepath + '.manifest.json'
+    shards = []
+    offset = 0
+
+    with open(filepath, 'wb') as out:
+        for summary in sorted(summaries, key=lambda s: s['shard']):
+            length = 0
+
+            with open(summary['filepath'], 'rb') as fl:
+                while True:
+                    data = fl.read(1 << 20)
+
+                    if not data:
+                        break
+
+                    out.write(data)
+
+                    length += len(data)
+
+            shards.append({
+                'shard': summary['shard'],
+                'key': summary['key'],
+                'offset': offset,
+                'length': length,
+                'genesets': summary['genesets']
+            })
+
+            offset += length
+
+    contents = {'filepath': filepath, 'shards': shards}
+
+    with open(manifest, 'w') as fl:
+        json.dump(contents, fl, indent=2, sort_keys=True)
+
+    return contents
+
+def export_genesets_parallel(
+    gs_ids,
+    directory,
+    by='size',
+    shards=None,
+    processes=4,
+    compress=False,
+    filepath=None,
+    **kwargs
+):
+    """
+    Exports gene sets into batch files in parallel. Gene sets are partitioned into
+    shards (see partition_genesets) and each shard is written to its own file by a
+    worker process using its own DB connection. Shards are optionally concatenated
+    into a single file along with a manifest of shard offsets.
+    A DB connection (see db.connect) must be made before calling this, its
+    credentials are used by the workers.
+
+    arguments
+        gs_ids:    a list of gs_ids, e.g. from db.get_geneset_ids
+        directory: directory the shard files are written to
+        by:        how gene sets are partitioned: species, attribution, or size
+        shards:    the number of shards created when partitioning by size,
+                   defaults to the number of processes
+        processes: the number of worker processes
+        compress:  gzip the shard files
+        filepath:  if given, shards are concatenated into this file and removed
+        kwargs:    other export_genesets keyword arguments (is_dev, versioning,
+                   chunk_size, itersize)
+
+    returns
+        a list of shard summaries sorted by shard number. Each summary is a dict
+        containing the shard number (shard), partition key (key), shard filepath,
+        number of gene sets written (genesets), and errors. If shards were
+        concatenated, the manifest object is returned instead, with the shard
+        errors added to each of its shards.
+    """
+
+    connect_args = db.get_connect_args()
+
+    if connect_args is None:
+        raise ValueError('A DB connection is required to export gene sets')
+
+    parts = partition_genesets(
+        db.get_geneset_partition_info(gs_ids) if gs_ids else [],
+        by=by,
+        shards=shards or processes
+    )
+    ext = '.bgf.gz' if compress else '.bgf'
+    tasks = []
+
+    for part in parts:
+        shard_path = os.path.join(directory, 'shard-%04d%s' % (part['shard'], ext))
+
+        tasks.append((part, shard_path, kwargs))
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    pool = Pool(processes, _init_export_worker, (connect_args,))
+
+    try:
+        ## Shards are sorted largest first so the biggest start immediately
+        summaries = list(pool.imap_unordered(_export_shard, tasks))
+
+    finally:
+        pool.close()
+        pool.join()
+
+    summaries.sort(key=lambda s: s['shard'])
+
+    if not filepath:
+        return summaries
+
+    manifest = concatenate_shards(summaries, filepath)
+
+    for shard, summary in zip(manifest['shards'], summaries):
+        shard['errors'] = summary['errors']
+
+        os.remove(summary['filepath'])
+
+    return manifest
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: geneindex.py
+## desc: In-memory inverted gene -> gene set index. Each gene has a sorted posting
+##       list of the gene sets containing it, so the gene sets containing any or
+##       all of a list of genes are found by merging or intersecting posting lists
+##       instead of querying the geneset_value table.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+from bisect import bisect_left
+from bisect import insort
+from collections import defaultdict as dd
+from itertools import groupby
+
+from gwlib import db
+from gwlib.store import INT64
+
+def intersect_postings(postings):
+    """
+    Intersects sorted posting lists. The shortest list is used as the candidate
+    list and each candidate is binary searched in the other lists, starting where
+    the previous search ended, so the cost depends mostly on the shortest list.
+
+    arguments
+        postings: list of sorted sequences
+
+    returns
+        a list of the values found in every posting list
+    """
+
+    if not postings:
+        return []
+
+    postings = sorted(postings, key=len)
+    starts = [0] * len(postings)
+    found = []
+
+    for value in postings[0]:
+        for i in range(1, len(postings)):
+            starts[i] = bisect_left(postings[i], value, starts[i])
+
+            if starts[i] == len(postings[i]):
+                return found
+
+            if postings[i][starts[i]] != value:
+                break
+
+        else:
+            found.append(value)
+
+    return found
+
+class GeneIndex(object):
+    """
+    Inverted index of the gene sets containing each gene, along with the gene set
+    metadata used to filter results the same way db.get_geneset_ids does.
+
+    public
+        threshold: true if only genes whose values are in the gene set threshold
+                   were indexed
+        complete:  true if every normal gene set was indexed. Partial indexes
+                   aren't used by db.get_genesets_by_genes.
+    """
+
+    def __init__(self, threshold=False, complete=False):
+
+        self.threshold = threshold
+        self.complete = complete
+        ## ode_gene_id -> sorted gs_ids
+        self._postings = {}
+        ## gs_id -> (cur_id, sp_id, gs_attribution, gs_count)
+        self._genesets = {}
+
+    def __len__(self):
+        return len(self._genesets)
+
+    def __contains__(self, gs_id):
+        return gs_id in self._genesets
+
+    @property
+    def genes(self):
+        return len(self._postings)
+
+    def add_geneset(self, gs_id, genes, cur_id=None, sp_id=None, at_id=None,
+                    count=None):
+        """
+        Adds a gene set to the index. Gene sets are appended to the end of posting
+        lists when they're added in gs_id order.
+
+        arguments
+            gs_id:  gene set ID
+            genes:  list of ode_gene_ids
+            cur_id: curation tier
+            sp_id:  species identifier
+            at_id:  public resource attribution ID
+            count:  gene set size (gs_count)
+        """
+
+        if gs_id in self._genesets:
+            raise ValueError('Gene set %s is already in the index' % gs_id)
+
+        self._genesets[gs_id] = (cur_id, sp_id, at_id, count)
+
+        for ode in set(genes):
+            postings = self._postings.get(ode)
+
+            if postings is None:
+                self._postings[ode] = array(INT64, [gs_id])
+
+            elif postings[-1] < gs_id:
+                postings.append(gs_id)
+
+            else:
+                insort(postings, gs_id)
+
+    def get_genesets(self, ode_gene_id):
+        """
+        Returns the posting list for a gene.
+
+        arguments
+            ode_gene_id: gene ID
+
+        returns
+            a sorted sequence of gs_ids
+        """
+
+        return self._postings.get(ode_gene_id, ())
+
+    def __filter(self, tiers, at_id, size, sp_id):
+        """
+        Returns a function which tests if a gene set passes the get_geneset_ids
+        filters.
+        """
+
+        tiers = set(tiers)
+
+        def keep(gs_id):
+            cur_id, gs_sp_id, gs_at_id, count = self._genesets[gs_id]
+
+            if cur_id not in tiers:
+                return False
+
+            if at_id is not None and gs_at_id != at_id:
+                return False
+
+            if size > 0 and (count or 0) >= size:
+                return False
+
+            return sp_id <= 0 or gs_sp_id == sp_id
+
+        return keep
+
+    def find_genesets(
+        self,
+        genes,
+        min_overlap=1,
+        tiers=[1, 2, 3, 4, 5],
+        at_id=None,
+        size=0,
+        sp_id=0
+    ):
+        """
+        Finds the gene sets containing the given genes. When min_overlap equals
+        the number of genes the posting lists are intersected, otherwise the number
+        of genes in each set is counted.
+
+        arguments
+            genes:       a list of ode_gene_ids
+            min_overlap: the minimum number of genes a set must contain
+            tiers:       a list of curation tiers
+            at_id:       public resource attribution ID
+            size:        indicates the maximum size a set should be
+            sp_id:       species identifier
+
+        returns
+            a list of (gs_id, overlap) tuples sorted by overlap (largest first) and
+            gs_id, see db.get_genesets_by_genes
+        """
+
+        genes = set(genes)
+        postings = [self._postings[ode] for ode in genes if ode in self._postings]
+        keep = self.__filter(tiers, at_id, size, sp_id)
+
+        if min_overlap > len(postings):
+            return []
+
+        if min_overlap == len(genes):
+            return [
+                (gs_id, min_overlap)
+                for gs_id in intersect_postings(postings) if keep(gs_id)
+            ]
+
+        overlaps = dd(int)
+
+        for posting in postings:
+            for gs_id in posting:
+                overlaps[gs_id] += 1
+
+        found = [
+            (gs_id, overlap) for gs_id, overlap in overlaps.items()
+            if overlap >= min_overlap and keep(gs_id)
+        ]
+
+        found.sort(key=lambda t: (-t[1], t[0]))
+
+        return found
+
+def build_gene_index(gs_ids=None, threshold=False, itersize=100000):
+    """
+    Builds a gene index from the gene sets stored in the DB. The index is only
+    complete when every normal gene set is indexed.
+
+    arguments
+        gs_ids:    a list of gs_ids, if None every normal gene set is indexed
+        threshold: if true, only genes whose values are in the gene set threshold
+                   are indexed
+        itersize:  the number of rows fetched from the DB at once
+
+    returns
+        a GeneIndex
+    """
+
+    complete = gs_ids is None
+
+    if complete:
+        gs_ids = db.get_geneset_ids()
+
+    index = GeneIndex(threshold=threshold, complete=complete)
+
+    if not gs_ids:
+        return index
+
+    info = dict(
+        (gs['gs_id'], gs) for gs in db.get_geneset_partition_info(gs_ids)
+    )
+    rows = db.iter_geneset_value_rows(gs_ids, itersize=itersize)
+
+    for gs_id, gs_rows in groupby(rows, key=lambda row: row[0]):
+        gs = info.get(gs_id)
+
+        if gs is None:
+            continue
+
+        index.add_geneset(
+            gs_id,
+            [row[1] for row in gs_rows if row[3] or not threshold],
+            gs['cur_id'],
+            gs['sp_id'],
+            gs['gs_attribution'],
+            gs['gs_count']
+        )
+
+    return index
+
+def load_gene_index(threshold=False, itersize=100000):
+    """
+    Builds a gene index of every normal gene set and sets it as the index used by
+    db.get_genesets_by_genes. The index is a snapshot, it has to be rebuilt for
+    changes to the stored gene sets to be reflected in results.
+
+    arguments
+        threshold: if true, only genes whose values are in the gene set threshold
+                   are indexed
+        itersize:  the number of rows fetched from the DB at once
+
+    returns
+        the GeneIndex
+    """
+
+    index = build_gene_index(threshold=threshold, itersize=itersize)
+
+    db.set_gene_index(index)
+
+    return index
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: ingest.py
+## desc: Concurrent ingestion of many batch files. Files are parsed by a pool of
+##       processes, mapped to GW identifiers using reference data and caches shared
+##       by every file, and inserted by a pool of DB writer threads that each use
+##       their own pooled connection.
+## auth: TR
+#
+
+from __future__ import print_function
+from glob import glob
+from multiprocessing import Pool
+import os
+import threading
+
+try:
+    from Queue import Full, Queue
+except ImportError:
+    from queue import Full, Queue
+
+from gwlib import batch
+from gwlib import db
+
+def find_batch_files(path):
+    """
+    Returns the batch files found at the given path.
+
+    arguments
+        path: a directory, in which case every file in the directory is returned,
+              or a glob pattern
+
+    returns
+        a sorted list of filepaths
+    """
+
+    if os.path.isdir(path):
+        files = [os.path.join(path, fp) for fp in os.listdir(path)]
+    else:
+        files = glob(path)
+
+    return sorted(fp for fp in files if os.path.isfile(fp))
+
+def parse_batch_file_syntax(args):
+    """
+    Parses a single batch file without doing any of the gene identifier mapping.
+    This is used by the parsing processes so it must be a top level function.
+
+    arguments
+        args: a tuple containing the batch filepath and the reference data returned
+              by BatchReader.get_reference_data
+
+    returns
+        a tuple of the parsed gene sets, errors, and warnings
+    """
+
+    filepath, reference = args
+
+    with open(filepath, 'r') as fl:
+        lns = fl.read().split('\n')
+
+    return batch.parse_batch_chunk((reference, 0, [], lns))
+
+def write_genesets(queue, failures):
+    """
+    DB writer thread. Inserts the gene sets it receives from the queue using its own
+    pooled connection and commits each one. A None item stops the writer. The
+    writer also stops if it can't get a connection or roll back a failed insert, in
+    which case the exception is added to the failures list.
+
+    arguments
+        queue:    a queue of (summary, index, reader, gene set) tuples
+        failures: list of exceptions that stopped writers
+    """
+
+    try:
+        with db.PooledConnection():
+            while True:
+                item = queue.get()
+
+                if item is None:
+                    break
+
+                summary, index, reader, gs = item
+
+                try:
+                    gs_id = reader.insert_geneset(gs)
+
+                    db.commit()
+
+                except Exception as e:
+                    reader.errors.append(
+                        'Failed to insert the set %s: %s' % (gs['gs_name'], e)
+                    )
+
+                    db.rollback()
+
+                    continue
+
+                if gs_id is not None:
+                    summary['ids'].append((index, gs_id))
+
+    except Exception as e:
+        failures.append(e)
+
+def put_geneset(queue, item, threads):
+    """
+    Puts an item on the writer queue, blocking while the queue is full as long as
+    at least one of the writer threads is still running.
+
+    arguments
+        queue:   the writer queue
+        item:    queue item
+        threads: the writer threads
+
+    returns
+        False if every writer has stopped, True otherwise
+    """
+
+    while True:
+        try:
+            queue.put(item, timeout=0.1)
+
+            return True
+
+        except Full:
+            if not any(thread.is_alive() for thread in threads):
+                return False
+
+def ingest_batch_files(path, processes=4, writers=4, queue_size=100, pubmed=None):
+    """
+    Parses, maps, and inserts every batch file found at the given path. Files are
+    parsed concurrently and their gene sets are mapped to GW identifiers in this
+    process using reference data and identifier caches shared by all files. Mapped
+    gene sets are fed through a bounded queue to the DB writer threads. The DB
+    connection pool must be created (see db.connect_pool) before calling this and
+    needs at least writers + 1 connections.
+
+    Gene sets are committed individually, files with parsing errors are skipped
+    entirely. If every writer stops (see write_genesets) the first writer failure
+    is raised.
+
+    arguments
+        path:       a directory or glob pattern of batch files
+        processes:  the number of processes used to parse files
+        writers:    the number of DB writer threads
+        queue_size: the max number of gene sets waiting to be inserted
+        pubmed:     optional ncbi.PubMedClient used to retrieve publications for
+                    every file, see BatchReader
+
+    returns
+        a list of per-file summaries in file order. Each summary is a dict
+        containing the filepath, the list of inserted gs_ids (ids), and the errors
+        and warnings (warns) for the file.
+    """
+
+    files = find_batch_files(path)
+    summaries = []
+    queue = Queue(maxsize=queue_size)
+    threads = []
+    failures = []
+
+    for _ in range(writers):
+        thread = threading.Thread(target=write_genesets, args=(queue, failures))
+        thread.daemon = True
+        thread.start()
+
+        threads.append(thread)
+
+    pool = Pool(processes)
+
+    try:
+        with db.PooledConnection():
+
+            reader = batch.BatchReader(None, pubmed=pubmed)
+            reference = reader.get_reference_data()
+            results = pool.imap(
+                parse_batch_file_syntax, [(fp, reference) for fp in files]
+            )
+
+            for fp, (genesets, errors, warns) in zip(files, results):
+
+                ## Each reader shares the reference data and caches of the last
+                reader = batch.BatchReader(fp, shared=reader)
+                reader.genesets = genesets
+                reader.errors = errors
+                reader.warns = warns
+
+                summary = {
+                    'filepath': fp,
+                    'ids': [],
+                    'errors': reader.errors,
+                    'warns': reader.warns
+                }
+
+                summaries.append(summary)
+
+                if reader.errors:
+                    continue
+
+                reader.map_genesets()
+                reader.get_geneset_pubmeds()
+
+                ## Publications are shared by gene sets across files so they're
+                ## inserted and committed here, before the writers need them
+                reader.insert_geneset_publications()
+
+                db.commit()
+
+                for i, gs in enumerate(reader.genesets):
+                    if not put_geneset(queue, (summary, i, reader, gs), threads):
+                        raise failures[0]
+
+    finally:
+        pool.close()
+        pool.join()
+
+        for _ in threads:
+            if not put_geneset(queue, None, threads):
+                break
+
+        for thread in threads:
+            thread.join()
+
+    ## Writers finish in any order
+    for summary in summaries:
+        summary['ids'] = [gs_id for _, gs_id in sorted(summary['ids'])]
+
+    return summaries
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: journal.py
+## desc: Checkpoint journal for resumable batch uploads. Every committed gene set
+##       is recorded, along with its gs_id, as a single JSON line in a local file
+##       so a failed upload can be rerun and skip the sets that already made it
+##       into the DB.
+## auth: TR
+#
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+
+def geneset_key(gs, occurrence=0):
+    """
+    Generates a key identifying a parsed gene set. The key is based on the set's
+    abbreviation, name, and values rather than its position in the batch file, so
+    sets can be fixed, added, or removed from a file before it's uploaded again.
+    Files containing the same set more than once distinguish the copies by their
+    occurrence number (see geneset_keys).
+
+    arguments
+        gs:         parsed gene set object
+        occurrence: the number of identical sets preceding this one in the file
+
+    returns
+        a hex digest string
+    """
+
+    content = json.dumps([
+        gs.get('gs_abbreviation'),
+        gs.get('gs_name'),
+        [[str(ref), str(value)] for ref, value in gs.get('values', [])],
+        occurrence
+    ])
+
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def geneset_keys(genesets):
+    """
+    Generates the keys for every gene set in a batch file. Identical sets get
+    different keys based on the order they appear in.
+
+    arguments
+        genesets: list of parsed gene set objects in file order
+
+    returns
+        a list of keys, one for each gene set
+    """
+
+    occurrences = {}
+    keys = []
+
+    for gs in genesets:
+        key = geneset_key(gs)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+
+        keys.append(geneset_key(gs, occurrence) if occurrence else key)
+
+    return keys
+
+class BatchJournal(object):
+    """
+    A journal of committed gene sets. Entries are appended and synced to disk as
+    soon as they're recorded. Since the process may die while writing, a partially
+    written final line is ignored when the journal is loaded.
+
+    public
+        filepath:  journal filepath
+        completed: a mapping of gene set keys -> gs_ids
+    """
+
+    def __init__(self, filepath):
+        """
+        arguments
+            filepath: journal filepath, created if it doesn't exist
+        """
+
+        self.filepath = filepath
+        self.completed = {}
+        self._file = None
+        ## True if the last line was only partially written
+        self._partial = False
+
+        self.__load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __load(self):
+        """
+        Loads the entries from an existing journal.
+        """
+
+        if not os.path.exists(self.filepath):
+            return
+
+        with open(self.filepath, 'r') as fl:
+            lns = fl.read()
+
+        self._partial = bool(lns) and not lns.endswith('\n')
+
+        for ln in lns.split('\n'):
+            try:
+                entry = json.loads(ln)
+
+            except ValueError:
+                continue
+
+            self.completed[entry['key']] = entry['gs_id']
+
+    def get(self, key):
+        """
+        Returns the gs_id recorded for the given gene set key.
+
+        arguments
+            key: gene set key (see geneset_key)
+
+        returns
+            the gs_id or None if the set hasn't been committed
+        """
+
+        return self.completed.get(key)
+
+    def record(self, key, gs_id):
+        """
+        Records a committed gene set. This should only be called after the set has
+        been committed.
+
+        arguments
+            key:   gene set key (see geneset_key)
+            gs_id: gs_id of the committed set
+        """
+
+        if self._file is None:
+            self._file = open(self.filepath, 'a')
+
+            ## Start a new line so the partial one doesn't corrupt this entry
+            if self._partial:
+                self._file.write('\n')
+
+        self._file.write(json.dumps({'key': key, 'gs_id': gs_id}) + '\n')
+        self._file.flush()
+
+        os.fsync(self._file.fileno())
+
+        self.completed[key] = gs_id
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+
+        if self._file is not None:
+            self._file.close()
+
+            self._file = None
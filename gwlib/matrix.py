@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: matrix.py
+## desc: Sparse gene x gene set incidence matrices. Gene set values are streamed
+##       into compressed sparse column (CSC) arrays with ode_gene_ids and gs_ids
+##       re-indexed into dense row and column numbers. The arrays use the same
+##       layout as scipy.sparse so they can be handed to it directly.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+from itertools import groupby
+
+from gwlib import db
+from gwlib.store import GenesetStore
+from gwlib.store import INT64
+from gwlib.store import StoreWriter
+
+class GenesetMatrix(object):
+    """
+    Sparse gene x gene set matrix in CSC form; rows are genes and columns are gene
+    sets. Gene sets can be appended at any time and the CSR form (gene -> gene
+    sets) is built on demand.
+
+    public
+        genes:   list of ode_gene_ids, one per row
+        gs_ids:  list of gs_ids, one per column
+        indptr:  int64 array of column pointers, column j's entries are at
+                 indptr[j]:indptr[j + 1]
+        indices: int64 array of the row index of each entry, sorted within columns
+        values:  float32 array of the value of each entry or None if values
+                 aren't kept. Missing values are NaN.
+        mask:    byte array which is 1 for entries whose value is in the gene set
+                 threshold or None if thresholds aren't kept
+    """
+
+    def __init__(self, values=True, thresholds=False):
+        """
+        arguments
+            values:     if true, gene values are kept
+            thresholds: if true, gene threshold flags are kept
+        """
+
+        self.genes = []
+        self.gs_ids = []
+        self.indptr = array(INT64, [0])
+        self.indices = array(INT64)
+        self.values = array('f') if values else None
+        self.mask = array('B') if thresholds else None
+        self._rows = {}
+        self._columns = {}
+        self._csr = None
+
+    def __len__(self):
+        return len(self.gs_ids)
+
+    def __contains__(self, gs_id):
+        return gs_id in self._columns
+
+    @property
+    def shape(self):
+        return (len(self.genes), len(self.gs_ids))
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def get_row(self, ode_gene_id):
+        """
+        Returns a gene's row index or None if the gene isn't in the matrix.
+        """
+
+        return self._rows.get(ode_gene_id)
+
+    def get_column(self, gs_id):
+        """
+        Returns a gene set's column index or None if the set isn't in the matrix.
+        """
+
+        return self._columns.get(gs_id)
+
+    def append(self, gs_id, genes, values=None, thresholds=None):
+        """
+        Appends a gene set as a new column. Genes that aren't in the matrix yet are
+        given new rows.
+
+        arguments
+            gs_id:      gene set ID
+            genes:      list of ode_gene_ids
+            values:     list of gene values, in the same order as the genes
+            thresholds: list of booleans indicating if each gene's value is in
+                        the gene set threshold, in the same order as the genes
+        """
+
+        if gs_id in self._columns:
+            raise ValueError('Gene set %s is already in the matrix' % gs_id)
+
+        rows = []
+
+        for ode in genes:
+            if ode not in self._rows:
+                self._rows[ode] = len(self.genes)
+
+                self.genes.append(ode)
+
+            rows.append(self._rows[ode])
+
+        order = sorted(range(len(rows)), key=lambda i: rows[i])
+
+        self.indices.extend(rows[i] for i in order)
+
+        if self.values is not None:
+            values = values or [None] * len(rows)
+
+            self.values.extend(
+                float('nan') if values[i] is None else values[i] for i in order
+            )
+
+        if self.mask is not None:
+            thresholds = thresholds or [False] * len(rows)
+
+            self.mask.extend(1 if thresholds[i] else 0 for i in order)
+
+        self._columns[gs_id] = len(self.gs_ids)
+        self._csr = None
+
+        self.gs_ids.append(gs_id)
+        self.indptr.append(len(self.indices))
+
+    def extend(self, rows):
+        """
+        Appends gene sets from a stream of gene set values.
+
+        arguments
+            rows: iterable of (gs_id, ode_gene_id, gsv_value, gsv_in_threshold)
+                  tuples grouped by gs_id, e.g. from db.iter_geneset_value_rows
+
+        returns
+            the number of gene sets appended
+        """
+
+        count = 0
+
+        for gs_id, gs_rows in groupby(rows, key=lambda row: row[0]):
+            gs_rows = list(gs_rows)
+
+            self.append(
+                gs_id,
+                [row[1] for row in gs_rows],
+                [None if row[2] is None else float(row[2]) for row in gs_rows],
+                [row[3] for row in gs_rows]
+            )
+
+            count += 1
+
+        return count
+
+    def get_genes(self, gs_id):
+        """
+        Returns the genes in a gene set.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            a list of ode_gene_ids or None if the set isn't in the matrix
+        """
+
+        j = self._columns.get(gs_id)
+
+        if j is None:
+            return None
+
+        return [
+            self.genes[i] for i in self.indices[self.indptr[j]:self.indptr[j + 1]]
+        ]
+
+    def get_values(self, gs_id):
+        """
+        Returns the values of a gene set's genes.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            a list of values, in the same order as get_genes, or None if the set
+            isn't in the matrix or values aren't kept
+        """
+
+        j = self._columns.get(gs_id)
+
+        if j is None or self.values is None:
+            return None
+
+        return self.values[self.indptr[j]:self.indptr[j + 1]].tolist()
+
+    def to_csr(self):
+        """
+        Returns the matrix in compressed sparse row form. The result is cached
+        until another gene set is appended.
+
+        returns
+            a tuple of (indptr, indices, positions) arrays. Row i's entries are at
+            indptr[i]:indptr[i + 1], indices contains their column indices (sorted
+            within rows), and positions their position in the CSC arrays so
+            values and threshold flags can be looked up.
+        """
+
+        if self._csr is not None:
+            return self._csr
+
+        counts = [0] * (len(self.genes) + 1)
+
+        for i in self.indices:
+            counts[i + 1] += 1
+
+        for i in range(len(self.genes)):
+            counts[i + 1] += counts[i]
+
+        indptr = array(INT64, counts)
+        indices = array(INT64, [0]) * len(self.indices)
+        positions = array(INT64, [0]) * len(self.indices)
+        ## The next free slot in each row
+        slots = counts[:-1]
+
+        ## Columns are visited in order so columns are sorted within rows
+        for j in range(len(self.gs_ids)):
+            for k in range(self.indptr[j], self.indptr[j + 1]):
+                i = self.indices[k]
+
+                indices[slots[i]] = j
+                positions[slots[i]] = k
+                slots[i] += 1
+
+        self._csr = (indptr, indices, positions)
+
+        return self._csr
+
+    def get_genesets(self, ode_gene_id):
+        """
+        Returns the gene sets containing a gene.
+
+        arguments
+            ode_gene_id: gene ID
+
+        returns
+            a list of gs_ids in column order
+        """
+
+        i = self._rows.get(ode_gene_id)
+
+        if i is None:
+            return []
+
+        indptr, indices, _ = self.to_csr()
+
+        return [self.gs_ids[j] for j in indices[indptr[i]:indptr[i + 1]]]
+
+    def threshold_only(self):
+        """
+        Creates a matrix containing only the entries whose values are in their
+        gene set's threshold. Genes keep their row indices, so rows may be empty.
+
+        returns
+            a GenesetMatrix
+        """
+
+        if self.mask is None:
+            raise ValueError('The matrix doesn\'t contain threshold flags')
+
+        matrix = GenesetMatrix(values=self.values is not None, thresholds=True)
+        matrix.genes = list(self.genes)
+        matrix._rows = dict(self._rows)
+        matrix.gs_ids = list(self.gs_ids)
+        matrix._columns = dict(self._columns)
+
+        for j in range(len(self.gs_ids)):
+            for k in range(self.indptr[j], self.indptr[j + 1]):
+                if not self.mask[k]:
+                    continue
+
+                matrix.indices.append(self.indices[k])
+                matrix.mask.append(1)
+
+                if self.values is not None:
+                    matrix.values.append(self.values[k])
+
+            matrix.indptr.append(len(matrix.indices))
+
+        return matrix
+
+    def save(self, filepath):
+        """
+        Saves the matrix as a binary gene set store (see the store module).
+
+        arguments
+            filepath: store filepath
+        """
+
+        with StoreWriter(
+            filepath,
+            values=self.values is not None,
+            thresholds=self.mask is not None
+        ) as writer:
+            for j, gs_id in enumerate(self.gs_ids):
+                start = self.indptr[j]
+                end = self.indptr[j + 1]
+
+                writer.add(
+                    gs_id,
+                    [self.genes[i] for i in self.indices[start:end]],
+                    None if self.values is None else self.values[start:end],
+                    None if self.mask is None else self.mask[start:end]
+                )
+
+    @classmethod
+    def load(cls, filepath, gs_ids=None):
+        """
+        Loads a matrix from a binary gene set store.
+
+        arguments
+            filepath: store filepath
+            gs_ids:   optional list of gs_ids to load, by default every set in the
+                      store is loaded
+
+        returns
+            a GenesetMatrix
+        """
+
+        with GenesetStore(filepath) as store:
+            matrix = cls(values=store.has_values, thresholds=store.has_thresholds)
+
+            for gs_id in (store.gs_ids if gs_ids is None else gs_ids):
+                if gs_id not in store:
+                    continue
+
+                ## Views are copied so the store can be unmapped
+                values = store.get_values(gs_id)
+                values = None if values is None else list(values)
+                thresholds = store.get_thresholds(gs_id)
+                thresholds = None if thresholds is None else list(thresholds)
+
+                matrix.append(gs_id, store.get_genes(gs_id), values, thresholds)
+
+        return matrix
+
+def build_matrix(gs_ids=None, values=True, thresholds=False, itersize=100000):
+    """
+    Builds a gene x gene set matrix from gene set values stored in the DB.
+
+    arguments
+        gs_ids:     a list of gs_ids, if None every normal gene set is used
+        values:     if true, gene values are kept
+        thresholds: if true, gene threshold flags are kept
+        itersize:   the number of rows fetched from the DB at once
+
+    returns
+        a GenesetMatrix
+    """
+
+    matrix = GenesetMatrix(values=values, thresholds=thresholds)
+
+    matrix.extend(db.iter_geneset_value_rows(gs_ids, itersize=itersize))
+
+    return matrix
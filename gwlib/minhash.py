@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: minhash.py
+## desc: Approximate gene set similarity search. Gene sets are summarized by
+##       MinHash signatures which estimate their Jaccard similarity, and
+##       signatures are split into bands (locality sensitive hashing) so only
+##       gene sets sharing a band with the query are compared.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+from calendar import timegm
+from collections import defaultdict as dd
+from itertools import groupby
+import os
+import random
+import struct
+import tempfile
+import threading
+
+from gwlib import db
+from gwlib.store import INT64
+
+## File layout: header, then one record per gene set containing the gs_id, its
+## update time, and its signature, all little endian int64s
+MAGIC = b'GWMH'
+VERSION = 2
+HEADER = struct.Struct('<4sIIIqqB7x')
+
+## Mersenne prime used by the hash functions, h(x) = (a * x + b) mod PRIME
+PRIME = (1 << 61) - 1
+
+## Maximum number of genes whose hash values are cached
+CACHE_SIZE = 100000
+
+## Exact re-ranking compares this many times k of the best estimated candidates
+RERANK_FACTOR = 4
+
+## The index used by find_similar_genesets when one isn't given
+_index = None
+_lock = threading.Lock()
+
+def jaccard(a, b):
+    """
+    Calculates the Jaccard similarity of two gene sets.
+
+    arguments
+        a: set of ode_gene_ids
+        b: set of ode_gene_ids
+
+    returns
+        the similarity, 0 if both sets are empty
+    """
+
+    union = len(a | b)
+
+    return len(a & b) / float(union) if union else 0.0
+
+def _timestamp(date):
+    """
+    Converts a gene set's "last updated" date into microseconds since the epoch
+    so it can be saved with its signature. Missing dates are 0.
+    """
+
+    if date is None:
+        return 0
+
+    return timegm(date.utctimetuple()) * 1000000 + date.microsecond
+
+class MinHashIndex(object):
+    """
+    MinHash signatures for gene sets and LSH band buckets used to find candidate
+    similar sets. Two sets share at least one band with probability
+    1 - (1 - s^r)^b, where s is their similarity, b the number of bands, and r the
+    number of rows (hashes) per band.
+
+    public
+        num_perm:  the number of hash functions (signature length)
+        bands:     the number of LSH bands, must divide num_perm
+        seed:      random seed used to generate the hash functions
+        threshold: true if only genes whose values are in the gene set threshold
+                   were used
+    """
+
+    def __init__(self, num_perm=128, bands=32, seed=1, threshold=False):
+
+        if num_perm % bands:
+            raise ValueError('The number of bands must divide num_perm')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.seed = seed
+        self.threshold = threshold
+
+        self._rows = num_perm // bands
+        self._signatures = {}
+        ## gs_id -> update time of the gene set when it was signed
+        self._updated = {}
+        self._buckets = [dd(set) for _ in range(bands)]
+        self._cache = {}
+
+        rand = random.Random(seed)
+
+        self._params = [
+            (rand.randint(1, PRIME - 1), rand.randint(0, PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, gs_id):
+        return gs_id in self._signatures
+
+    @property
+    def gs_ids(self):
+        return sorted(self._signatures)
+
+    def __hash_gene(self, ode):
+        """
+        Returns the values of every hash function for a gene.
+        """
+
+        hashes = self._cache.get(ode)
+
+        if hashes is None:
+            hashes = array(INT64, [(a * ode + b) % PRIME for a, b in self._params])
+
+            if len(self._cache) < CACHE_SIZE:
+                self._cache[ode] = hashes
+
+        return hashes
+
+    def signature(self, genes):
+        """
+        Computes the MinHash signature of a gene set.
+
+        arguments
+            genes: list of ode_gene_ids
+
+        returns
+            an int64 array of num_perm minimum hash values. Empty sets have a
+            signature of PRIMEs.
+        """
+
+        hashes = [self.__hash_gene(ode) for ode in set(genes)]
+
+        if not hashes:
+            return array(INT64, [PRIME] * self.num_perm)
+
+        return array(INT64, [min(column) for column in zip(*hashes)])
+
+    def __band_keys(self, signature):
+
+        r = self._rows
+
+        return [
+            tuple(signature[i * r:(i + 1) * r]) for i in range(self.bands)
+        ]
+
+    def get_signature(self, gs_id):
+        """
+        Returns a gene set's signature or None if it isn't in the index.
+        """
+
+        return self._signatures.get(gs_id)
+
+    def get_updated(self, gs_id):
+        """
+        Returns the update time (see update_minhash_index) of a gene set when it
+        was added or None if it isn't in the index.
+        """
+
+        return self._updated.get(gs_id)
+
+    def add_signature(self, gs_id, signature, updated=0):
+        """
+        Adds or replaces a gene set's signature.
+
+        arguments
+            gs_id:     gene set ID
+            signature: MinHash signature, see signature
+            updated:   update time of the gene set in microseconds since the epoch
+        """
+
+        if len(signature) != self.num_perm:
+            raise ValueError('Signatures must contain %s hashes' % self.num_perm)
+
+        self.remove(gs_id)
+
+        self._signatures[gs_id] = signature
+        self._updated[gs_id] = updated
+
+        for bucket, key in zip(self._buckets, self.__band_keys(signature)):
+            bucket[key].add(gs_id)
+
+    def add(self, gs_id, genes, updated=0):
+        """
+        Adds or replaces a gene set.
+
+        arguments
+            gs_id:   gene set ID
+            genes:   list of ode_gene_ids
+            updated: update time of the gene set in microseconds since the epoch
+        """
+
+        self.add_signature(gs_id, self.signature(genes), updated)
+
+    def remove(self, gs_id):
+        """
+        Removes a gene set from the index.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            true if the gene set was in the index
+        """
+
+        signature = self._signatures.pop(gs_id, None)
+
+        if signature is None:
+            return False
+
+        del self._updated[gs_id]
+
+        for bucket, key in zip(self._buckets, self.__band_keys(signature)):
+            bucket[key].discard(gs_id)
+
+            if not bucket[key]:
+                del bucket[key]
+
+        return True
+
+    def estimate(self, a, b):
+        """
+        Estimates the Jaccard similarity of two gene sets from their signatures.
+
+        arguments
+            a: MinHash signature
+            b: MinHash signature
+
+        returns
+            the fraction of hash values the signatures share
+        """
+
+        ## Empty sets only match PRIMEs so they aren't similar to anything
+        return sum(
+            1 for x, y in zip(a, b) if x == y and x != PRIME
+        ) / float(self.num_perm)
+
+    def query(self, signature):
+        """
+        Finds the candidate similar gene sets for a signature.
+
+        arguments
+            signature: MinHash signature
+
+        returns
+            a set of gs_ids sharing at least one band with the signature
+        """
+
+        candidates = set()
+
+        for bucket, key in zip(self._buckets, self.__band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+
+        return candidates
+
+    def find_similar(self, signature, k=50, exclude=None):
+        """
+        Finds the gene sets with the highest estimated similarity to a
+        signature.
+
+        arguments
+            signature: MinHash signature
+            k:         the number of gene sets to return
+            exclude:   optional gs_id left out of the results, e.g. the query's
+
+        returns
+            a list of (gs_id, estimated similarity) tuples sorted by similarity
+            (highest first) and gs_id
+        """
+
+        found = []
+
+        for gs_id in self.query(signature):
+            if gs_id == exclude:
+                continue
+
+            similarity = self.estimate(signature, self._signatures[gs_id])
+
+            if similarity > 0:
+                found.append((gs_id, similarity))
+
+        found.sort(key=lambda t: (-t[1], t[0]))
+
+        return found[:k]
+
+    def save(self, filepath):
+        """
+        Saves the index. The file is written to a temp file and renamed so
+        readers never see a partially written index.
+
+        arguments
+            filepath: index filepath
+        """
+
+        directory = os.path.dirname(os.path.abspath(filepath))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        record = struct.Struct('<%dq' % (self.num_perm + 2))
+
+        try:
+            with os.fdopen(fd, 'wb') as fl:
+                fl.write(HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    self.num_perm,
+                    self.bands,
+                    self.seed,
+                    len(self._signatures),
+                    1 if self.threshold else 0
+                ))
+
+                for gs_id in self.gs_ids:
+                    fl.write(record.pack(
+                        gs_id, self._updated[gs_id], *self._signatures[gs_id]
+                    ))
+
+            os.rename(tmp, filepath)
+
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Loads a saved index.
+
+        arguments
+            filepath: index filepath
+
+        returns
+            a MinHashIndex
+        """
+
+        with open(filepath, 'rb') as fl:
+            try:
+                magic, version, num_perm, bands, seed, count, threshold =\
+                    HEADER.unpack(fl.read(HEADER.size))
+
+            except struct.error:
+                magic, version = None, None
+
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a MinHash index' % filepath)
+
+            index = cls(num_perm, bands, seed, bool(threshold))
+            record = struct.Struct('<%dq' % (num_perm + 2))
+
+            for _ in range(count):
+                values = record.unpack(fl.read(record.size))
+
+                index.add_signature(values[0], array(INT64, values[2:]), values[1])
+
+        return index
+
+def _iter_geneset_genes(gs_ids, threshold=False, itersize=100000):
+    """
+    Streams the genes of each gene set from the DB.
+
+    returns
+        a generator of (gs_id, set of ode_gene_ids) tuples sorted by gs_id
+    """
+
+    rows = db.iter_geneset_value_rows(gs_ids, itersize=itersize)
+
+    for gs_id, gs_rows in groupby(rows, key=lambda row: row[0]):
+        yield (gs_id, set(row[1] for row in gs_rows if row[3] or not threshold))
+
+def update_minhash_index(index, gs_ids=None, itersize=100000):
+    """
+    Incrementally updates an index with the gene sets stored in the DB. Gene sets
+    that aren't in the index are added, gene sets whose "last updated" date
+    changed since they were added (e.g. by BatchReader.update_geneset) are
+    re-signed, and gene sets that are no longer normal are removed. Gene sets
+    without values are added with empty signatures, which aren't similar to
+    anything.
+
+    arguments
+        index:    a MinHashIndex
+        gs_ids:   a list of gs_ids to add or re-sign, if None every normal gene set
+                  is used. Indexed gene sets missing from the list are kept.
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a summary object containing the number of gene sets added (added),
+        re-signed (updated), and removed (removed)
+    """
+
+    dates = dict(
+        (gs_id, _timestamp(date))
+        for gs_id, date in db.get_geneset_update_dates().items()
+    )
+
+    if gs_ids is None:
+        gs_ids = dates
+
+    removed = [gs_id for gs_id in index.gs_ids if gs_id not in dates]
+    missing = sorted(
+        gs_id for gs_id in set(gs_ids)
+        if gs_id in dates and index.get_updated(gs_id) != dates[gs_id]
+    )
+    added = sum(1 for gs_id in missing if gs_id not in index)
+
+    for gs_id in removed:
+        index.remove(gs_id)
+
+    signed = set()
+
+    if missing:
+        for gs_id, genes in _iter_geneset_genes(
+            missing, index.threshold, itersize
+        ):
+            index.add(gs_id, genes, dates[gs_id])
+
+            signed.add(gs_id)
+
+    ## Sets without values are added so they aren't retrieved on every update
+    for gs_id in missing:
+        if gs_id not in signed:
+            index.add(gs_id, [], dates[gs_id])
+
+    return {
+        'added': added,
+        'updated': len(missing) - added,
+        'removed': len(removed)
+    }
+
+def build_minhash_index(
+    gs_ids=None, num_perm=128, bands=32, seed=1, threshold=False, itersize=100000
+):
+    """
+    Builds a MinHash index from the gene sets stored in the DB.
+
+    arguments
+        gs_ids:    a list of gs_ids, if None every normal gene set is indexed
+        num_perm:  the number of hash functions (signature length)
+        bands:     the number of LSH bands, must divide num_perm
+        seed:      random seed used to generate the hash functions
+        threshold: if true, only genes whose values are in the gene set threshold
+                   are used
+        itersize:  the number of rows fetched from the DB at once
+
+    returns
+        a MinHashIndex
+    """
+
+    index = MinHashIndex(num_perm, bands, seed, threshold)
+
+    update_minhash_index(index, gs_ids, itersize)
+
+    return index
+
+def get_minhash_index():
+    """
+    Returns the index used by find_similar_genesets or None if one hasn't been
+    set.
+    """
+
+    with _lock:
+        return _index
+
+def set_minhash_index(index):
+    """
+    Sets the index used by find_similar_genesets.
+
+    arguments
+        index: a MinHashIndex, None removes the index
+    """
+
+    global _index
+
+    with _lock:
+        _index = index
+
+def find_similar_genesets(query, k=50, exact=False, index=None):
+    """
+    Finds the gene sets most similar to a gene set or list of genes.
+    Candidates are found using LSH and ranked by their estimated similarity. If
+    exact is true, the best RERANK_FACTOR * k candidates are re-ranked by their
+    exact Jaccard similarity using their genes from the DB.
+
+    arguments
+        query: a gs_id or a list of ode_gene_ids
+        k:     the number of gene sets to return
+        exact: if true, candidates are re-ranked by their exact similarity
+        index: MinHashIndex to search, defaults to the one set with
+               set_minhash_index
+
+    returns
+        a list of (gs_id, similarity) tuples sorted by similarity (highest first)
+        and gs_id. The query gene set isn't included.
+    """
+
+    ## Empty indexes are falsy
+    if index is None:
+        index = get_minhash_index()
+
+    if index is None:
+        raise ValueError('A MinHash index is required to find similar gene sets')
+
+    genes = None
+    exclude = None
+
+    if isinstance(query, (list, tuple, set, frozenset)):
+        genes = set(query)
+        signature = index.signature(genes)
+
+    else:
+        exclude = query
+        signature = index.get_signature(query)
+
+        if signature is None or exact:
+            genes = dict(_iter_geneset_genes([query], index.threshold)).get(
+                query, set()
+            )
+
+            if signature is None:
+                signature = index.signature(genes)
+
+    if not exact:
+        return index.find_similar(signature, k, exclude)
+
+    candidates = index.find_similar(signature, k * RERANK_FACTOR, exclude)
+
+    if not candidates:
+        return []
+
+    found = [
+        (gs_id, jaccard(genes, gs_genes))
+        for gs_id, gs_genes in _iter_geneset_genes(
+            [gs_id for gs_id, _ in candidates], index.threshold
+        )
+    ]
+
+    found.sort(key=lambda t: (-t[1], t[0]))
+
+    return found[:k]
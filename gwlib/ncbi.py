@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: ncbi.py
+## desc: NCBI E-utilities client for retrieving PubMed article metadata. PMIDs
+##       are retrieved in batches by concurrent requests (under a rate limit),
+##       failed requests are retried with exponential backoff, and articles can be
+##       cached on disk.
+## auth: TR
+#
+
+from __future__ import print_function
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import HTTPError, URLError, urlopen
+
+## Base URL for the E-utilities, can be pointed at a mirror or a stub server
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+
+## NCBI allows 3 requests/sec without an API key and 10 with one
+RATE_LIMIT = 3
+API_KEY_RATE_LIMIT = 10
+
+MONTHS = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov',
+    'Dec'
+)
+
+def parse_pubdate(pubdate):
+    """
+    Parses the year and month from an E-utilities publication date.
+
+    arguments
+        pubdate: date string, e.g. '2015 Dec 1', '2015 Winter', or '2015'
+
+    returns
+        a tuple of the year and month strings, either may be empty
+    """
+
+    year = ''
+    month = ''
+
+    for token in (pubdate or '').split():
+        if not year and len(token) == 4 and token.isdigit():
+            year = token
+
+        elif not month and token[:3] in MONTHS:
+            month = token[:3]
+
+    return (year, month)
+
+def parse_summaries(summary):
+    """
+    Parses an esummary JSON response into publication objects, without
+    abstracts.
+
+    arguments
+        summary: the decoded esummary JSON response
+
+    returns
+        a dict mapping PMIDs -> publication objects
+    """
+
+    articles = {}
+    result = summary.get('result', {})
+
+    for pmid in result.get('uids', []):
+
+        ## Key errors will indicate a crucial metadata component of the article
+        ## is missing. These articles are skipped.
+        try:
+            pub = result[pmid]
+            year, month = parse_pubdate(pub.get('pubdate', ''))
+
+            articles[pmid] = {
+                'pub_title': pub['title'],
+                'pub_abstract': '',
+                'pub_journal': pub['fulljournalname'],
+                'pub_volume': pub.get('volume', ''),
+                'pub_pages': pub.get('pages', ''),
+                'pub_month': month,
+                'pub_year': year,
+                'pub_pubmed': pmid,
+                'pub_authors': ','.join(auth['name'] for auth in pub['authors'])
+            }
+
+        except KeyError:
+            continue
+
+    return articles
+
+def parse_abstracts(xml):
+    """
+    Parses the abstracts from an efetch XML response. Structured abstracts are
+    joined into a single string, one labeled section per line.
+
+    arguments
+        xml: efetch XML response
+
+    returns
+        a dict mapping PMIDs -> abstracts
+    """
+
+    abstracts = {}
+
+    for article in ElementTree.fromstring(xml).iter('PubmedArticle'):
+        pmid = article.find('MedlineCitation/PMID')
+
+        if pmid is None:
+            continue
+
+        path = 'MedlineCitation/Article/Abstract/AbstractText'
+        sections = []
+
+        for section in article.findall(path):
+            text = ''.join(section.itertext()).strip()
+
+            if section.get('Label'):
+                text = '%s: %s' % (section.get('Label'), text)
+
+            sections.append(text)
+
+        abstracts[pmid.text.strip()] = '\n'.join(sections)
+
+    return abstracts
+
+class PubMedClient(object):
+    """
+    Retrieves PubMed article metadata using the E-utilities.
+
+    public
+        base_url:   E-utilities base URL
+        cache_dir:  directory used to cache articles, caching is disabled if None
+        batch_size: the max number of PMIDs retrieved by a single request
+        threads:    the number of concurrent requests
+        rate:       the max number of requests per second
+        retries:    the number of times a failed request is retried
+        backoff:    time (in seconds) to wait before the first retry, doubled after
+                    each subsequent failure
+        timeout:    request timeout in seconds
+        api_key:    optional NCBI API key
+    """
+
+    def __init__(
+        self,
+        base_url=EUTILS_URL,
+        cache_dir=None,
+        batch_size=200,
+        threads=3,
+        rate=None,
+        retries=5,
+        backoff=0.5,
+        timeout=30,
+        api_key=None
+    ):
+
+        self.base_url = base_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.threads = threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.api_key = api_key
+
+        if rate is None:
+            rate = API_KEY_RATE_LIMIT if api_key else RATE_LIMIT
+
+        self.rate = rate
+
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __wait(self):
+        """
+        Blocks until another request can be made without exceeding the rate
+        limit.
+        """
+
+        with self._lock:
+            now = time.time()
+            wait = self._next_request - now
+
+            self._next_request = max(now, self._next_request) + (1.0 / self.rate)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def __request(self, utility, params):
+        """
+        POSTs a request to one of the E-utilities, retrying failures with
+        exponential backoff.
+
+        arguments
+            utility: name of the E-utility, e.g. esummary
+            params:  dict of request parameters
+
+        returns
+            the response body or None if every attempt failed
+        """
+
+        if self.api_key:
+            params = dict(params, api_key=self.api_key)
+
+        url = '%s/%s.fcgi' % (self.base_url, utility)
+        data = urlencode(params).encode('utf-8')
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+
+            self.__wait()
+
+            try:
+                response = urlopen(url, data, self.timeout)
+
+                try:
+                    return response.read()
+
+                finally:
+                    response.close()
+
+            ## Sometimes the NCBI servers shit the bed, 4xx errors (other than
+            ## rate limiting) won't go away by retrying though
+            except HTTPError as e:
+                if 400 <= e.code < 500 and e.code != 429:
+                    return None
+
+            except (URLError, socket.error):
+                continue
+
+        return None
+
+    def __cache_path(self, pmid):
+        return os.path.join(self.cache_dir, '%s.json' % pmid)
+
+    def __read_cache(self, pmid):
+        """
+        Returns the cached article for the given PMID or None if it isn't cached.
+        """
+
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self.__cache_path(pmid), 'r') as fl:
+                return json.load(fl)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __write_cache(self, pmid, article):
+        """
+        Caches an article. The article is written to a temp file first so readers
+        never see a partially written article.
+        """
+
+        if not self.cache_dir:
+            return
+
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as fl:
+            json.dump(article, fl)
+
+        os.rename(tmp, self.__cache_path(pmid))
+
+    def __get_batch(self, pmids):
+        """
+        Retrieves the summaries and abstracts for a batch of PMIDs.
+
+        arguments
+            pmids: list of PMID strings
+
+        returns
+            a dict mapping PMIDs -> publication objects. Articles whose summary or
+            abstract couldn't be retrieved are missing.
+        """
+
+        ids = ','.join(pmids)
+        summary = self.__request(
+            'esummary', {'db': 'pubmed', 'retmode': 'json', 'id': ids}
+        )
+
+        if summary is None:
+            return {}
+
+        abstracts = self.__request(
+            'efetch', {'db': 'pubmed', 'retmode': 'xml', 'id': ids}
+        )
+
+        if abstracts is None:
+            return {}
+
+        try:
+            articles = parse_summaries(json.loads(summary.decode('utf-8')))
+            abstracts = parse_abstracts(abstracts)
+
+        except (ValueError, ElementTree.ParseError):
+            return {}
+
+        for pmid, article in articles.items():
+            article['pub_abstract'] = abstracts.get(pmid, '')
+
+            self.__write_cache(pmid, article)
+
+        return articles
+
+    def get_articles(self, pmids):
+        """
+        Retrieves article metadata for the given PMIDs. Cached articles are
+        returned without making any requests.
+
+        arguments
+            pmids: list of PMIDs
+
+        returns
+            a dict mapping PMID strings -> publication objects. Each object is a
+            dict where each key corresponds to a column in the publication table.
+            PMIDs that couldn't be retrieved are missing.
+        """
+
+        articles = {}
+        missing = []
+
+        for pmid in sorted(set(str(p).strip() for p in pmids if p)):
+            article = self.__read_cache(pmid)
+
+            if article is None:
+                missing.append(pmid)
+            else:
+                articles[pmid] = article
+
+        batches = [
+            missing[i:i + self.batch_size]
+            for i in range(0, len(missing), self.batch_size)
+        ]
+
+        if not batches:
+            return articles
+
+        pool = ThreadPool(min(self.threads, len(batches)))
+
+        try:
+            for batch in pool.map(self.__get_batch, batches):
+                articles.update(batch)
+
+        finally:
+            pool.close()
+            pool.join()
+
+        return articles
+
+def get_pubmed_articles(pmids, **kwargs):
+    """
+    Retrieves article metadata for the given PMIDs. See PubMedClient for the
+    keyword arguments.
+
+    arguments
+        pmids: list of PMIDs
+
+    returns
+        a dict mapping PMID strings -> publication objects
+    """
+
+    return PubMedClient(**kwargs).get_articles(pmids)
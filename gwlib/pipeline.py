@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: pipeline.py
+## desc: Staged batch file ingestion. Parsing, gene identifier mapping, and DB
+##       insertion each run in their own thread and are connected by bounded
+##       queues, so DB latency overlaps with parsing and only a fixed number of
+##       gene sets are held in memory at once.
+## auth: TR
+#
+
+from __future__ import print_function
+import threading
+import time
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+
+from gwlib import batch
+from gwlib import db
+
+## Marks the end of the items put on a stage's queue
+DONE = object()
+
+class StageStats(object):
+    """
+    Throughput and queue depth statistics for a single pipeline stage. The queue is
+    the stage's output queue, its depth is sampled every time the stage puts an
+    item on it.
+
+    public
+        name:     stage name
+        items:    the number of items processed by the stage
+        busy:     time (in seconds) spent processing items
+        started:  time the stage started
+        finished: time the stage finished
+    """
+
+    def __init__(self, name, queue=None):
+
+        self.name = name
+        self.queue = queue
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self._depth_max = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+
+    def sample_queue(self):
+        """
+        Records the current depth of the stage's output queue.
+        """
+
+        if self.queue is None:
+            return
+
+        depth = self.queue.qsize()
+
+        self._depth_max = max(self._depth_max, depth)
+        self._depth_total += depth
+        self._depth_samples += 1
+
+    def elapsed(self):
+        """
+        Returns the time (in seconds) the stage has been running.
+        """
+
+        if self.started is None:
+            return 0.0
+
+        if self.finished is None:
+            return time.time() - self.started
+
+        return self.finished - self.started
+
+    def to_dict(self):
+        """
+        Returns the stage statistics as a dict.
+
+        returns
+            a dict containing the stage name, items processed, elapsed and busy
+            time, throughput (items per second), and the current, max, and mean
+            depths of its output queue
+        """
+
+        elapsed = self.elapsed()
+
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'elapsed': elapsed,
+            'busy': self.busy,
+            'throughput': (self.items / elapsed) if elapsed else 0.0,
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'max_queue_depth': self._depth_max,
+            'mean_queue_depth': (
+                float(self._depth_total) / self._depth_samples
+                if self._depth_samples else 0.0
+            )
+        }
+
+class BatchPipeline(object):
+    """
+    Parses, maps, and inserts the gene sets in a batch file using three concurrent
+    stages connected by bounded queues:
+
+        parse  -> reads and parses the file incrementally (BatchReader.iter_batch_file)
+        map    -> maps gene identifiers, attributions, annotations, and publications
+        insert -> inserts each gene set into the DB
+
+    The map and insert stages each use their own pooled connection so the DB
+    connection pool must be created (see db.connect_pool) beforehand and needs at
+    least three connections.
+
+    Like BatchReader.parse_batch_file, a file with syntax errors isn't inserted.
+    Since sets are inserted before the whole file has been parsed, every insert
+    happens in a single transaction which is only committed once parsing finishes
+    without errors.
+
+    public
+        filepath:   batch filepath
+        reader:     the BatchReader used to map and insert gene sets
+        errors:     parsing, mapping, and insertion errors
+        warns:      parsing and mapping warnings
+        ids:        the gs_ids of the inserted gene sets
+        stats:      a list of StageStats for each stage
+    """
+
+    def __init__(
+        self, filepath, queue_size=100, chunk_size=10000, pub_batch=100, pubmed=None
+    ):
+        """
+        arguments
+            filepath:   batch filepath
+            queue_size: the max number of gene sets waiting between two stages
+            chunk_size: the number of lines the parse stage reads at once
+            pub_batch:  the number of gene sets whose publications are retrieved
+                        at once by the map stage
+            pubmed:     optional ncbi.PubMedClient used by the map stage, see
+                        BatchReader
+        """
+
+        self.filepath = filepath
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.pub_batch = pub_batch
+        self.errors = []
+        self.warns = []
+        self.ids = []
+
+        ## Parsing uses a separate reader so syntax errors can be distinguished
+        ## from errors produced while mapping and inserting
+        self._parser = batch.BatchReader(filepath, pubmed=pubmed)
+        self.reader = None
+
+        self._map_queue = Queue(maxsize=queue_size)
+        self._insert_queue = Queue(maxsize=queue_size)
+        self._abort = threading.Event()
+        self._failure = None
+
+        self.stats = [
+            StageStats('parse', self._map_queue),
+            StageStats('map', self._insert_queue),
+            StageStats('insert')
+        ]
+
+    def __put(self, queue, item, stats):
+        """
+        Puts an item on a stage queue, blocking while the queue is full unless the
+        pipeline has been aborted.
+
+        returns
+            False if the pipeline was aborted, True otherwise
+        """
+
+        while not self._abort.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                stats.sample_queue()
+
+                return True
+
+            except Full:
+                continue
+
+        return False
+
+    def __get(self, queue):
+        """
+        Gets an item from a stage queue, blocking while the queue is empty unless
+        the pipeline has been aborted.
+
+        returns
+            the item or DONE if the pipeline was aborted
+        """
+
+        while not self._abort.is_set():
+            try:
+                return queue.get(timeout=0.1)
+
+            except Empty:
+                continue
+
+        return DONE
+
+    def __run_stage(self, stats, stage):
+        """
+        Runs a stage function and aborts the entire pipeline if it fails.
+        """
+
+        stats.started = time.time()
+
+        try:
+            stage(stats)
+
+        except Exception as e:
+            if self._failure is None:
+                self._failure = e
+
+            self._abort.set()
+
+        finally:
+            stats.finished = time.time()
+
+    def __parse_stage(self, stats):
+        """
+        Parses the batch file and passes complete gene sets to the map stage. Once
+        a syntax error is found the remaining sets are still parsed, so every error
+        is reported, but they're no longer passed on.
+        """
+
+        start = time.time()
+
+        for gs in self._parser.iter_batch_file(self.chunk_size):
+            stats.busy += time.time() - start
+            stats.items += 1
+
+            if not self._parser.errors:
+                if not self.__put(self._map_queue, gs, stats):
+                    return
+
+            start = time.time()
+
+        stats.busy += time.time() - start
+
+        self.__put(self._map_queue, DONE, stats)
+
+    def __map_genesets(self, genesets, stats):
+        """
+        Maps a batch of gene sets and passes them to the insert stage.
+
+        returns
+            False if the pipeline was aborted, True otherwise
+        """
+
+        start = time.time()
+
+        for gs in genesets:
+            self.reader.map_geneset(gs)
+
+        self.reader.get_geneset_pubmeds(genesets)
+
+        stats.busy += time.time() - start
+        stats.items += len(genesets)
+
+        for gs in genesets:
+            if not self.__put(self._insert_queue, gs, stats):
+                return False
+
+        return True
+
+    def __map_stage(self, stats):
+        """
+        Maps gene sets received from the parse stage. Publications are retrieved
+        for pub_batch sets at a time.
+        """
+
+        genesets = []
+
+        with db.PooledConnection():
+            while True:
+                gs = self.__get(self._map_queue)
+
+                if gs is DONE:
+                    break
+
+                genesets.append(gs)
+
+                if len(genesets) >= self.pub_batch or self._map_queue.empty():
+                    if not self.__map_genesets(genesets, stats):
+                        return
+
+                    genesets = []
+
+            if genesets and not self.__map_genesets(genesets, stats):
+                return
+
+        self.__put(self._insert_queue, DONE, stats)
+
+    def __insert_stage(self, stats):
+        """
+        Inserts gene sets received from the map stage. Everything is committed
+        once the parse stage has finished without errors, otherwise the inserts are
+        rolled back.
+        """
+
+        ids = []
+
+        with db.PooledConnection():
+            while True:
+                gs = self.__get(self._insert_queue)
+
+                if gs is DONE:
+                    break
+
+                start = time.time()
+                gs_id = self.reader.insert_geneset(gs)
+
+                stats.busy += time.time() - start
+                stats.items += 1
+
+                if gs_id is not None:
+                    ids.append(gs_id)
+
+            if self._abort.is_set() or self._parser.errors:
+                db.rollback()
+                return
+
+            db.commit()
+
+        self.ids = ids
+
+    def get_stats(self):
+        """
+        Returns the statistics for each pipeline stage. This can be called while
+        the pipeline is running.
+
+        returns
+            a list of dicts, one for each stage (see StageStats.to_dict)
+        """
+
+        return [s.to_dict() for s in self.stats]
+
+    def run(self):
+        """
+        Runs the pipeline to completion.
+
+        returns
+            the list of inserted gs_ids. This is empty if the file contained any
+            syntax errors.
+        """
+
+        with db.PooledConnection():
+            self._parser.load_reference_data()
+
+        self.reader = batch.BatchReader(self.filepath, shared=self._parser)
+
+        stages = [self.__parse_stage, self.__map_stage, self.__insert_stage]
+        threads = []
+
+        for stats, stage in zip(self.stats, stages):
+            thread = threading.Thread(target=self.__run_stage, args=(stats, stage))
+            thread.daemon = True
+            thread.start()
+
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        self.errors = self._parser.errors + self.reader.errors
+        self.warns = self._parser.warns + self.reader.warns
+
+        if self._failure is not None:
+            raise self._failure
+
+        if self._parser.errors:
+            return []
+
+        return self.ids
+
+def run_batch_pipeline(filepath, queue_size=100, chunk_size=10000, pubmed=None):
+    """
+    Parses, maps, and inserts a batch file using a BatchPipeline.
+
+    arguments
+        filepath:   batch filepath
+        queue_size: the max number of gene sets waiting between two stages
+        chunk_size: the number of lines the parse stage reads at once
+        pubmed:     optional ncbi.PubMedClient used to retrieve publications
+
+    returns
+        a tuple of the inserted gs_ids, errors, warnings, and the per stage
+        statistics
+    """
+
+    pipeline = BatchPipeline(
+        filepath, queue_size=queue_size, chunk_size=chunk_size, pubmed=pubmed
+    )
+    ids = pipeline.run()
+
+    return (ids, pipeline.errors, pipeline.warns, pipeline.get_stats())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: probes.py
+## desc: Expression platform probe indexes. Maps the probe references for a
+##       platform to GW probe IDs and the genes each probe targets. Indexes are
+##       built from a single query, stored in compact arrays, and cached per
+##       platform so every gene set (and reader) using a platform shares one.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+import threading
+
+from gwlib import db
+
+## Platform indexes that have been loaded, pf_id -> PlatformIndex
+_indexes = {}
+_lock = threading.Lock()
+
+class PlatformIndex(object):
+    """
+    Probe reference -> probe ID -> gene mapping for a single expression platform.
+    Probe IDs and genes are stored in arrays; the genes targeted by the probe at
+    position i are genes[offsets[i]:offsets[i + 1]]. Indexes can be pickled so
+    they can be passed to other processes.
+
+    public
+        pf_id: platform ID
+    """
+
+    def __init__(self, pf_id, rows=()):
+        """
+        arguments
+            pf_id: platform ID
+            rows:  (prb_ref_id, prb_id, ode_gene_id) tuples sorted by prb_id. The
+                   gene is None for probes that don't target any genes.
+        """
+
+        self.pf_id = pf_id
+        self._positions = {}
+        self._prb_ids = array('l')
+        self._offsets = array('l', [0])
+        self._genes = array('l')
+
+        for prb_ref, prb_id, ode_gene_id in rows:
+
+            if not self._prb_ids or self._prb_ids[-1] != prb_id:
+                ## Probe references are supposed to be unique per platform, if
+                ## they aren't the first probe is kept
+                if prb_ref not in self._positions:
+                    self._positions[prb_ref] = len(self._prb_ids)
+
+                self._prb_ids.append(prb_id)
+                self._offsets.append(self._offsets[-1])
+
+            if ode_gene_id is not None:
+                self._genes.append(ode_gene_id)
+                self._offsets[-1] += 1
+
+    def __len__(self):
+        return len(self._prb_ids)
+
+    def __contains__(self, prb_ref):
+        return prb_ref in self._positions
+
+    def get_probe(self, prb_ref):
+        """
+        Returns the GW probe ID for the given probe reference.
+
+        arguments
+            prb_ref: probe reference
+
+        returns
+            the prb_id or None if the reference doesn't exist for this platform
+        """
+
+        i = self._positions.get(prb_ref)
+
+        return None if i is None else self._prb_ids[i]
+
+    def get_genes(self, prb_ref):
+        """
+        Returns the genes targeted by the probe with the given reference.
+
+        arguments
+            prb_ref: probe reference
+
+        returns
+            a list of ode_gene_ids, empty if the reference doesn't exist or
+            the probe doesn't target any genes
+        """
+
+        i = self._positions.get(prb_ref)
+
+        if i is None:
+            return []
+
+        return self._genes[self._offsets[i]:self._offsets[i + 1]].tolist()
+
+def load_platform_index(pf_id):
+    """
+    Builds the index for a platform from the DB. Use get_platform_index to reuse
+    indexes that have already been built.
+
+    arguments
+        pf_id: platform ID
+
+    returns
+        a PlatformIndex
+    """
+
+    return PlatformIndex(pf_id, db.get_platform_probe_genes(pf_id))
+
+def get_platform_index(pf_id):
+    """
+    Returns the cached index for a platform, building it if necessary.
+
+    arguments
+        pf_id: platform ID
+
+    returns
+        a PlatformIndex
+    """
+
+    with _lock:
+        if pf_id not in _indexes:
+            _indexes[pf_id] = load_platform_index(pf_id)
+
+        return _indexes[pf_id]
+
+def add_platform_index(index):
+    """
+    Adds an index built elsewhere (e.g. passed from another process) to the
+    cache.
+
+    arguments
+        index: PlatformIndex
+    """
+
+    with _lock:
+        _indexes[index.pf_id] = index
+
+def clear_platform_indexes():
+    """
+    Removes every index from the cache, e.g. after a platform has been modified.
+    """
+
+    with _lock:
+        _indexes.clear()
+
+def clear_platform_index(pf_id):
+    """
+    Removes a single platform's index from the cache, e.g. after its probes have
+    been imported (see db.import_platform).
+
+    arguments
+        pf_id: platform ID
+    """
+
+    with _lock:
+        _indexes.pop(pf_id, None)
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: store.py
+## desc: Compact binary gene set store. Gene set genes (and optionally values and
+##       threshold flags) are exported from the DB once into a single file which
+##       is memory-mapped by readers, so analyses can load the entire corpus
+##       without querying the DB.
+## auth: TR
+#
+
+from __future__ import print_function
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+import mmap
+import os
+import struct
+import tempfile
+
+from gwlib import db
+from gwlib import util
+
+## File layout, all numbers are little endian:
+##  header:     magic, version, flags, number of gene sets, total number of genes
+##  table:      four int64 columns sorted by gs_id: gs_ids, byte offsets of each
+##              set's genes, set sizes, and the index of each set's first value
+##  values:     float32 gene values (if FLAG_VALUES)
+##  thresholds: one byte per gene, 1 if the value is in the threshold
+##              (if FLAG_THRESHOLDS)
+##  genes:      each set's sorted ode_gene_ids, delta and varint encoded
+MAGIC = b'GWGS'
+VERSION = 1
+HEADER = struct.Struct('<4sIIqq4x')
+FLAG_VALUES = 1
+FLAG_THRESHOLDS = 2
+
+## Maximum number of bytes used to encode a single int64
+MAX_VARINT = 10
+
+## Typecode used for decoded ode_gene_ids, python 2 arrays don't support 'q'
+try:
+    array('q')
+    INT64 = 'q'
+except ValueError:
+    INT64 = 'l'
+
+def encode_varints(numbers):
+    """
+    Encodes a sorted list of non-negative integers as the varint encoded
+    differences between consecutive numbers.
+
+    arguments
+        numbers: sorted list of ints
+
+    returns
+        a bytearray
+    """
+
+    data = bytearray()
+    last = 0
+
+    for n in numbers:
+        delta = n - last
+        last = n
+
+        if delta < 0:
+            raise ValueError('Numbers must be sorted and non-negative')
+
+        while delta > 0x7f:
+            data.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+
+        data.append(delta)
+
+    return data
+
+def decode_varints(data, count=None):
+    """
+    Decodes numbers encoded by encode_varints.
+
+    arguments
+        data:  bytes-like object
+        count: the number of numbers to decode, by default all of them
+
+    returns
+        an int64 array
+    """
+
+    numbers = array(INT64)
+    last = 0
+    delta = 0
+    shift = 0
+
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+
+        if byte & 0x80:
+            shift += 7
+            continue
+
+        last += delta
+        numbers.append(last)
+
+        if len(numbers) == count:
+            break
+
+        delta = 0
+        shift = 0
+
+    return numbers
+
+class _TempColumn(object):
+    """
+    A temp file used to spool one region of the store while it's being written.
+    """
+
+    def __init__(self, directory):
+
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+
+        self.file.write(data)
+
+        self.size += len(data)
+
+    def close(self):
+
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+
+        self.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class StoreWriter(object):
+    """
+    Writes gene sets into a binary store. Gene set data is spooled into temp files
+    as it's added so only the gs_id table is kept in memory. The store is written
+    when the writer is closed, to a temp file which is then renamed so readers
+    never see a partially written store.
+
+    public
+        filepath:   store filepath
+        values:     if true, gene values are stored
+        thresholds: if true, gene threshold flags are stored
+    """
+
+    def __init__(self, filepath, values=True, thresholds=False):
+
+        self.filepath = filepath
+        self.values = values
+        self.thresholds = thresholds
+
+        self._directory = os.path.dirname(os.path.abspath(filepath))
+        self._gs_ids = array(INT64)
+        self._offsets = array(INT64)
+        self._sizes = array(INT64)
+        self._starts = array(INT64)
+        self._seen = set()
+        self._nvalues = 0
+        self._genes = _TempColumn(self._directory)
+        self._values = _TempColumn(self._directory)
+        self._thresholds = _TempColumn(self._directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self._gs_ids)
+
+    def add(self, gs_id, genes, values=None, thresholds=None):
+        """
+        Adds a gene set to the store.
+
+        arguments
+            gs_id:      gene set ID
+            genes:      list of ode_gene_ids
+            values:     list of gene values, in the same order as the genes.
+                        Missing values are stored as NaN.
+            thresholds: list of booleans indicating if each gene's value is in
+                        the gene set threshold, in the same order as the genes
+        """
+
+        if gs_id in self._seen:
+            raise ValueError('Gene set %s was already added' % gs_id)
+
+        self._seen.add(gs_id)
+
+        order = sorted(range(len(genes)), key=lambda i: genes[i])
+
+        self._gs_ids.append(gs_id)
+        self._offsets.append(self._genes.size)
+        self._sizes.append(len(genes))
+        self._starts.append(self._nvalues)
+
+        self._genes.write(encode_varints([genes[i] for i in order]))
+
+        if self.values:
+            values = values or [None] * len(genes)
+            values = [values[i] for i in order]
+
+            self._values.write(struct.pack(
+                '<%df' % len(values),
+                *[float('nan') if v is None else float(v) for v in values]
+            ))
+
+        if self.thresholds:
+            thresholds = thresholds or [False] * len(genes)
+
+            self._thresholds.write(
+                bytes(bytearray(1 if thresholds[i] else 0 for i in order))
+            )
+
+        self._nvalues += len(genes)
+
+    def abort(self):
+        """
+        Discards the store.
+        """
+
+        for column in (self._genes, self._values, self._thresholds):
+            column.remove()
+
+    def close(self):
+        """
+        Writes the store.
+
+        returns
+            the number of gene sets in the store
+        """
+
+        flags = 0
+
+        if self.values:
+            flags |= FLAG_VALUES
+
+        if self.thresholds:
+            flags |= FLAG_THRESHOLDS
+
+        count = len(self._gs_ids)
+        order = sorted(range(count), key=lambda i: self._gs_ids[i])
+        regions = [self._values] if self.values else []
+
+        if self.thresholds:
+            regions.append(self._thresholds)
+
+        ## Gene offsets are relative to the start of the genes region
+        base = HEADER.size + count * 32 + sum(r.size for r in regions)
+
+        try:
+            for column in (self._genes, self._values, self._thresholds):
+                column.close()
+
+            fd, tmp = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+
+            with os.fdopen(fd, 'wb') as fl:
+                fl.write(HEADER.pack(MAGIC, VERSION, flags, count, self._nvalues))
+
+                for column, shift in (
+                    (self._gs_ids, 0),
+                    (self._offsets, base),
+                    (self._sizes, 0),
+                    (self._starts, 0)
+                ):
+                    fl.write(struct.pack(
+                        '<%dq' % count, *[column[i] + shift for i in order]
+                    ))
+
+                for region in regions + [self._genes]:
+                    with open(region.path, 'rb') as rfl:
+                        while True:
+                            data = rfl.read(1 << 20)
+
+                            if not data:
+                                break
+
+                            fl.write(data)
+
+            os.rename(tmp, self.filepath)
+
+        finally:
+            self.abort()
+
+        return count
+
+def write_store(filepath, rows, values=True, thresholds=False):
+    """
+    Writes gene set values into a binary store.
+
+    arguments
+        filepath:   store filepath
+        rows:       iterable of (gs_id, ode_gene_id, gsv_value, gsv_in_threshold)
+                    tuples grouped by gs_id
+        values:     if true, gene values are stored
+        thresholds: if true, gene threshold flags are stored
+
+    returns
+        the number of gene sets in the store
+    """
+
+    with StoreWriter(filepath, values, thresholds) as writer:
+        for gs_id, gs_rows in groupby(rows, key=lambda row: row[0]):
+            gs_rows = list(gs_rows)
+
+            writer.add(
+                gs_id,
+                [row[1] for row in gs_rows],
+                [row[2] for row in gs_rows],
+                [row[3] for row in gs_rows]
+            )
+
+    return len(writer)
+
+def export_store(filepath, gs_ids=None, values=True, thresholds=False,
+                 itersize=100000):
+    """
+    Exports gene sets from the DB into a binary store.
+
+    arguments
+        filepath:   store filepath
+        gs_ids:     a list of gs_ids, if None every normal gene set is exported
+        values:     if true, gene values are stored
+        thresholds: if true, gene threshold flags are stored
+        itersize:   the number of rows fetched from the DB at once
+
+    returns
+        the number of gene sets in the store
+    """
+
+    return write_store(
+        filepath,
+        db.iter_geneset_value_rows(gs_ids, itersize=itersize),
+        values,
+        thresholds
+    )
+
+class GenesetStore(object):
+    """
+    Memory-mapped reader for binary gene set stores. Values and threshold flags
+    are returned as zero-copy views of the mapped file; genes are decoded from
+    their compressed form on access.
+
+    public
+        filepath: store filepath
+        gs_ids:   sorted sequence of the gs_ids in the store
+    """
+
+    def __init__(self, filepath):
+
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._map = None
+        self._views = []
+
+        try:
+            magic, version, flags, count, nvalues = HEADER.unpack(
+                self._file.read(HEADER.size)
+            )
+
+        except struct.error:
+            magic, version = None, None
+
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+
+            raise ValueError('%s is not a gene set store' % filepath)
+
+        self._flags = flags
+        self._count = count
+        self.gs_ids = ()
+        self._values = None
+        self._thresholds = None
+
+        if not count:
+            return
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = HEADER.size
+        columns = []
+
+        for _ in range(4):
+            columns.append(util.map_array(self._map, offset, count, 'q'))
+
+            offset += count * 8
+
+        self.gs_ids, self._offsets, self._sizes, self._starts = columns
+        self._views = list(columns)
+
+        if flags & FLAG_VALUES:
+            self._values = util.map_array(self._map, offset, nvalues, 'f')
+
+            self._views.append(self._values)
+
+            offset += nvalues * 4
+
+        if flags & FLAG_THRESHOLDS:
+            self._thresholds = util.map_array(self._map, offset, nvalues, 'B')
+
+            self._views.append(self._thresholds)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, gs_id):
+        return self.__find(gs_id) is not None
+
+    def __iter__(self):
+        return iter(self.gs_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def has_values(self):
+        return bool(self._flags & FLAG_VALUES)
+
+    @property
+    def has_thresholds(self):
+        return bool(self._flags & FLAG_THRESHOLDS)
+
+    def close(self):
+        """
+        Unmaps and closes the store. Views returned by the store can't be used
+        afterwards.
+        """
+
+        for view in self._views:
+            if isinstance(view, memoryview):
+                view.release()
+
+        self._views = []
+        self.gs_ids = ()
+        self._values = None
+        self._thresholds = None
+
+        if self._map is not None:
+            ## Fails if views are still being used elsewhere, the map is then
+            ## closed when it's garbage collected
+            try:
+                self._map.close()
+
+            except BufferError:
+                pass
+
+            self._map = None
+
+        self._file.close()
+
+    def __find(self, gs_id):
+        """
+        Returns the table position of a gene set or None if it isn't stored.
+        """
+
+        i = bisect_left(self.gs_ids, gs_id)
+
+        if i < self._count and self.gs_ids[i] == gs_id:
+            return i
+
+        return None
+
+    def get_size(self, gs_id):
+        """
+        Returns the number of genes in a gene set or None if it isn't stored.
+        """
+
+        i = self.__find(gs_id)
+
+        return None if i is None else self._sizes[i]
+
+    def get_genes(self, gs_id):
+        """
+        Returns a gene set's genes.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            a sorted int64 array of ode_gene_ids or None if the set isn't stored
+        """
+
+        i = self.__find(gs_id)
+
+        if i is None:
+            return None
+
+        ## Sets aren't stored in gs_id order so only an upper bound on the length
+        ## of the encoded genes is known
+        size = self._sizes[i]
+        start = self._offsets[i]
+        end = min(start + size * MAX_VARINT, len(self._map))
+
+        return decode_varints(self._map[start:end], size)
+
+    def __get_region(self, region, gs_id):
+
+        i = self.__find(gs_id)
+
+        if i is None or region is None:
+            return None
+
+        return region[self._starts[i]:self._starts[i] + self._sizes[i]]
+
+    def get_values(self, gs_id):
+        """
+        Returns a gene set's values.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            a float32 view of the values, in the same order as get_genes, or None
+            if the set isn't stored or the store doesn't contain values
+        """
+
+        return self.__get_region(self._values, gs_id)
+
+    def get_thresholds(self, gs_id):
+        """
+        Returns a gene set's threshold flags.
+
+        arguments
+            gs_id: gene set ID
+
+        returns
+            a view of one byte per gene, in the same order as get_genes, which is
+            1 if the gene's value is in the threshold. None if the set isn't stored
+            or the store doesn't contain thresholds.
+        """
+
+        return self.__get_region(self._thresholds, gs_id)
+
+    def iter_genesets(self):
+        """
+        Iterates over every gene set in the store.
+
+        returns
+            a generator of (gs_id, genes, values, thresholds) tuples sorted by
+            gs_id. values and thresholds are None if they aren't stored.
+        """
+
+        for gs_id in self.gs_ids:
+            yield (
+                gs_id,
+                self.get_genes(gs_id),
+                self.get_values(gs_id),
+                self.get_thresholds(gs_id)
+            )
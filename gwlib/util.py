@@ -9,7 +9,9 @@ from sys import argv
 import datetime as dt
 import json
 import os
+import struct
 import subprocess
+import sys
 
 def chunk_list(l, n):
     """
@@ -29,6 +31,65 @@ def chunk_list(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+class PackedArray(object):
+    """
+    Read only sequence of little endian numbers stored in a buffer (e.g. a
+    memory-mapped file). Used by map_array when memoryview casting isn't available
+    (python 2) or the host is big endian.
+    """
+
+    def __init__(self, buf, offset, length, typecode):
+
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+        self._format = '<' + typecode
+        self._size = struct.calcsize(self._format)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._length))]
+
+        if i < 0:
+            i += self._length
+
+        if i < 0 or i >= self._length:
+            raise IndexError('index out of range')
+
+        return struct.unpack_from(
+            self._format, self._buf, self._offset + i * self._size
+        )[0]
+
+    def tolist(self):
+        return self[:]
+
+def map_array(buf, offset, length, typecode):
+    """
+    Returns a read only, zero-copy sequence of little endian numbers stored in a
+    buffer.
+
+    arguments
+        buf:      a buffer, e.g. an mmap object
+        offset:   byte offset of the first number
+        length:   the number of numbers in the sequence
+        typecode: struct/array type code of the numbers, e.g. q (int64) or f
+                  (float32)
+
+    returns
+        a memoryview or PackedArray
+    """
+
+    if sys.version_info[0] >= 3 and sys.byteorder == 'little':
+        size = struct.calcsize(typecode)
+
+        return memoryview(buf)[offset:offset + length * size].cast(typecode)
+
+    return PackedArray(buf, offset, length, typecode)
+
 def flatten(outlist):
     """
     Flattens a list of lists into a single list.
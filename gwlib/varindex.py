@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: varindex.py
+## desc: Local, memory-mapped variant indexes. The rsID -> var_id -> ode_gene_id
+##       mapping for a genome build is exported once into a file of sorted int64
+##       arrays, and bulk rsID lookups are resolved against the mapped file
+##       instead of joining the variant tables on every request.
+## auth: TR
+#
+
+from __future__ import print_function
+from bisect import bisect_left
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from gwlib import db
+from gwlib import util
+
+## File layout: header, then five little endian int64 arrays.
+##  refs:     rsIDs, sorted
+##  var_ids:  GW variant IDs, one per rsID
+##  odes:     variant ode_gene_ids, one per rsID, MISSING if there isn't one
+##  ode_keys: variant ode_gene_ids, sorted
+##  ode_refs: rsIDs, one per ode_gene_id
+MAGIC = b'GWVI'
+VERSION = 1
+HEADER = struct.Struct('<4sIqq')
+MISSING = -1
+
+## The number of values packed and written at once during exports
+WRITE_SIZE = 65536
+
+## Variant indexes that have been registered, genome build -> VariantIndex
+_indexes = {}
+_lock = threading.Lock()
+
+def normalize_rsid(ref):
+    """
+    Converts a reference SNP identifier into the integer form stored by GW.
+
+    arguments
+        ref: rsID, e.g. 'rs123', '123', or 123
+
+    returns
+        the rsID as an int or None if it isn't a valid rsID
+    """
+
+    ref = str(ref).strip()
+
+    if ref[:2].lower() == 'rs':
+        ref = ref[2:]
+
+    try:
+        return int(ref)
+
+    except ValueError:
+        return None
+
+class _ColumnWriter(object):
+    """
+    Buffers int64 values and writes them to a temp file in chunks.
+    """
+
+    def __init__(self, directory):
+
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        self.file = os.fdopen(fd, 'wb')
+        self.buffer = []
+
+    def append(self, value):
+
+        self.buffer.append(value)
+
+        if len(self.buffer) >= WRITE_SIZE:
+            self.flush()
+
+    def flush(self):
+
+        if self.buffer:
+            self.file.write(
+                struct.pack('<%dq' % len(self.buffer), *self.buffer)
+            )
+
+            self.buffer = []
+
+    def close(self):
+
+        self.flush()
+        self.file.close()
+
+def write_variant_index(filepath, variants, odes):
+    """
+    Writes a variant index file. Rows are streamed into temporary per-array files
+    which are then concatenated, so memory use doesn't depend on the number of
+    variants. The index is written to a temp file and renamed so readers never see
+    a partially written index.
+
+    arguments
+        filepath: index filepath
+        variants: iterable of (rsID, var_id, ode_gene_id) tuples sorted by rsID. The
+                  ode_gene_id is None for variants that don't have one.
+        odes:     iterable of (ode_gene_id, rsID) tuples sorted by ode_gene_id
+
+    returns
+        a tuple containing the number of rsIDs and ode_gene_ids in the index
+    """
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    columns = [_ColumnWriter(directory) for _ in range(5)]
+    refs, var_ids, var_odes, ode_keys, ode_refs = columns
+    nrefs = 0
+    nodes = 0
+
+    try:
+        last = None
+
+        for ref, var_id, ode in variants:
+            if last is not None and ref < last:
+                raise ValueError('Variants must be sorted by rsID')
+
+            refs.append(ref)
+            var_ids.append(var_id)
+            var_odes.append(MISSING if ode is None else ode)
+
+            last = ref
+            nrefs += 1
+
+        last = None
+
+        for ode, ref in odes:
+            if last is not None and ode < last:
+                raise ValueError('Variant genes must be sorted by ode_gene_id')
+
+            ode_keys.append(ode)
+            ode_refs.append(ref)
+
+            last = ode
+            nodes += 1
+
+        for column in columns:
+            column.close()
+
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'wb') as fl:
+            fl.write(HEADER.pack(MAGIC, VERSION, nrefs, nodes))
+
+            for column in columns:
+                with open(column.path, 'rb') as cfl:
+                    while True:
+                        data = cfl.read(WRITE_SIZE * 8)
+
+                        if not data:
+                            break
+
+                        fl.write(data)
+
+        os.rename(tmp, filepath)
+
+    finally:
+        for column in columns:
+            if not column.file.closed:
+                column.file.close()
+
+            os.remove(column.path)
+
+    return (nrefs, nodes)
+
+def export_variant_index(build, filepath, itersize=100000):
+    """
+    Exports the rsID -> var_id -> ode_gene_id mapping for a genome build from the
+    DB into a variant index file.
+
+    arguments
+        build:    genome build reference, e.g. hg38
+        filepath: index filepath
+        itersize: the number of rows fetched from the DB at once
+
+    returns
+        a tuple containing the number of rsIDs and ode_gene_ids in the index
+    """
+
+    return write_variant_index(
+        filepath,
+        db.iter_variant_genes(build, itersize=itersize),
+        db.iter_variant_gene_refs(build, itersize=itersize)
+    )
+
+def _search(keys, queries):
+    """
+    Finds the position of each query in a sorted array. Queries are sorted first
+    so each binary search starts where the previous one ended, which shrinks the
+    search space and keeps accesses to the mapped file moving forward.
+
+    arguments
+        keys:    sorted sequence
+        queries: iterable of values
+
+    returns
+        a list of (query, position) tuples for the queries found in the array.
+        If a query occurs more than once in the array the first position is used.
+    """
+
+    found = []
+    lo = 0
+    hi = len(keys)
+
+    for query in sorted(set(queries)):
+        lo = bisect_left(keys, query, lo, hi)
+
+        if lo == hi:
+            break
+
+        if keys[lo] == query:
+            found.append((query, lo))
+
+    return found
+
+class VariantIndex(object):
+    """
+    Memory-mapped variant index for a single genome build. Lookups return the same
+    mappings as the corresponding db functions (get_variants_by_refs,
+    get_variant_odes_by_refs, and get_variant_refs_by_odes).
+
+    public
+        filepath: index filepath
+    """
+
+    def __init__(self, filepath):
+        """
+        arguments
+            filepath: index filepath, see write_variant_index
+        """
+
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._map = None
+        self._arrays = [()] * 5
+
+        try:
+            magic, version, nrefs, nodes = HEADER.unpack(
+                self._file.read(HEADER.size)
+            )
+
+        except struct.error:
+            magic, version = None, None
+
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+
+            raise ValueError('%s is not a variant index' % filepath)
+
+        self._nrefs = nrefs
+        self._nodes = nodes
+
+        ## Empty files can't be mapped
+        if not nrefs and not nodes:
+            return
+
+        self._map = mmap.mmap(
+            self._file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+
+        offset = HEADER.size
+        arrays = []
+
+        for length in (nrefs, nrefs, nrefs, nodes, nodes):
+            arrays.append(util.map_array(self._map, offset, length, 'q'))
+
+            offset += length * 8
+
+        self._arrays = arrays
+
+    def __len__(self):
+        return self._nrefs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps and closes the index file.
+        """
+
+        ## Casted memoryviews must be released before the map can be closed
+        for array in self._arrays:
+            if isinstance(array, memoryview):
+                array.release()
+
+        self._arrays = [()] * 5
+
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
+
+    def __lookup_refs(self, refs, values):
+        """
+        Maps rsIDs to the values stored in one of the per-rsID arrays.
+        """
+
+        refs = [normalize_rsid(ref) for ref in refs]
+        refs = [ref for ref in refs if ref is not None]
+
+        return dict((ref, values[i]) for ref, i in _search(self._arrays[0], refs))
+
+    def get_variants(self, refs):
+        """
+        Maps rsIDs to GW variant IDs.
+
+        arguments
+            refs: a list of reference SNP identifiers
+
+        returns
+            a mapping of rsIDs (as ints) to var_ids
+        """
+
+        return self.__lookup_refs(refs, self._arrays[1])
+
+    def get_variant_odes(self, refs):
+        """
+        Maps rsIDs to variant gene IDs (ode_gene_id).
+
+        arguments
+            refs: a list of reference SNP identifiers
+
+        returns
+            a mapping of rsIDs (as ints) to ode_gene_ids. rsIDs without variant
+            genes are missing.
+        """
+
+        odes = self.__lookup_refs(refs, self._arrays[2])
+
+        return dict((ref, ode) for ref, ode in odes.items() if ode != MISSING)
+
+    def get_variant_refs(self, odes):
+        """
+        Maps variant gene IDs (ode_gene_id) to rsIDs.
+
+        arguments
+            odes: ode_gene_id list
+
+        returns
+            a mapping of ode_gene_ids to rsIDs (as ints)
+        """
+
+        refs = self._arrays[4]
+
+        return dict(
+            (ode, refs[i]) for ode, i in _search(self._arrays[3], odes)
+        )
+
+def get_variant_index(build):
+    """
+    Returns the index registered for a genome build.
+
+    arguments
+        build: genome build reference, e.g. hg38
+
+    returns
+        a VariantIndex or None if one hasn't been registered for the build
+    """
+
+    with _lock:
+        return _indexes.get(build)
+
+def add_variant_index(build, filepath):
+    """
+    Opens a variant index and registers it for the given genome build. Once
+    registered, batch uploads for the build are mapped using the index instead of
+    the DB.
+
+    arguments
+        build:    genome build reference, e.g. hg38
+        filepath: index filepath
+
+    returns
+        the VariantIndex
+    """
+
+    index = VariantIndex(filepath)
+
+    with _lock:
+        if build in _indexes:
+            _indexes[build].close()
+
+        _indexes[build] = index
+
+    return index
+
+def clear_variant_indexes():
+    """
+    Closes and unregisters every index.
+    """
+
+    with _lock:
+        for index in _indexes.values():
+            index.close()
+
+        _indexes.clear()
@@ -111,11 +111,30 @@ CREATE TABLE extsrc.probe2gene (
 );
 
 CREATE TABLE odestatic.probe (
-    prb_id      BIGINT NOT NULL,
+    prb_id      BIGSERIAL NOT NULL,
     prb_ref_id  VARCHAR,
     pf_id       INTEGER NOT NULL
 );
 
+CREATE TABLE extsrc.variant_info (
+    vri_id          BIGSERIAL NOT NULL,
+    vri_chromosome  VARCHAR,
+    vri_position    BIGINT,
+    gb_id           INTEGER
+);
+
+CREATE TABLE extsrc.variant (
+    var_id          BIGSERIAL NOT NULL,
+    var_ref_id      BIGINT,
+    var_allele      VARCHAR,
+    var_obs_alleles VARCHAR,
+    var_ma          VARCHAR,
+    var_maf         NUMERIC,
+    vt_id           INTEGER,
+    var_clinsig     VARCHAR,
+    vri_id          BIGINT
+);
+
 INSERT INTO odestatic.species (sp_name, sp_taxid) 
 VALUES      ('Mus musculus', 10090), 
             ('Homo sapiens', 9606),
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_algebra.py
+## desc: Unit tests for algebra.py. DB queries are replaced with canned results.
+## auth: TR
+
+import io
+
+import pytest
+
+from gwlib import algebra
+from gwlib import db
+from gwlib import store
+
+## gs_id -> (sp_id, [(ode_gene_id, gsv_in_threshold)])
+GENESETS = {
+    1: (1, [(10, True), (20, True), (30, False)]),
+    2: (1, [(20, True), (40, True)]),
+    3: (1, [(30, True), (40, False), (50, True)]),
+    4: (2, [(100, True), (200, True), (300, True)])
+}
+
+## Mouse (1) and human (2) genes sharing homology IDs
+HOMOLOGS = {10: 1, 20: 2, 100: 1, 200: 2, 300: 3}
+
+@pytest.fixture
+def fake_db(monkeypatch):
+
+    def iter_geneset_value_rows(gs_ids, itersize=100000):
+        for gs_id in sorted(gs_ids):
+            for ode, in_threshold in GENESETS.get(gs_id, (0, []))[1]:
+                yield (gs_id, ode, 1.0, in_threshold)
+
+    def get_homolog_genes(hom_ids, sp_id, source):
+        genes = {}
+
+        for ode, hom_id in HOMOLOGS.items():
+            if hom_id in hom_ids and (ode < 100) == (sp_id == 1):
+                genes.setdefault(hom_id, []).append(ode)
+
+        return genes
+
+    monkeypatch.setattr(db, 'iter_geneset_value_rows', iter_geneset_value_rows)
+    monkeypatch.setattr(
+        db,
+        'get_geneset_species',
+        lambda gs_ids: dict((i, GENESETS[i][0]) for i in gs_ids if i in GENESETS)
+    )
+    monkeypatch.setattr(
+        db,
+        'get_gene_homologs',
+        lambda genes, source: dict((g, HOMOLOGS[g]) for g in genes if g in HOMOLOGS)
+    )
+    monkeypatch.setattr(db, 'get_homolog_genes', get_homolog_genes)
+    monkeypatch.setattr(db, 'get_gene_types', lambda: {'Gene Symbol': 7})
+    monkeypatch.setattr(
+        db,
+        'get_gene_refs',
+        lambda genes, type_id: dict(
+            (g, ['G%s' % g, 'A%s' % g]) for g in genes if g != 50
+        )
+    )
+    monkeypatch.setattr(
+        db, 'get_species', lambda: {'Mus musculus': 1, 'Homo sapiens': 2}
+    )
+    monkeypatch.setattr(db, 'get_platform_names', lambda: {})
+    monkeypatch.setattr(db, 'get_attributions', lambda: {})
+
+def test_set_operations():
+
+    assert list(algebra.union([[1, 3, 5], [2, 3], []])) == [1, 2, 3, 5]
+    assert list(algebra.intersection([[1, 3, 5], [3, 5, 7], [0, 5]])) == [5]
+    assert list(algebra.difference([1, 3, 5, 7], [0, 3, 7, 9])) == [1, 5]
+    assert list(algebra.difference([1, 2], [])) == [1, 2]
+
+def test_parse_expression():
+
+    assert algebra.parse_expression('GS1') == 1
+    assert algebra.parse_expression('1 | 2 | gs3') == ('|', [1, 2, 3])
+    assert algebra.parse_expression('1 | 2 & 3') == ('|', [1, ('&', [2, 3])])
+    assert algebra.parse_expression('(1 | 2) & 3 - 4') == (
+        '-', [('&', [('|', [1, 2]), 3]), 4]
+    )
+    assert algebra.parse_expression('1 - 2 - 3') == ('-', [('-', [1, 2]), 3])
+    assert algebra.expression_gs_ids(
+        algebra.parse_expression('(1 | 2) & 3 - 1')
+    ) == set([1, 2, 3])
+
+    for expression in ['', '1 |', '(1 | 2', '1 2', '1 ^ 2', ')']:
+        with pytest.raises(ValueError):
+            algebra.parse_expression(expression)
+
+def test_evaluate(fake_db):
+
+    gsa = algebra.GenesetAlgebra()
+
+    assert list(gsa.evaluate('1 | 2')) == [10, 20, 30, 40]
+    assert list(gsa.evaluate('1 & 2')) == [20]
+    assert list(gsa.evaluate('(1 | 3) - 2')) == [10, 30, 50]
+    assert gsa.get_species('1 | 3') == 1
+
+    with pytest.raises(ValueError):
+        gsa.evaluate('1 | 99')
+
+    with pytest.raises(ValueError):
+        gsa.get_species('1 | 4')
+
+def test_evaluate_threshold(fake_db):
+
+    gsa = algebra.GenesetAlgebra(threshold=True)
+
+    assert list(gsa.evaluate('1 | 3')) == [10, 20, 30, 50]
+
+def test_evaluate_store(tmpdir, fake_db):
+
+    path = str(tmpdir.join('genesets.gws'))
+
+    store.write_store(
+        path, db.iter_geneset_value_rows(list(GENESETS)), thresholds=True
+    )
+
+    with store.GenesetStore(path) as gstore:
+        gsa = algebra.GenesetAlgebra(store=gstore, threshold=True)
+
+        assert list(gsa.evaluate('1 | 3')) == [10, 20, 30, 50]
+        assert list(gsa.evaluate('2 - 1')) == [40]
+
+    path = str(tmpdir.join('values.gws'))
+
+    store.write_store(path, db.iter_geneset_value_rows(list(GENESETS)))
+
+    ## Thresholds can't be applied without the threshold flags
+    with store.GenesetStore(path) as gstore:
+        with pytest.raises(ValueError):
+            algebra.GenesetAlgebra(store=gstore, threshold=True)
+
+        gsa = algebra.GenesetAlgebra(store=gstore)
+
+        assert list(gsa.evaluate('1 | 3')) == [10, 20, 30, 40, 50]
+
+def test_homology_translation(fake_db):
+
+    gsa = algebra.GenesetAlgebra(sp_id=1)
+
+    assert list(gsa.get_genes(4)) == [10, 20]
+    assert list(gsa.evaluate('1 & 4')) == [10, 20]
+    assert gsa.get_species('1 | 4') == 1
+
+def test_iter_genesets(fake_db):
+
+    gsa = algebra.GenesetAlgebra()
+    genesets = list(gsa.iter_genesets(
+        ['1 & 2', {'expression': '3 - 2', 'gs_name': 'Three'}], cur_id=5
+    ))
+
+    assert genesets[0]['gs_name'] == '1 & 2'
+    assert genesets[0]['geneset_values'] == [('A20', 1)]
+    assert genesets[0]['gs_gene_id_type'] == -7
+    assert genesets[0]['sp_id'] == 1
+    assert genesets[0]['cur_id'] == 5
+    assert genesets[1]['gs_name'] == 'Three'
+    assert genesets[1]['gs_abbreviation'] == '3 - 2'
+    ## Genes without references are left out
+    assert genesets[1]['geneset_values'] == [('A30', 1)]
+    assert gsa.warns == [
+        '1 of the genes in the set Three have no gene references and were left out'
+    ]
+
+def test_export_expressions(fake_db):
+
+    out = io.StringIO()
+    summary = algebra.export_expressions(['1 | 2', '1 & 3'], out)
+
+    assert summary == {'genesets': 2, 'errors': []}
+
+    summary = algebra.export_expressions(['3'], io.StringIO())
+
+    assert summary['genesets'] == 1
+    assert summary['errors'] == [
+        '1 of the genes in the set 3 have no gene references and were left out'
+    ]
+
+    text = out.getvalue()
+
+    assert ': 1 | 2' in text
+    assert 'A40\t1' in text
+    assert '% Gene Symbol' in text
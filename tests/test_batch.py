@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_batch.py
+## desc: Unit tests for batch.py functions that don't require the DB.
+## auth: TR
+
+from decimal import Decimal
+import gzip
+import io
+import random
+
+import pytest
+
+from gwlib import batch
+from gwlib import db
+
+PLATFORMS = {
+    'Affymetrix GeneChip Mouse Genome 430 2.0 Array': 1,
+    'Affymetrix GeneChip Human Genome U133 Plus 2.0 Array': 2,
+    'Affymetrix GeneChip Rat Genome 230 2.0 Array': 3,
+    'Illumina MouseWG-6 v2.0 expression beadchip': 4,
+    'Illumina HumanHT-12 V4.0 expression beadchip': 5,
+    'Agilent-014868 Whole Mouse Genome Microarray 4x44K': 6,
+    'MG_U74Av2': 7,
+    'A': 8
+}
+
+def brute_force_match(platforms, s, threshold=0.65):
+
+    best = threshold
+    match = None
+
+    for name in platforms:
+        sim = batch.calculate_str_similarity(name.lower(), s.lower())
+
+        if sim > best:
+            best = sim
+            match = name
+
+    return match
+
+def test_make_digrams():
+
+    assert batch.make_digrams('') == ['']
+    assert batch.make_digrams('a') == ['a']
+    assert batch.make_digrams('ab') == ['ab']
+    assert batch.make_digrams('abcd') == ['ab', 'bc', 'cd']
+
+def test_calculate_str_similarity():
+
+    assert batch.calculate_str_similarity('abcd', 'abcd') == 1.0
+    assert batch.calculate_str_similarity('abcd', 'wxyz') == 0.0
+    assert batch.calculate_str_similarity('abab', 'ab') == 0.5
+
+def test_platform_matcher():
+
+    matcher = batch.PlatformMatcher(PLATFORMS)
+
+    assert matcher.match('Affymetrix Mouse Genome 430 2.0') == (
+        'Affymetrix GeneChip Mouse Genome 430 2.0 Array', 1
+    )
+    assert matcher.match('mg_u74av2') == ('MG_U74Av2', 7)
+    assert matcher.match('something else entirely') == (None, None)
+
+def test_platform_matcher_brute_force():
+
+    rand = random.Random(26)
+    names = list(PLATFORMS.keys())
+    platforms = dict(PLATFORMS)
+
+    ## Includes lower cased duplicates like the reference data does
+    for name in names:
+        platforms[name.lower()] = PLATFORMS[name]
+
+    matcher = batch.PlatformMatcher(platforms)
+
+    for _ in range(500):
+        s = list(rand.choice(names))
+
+        for _ in range(rand.randint(0, 15)):
+            i = rand.randrange(len(s))
+            s[i] = rand.choice('abcdefgh 0123456789')
+
+        s = ''.join(s)
+        expected = brute_force_match(platforms, s)
+        name, pf_id = matcher.match(s)
+
+        assert name == expected
+        assert pf_id == platforms.get(expected)
+
+def make_geneset(i, sp_id='Mus musculus'):
+
+    return {
+        'gs_abbreviation': 'GS%s' % i,
+        'gs_name': 'Gene set %s' % i,
+        'gs_description': 'Gene set number %s' % i,
+        'sp_id': sp_id,
+        'gs_threshold_type': '! Binary',
+        'gs_gene_id_type': 'Gene Symbol',
+        'geneset_values': [('Mobp', 1), ('Ccr4', 1)]
+    }
+
+def test_batch_writer_write(tmpdir):
+
+    genesets = [make_geneset(i) for i in range(3)]
+    genesets[2]['sp_id'] = 'Homo sapiens'
+    path = tmpdir.join('serial.bgf')
+    writer = batch.BatchWriter(str(path), genesets, no_db=True)
+
+    assert writer.serialize('v1')
+
+    out = io.StringIO()
+
+    ## Gene sets can be given as an iterator
+    assert writer.write(out, iter(genesets), 'v1') == 3
+    assert out.getvalue() == path.read()
+    assert out.getvalue().count('@ Homo sapiens') == 1
+
+def test_batch_writer_write_gzip(tmpdir):
+
+    genesets = [make_geneset(i) for i in range(3)]
+    path = tmpdir.join('serial.bgf.gz')
+    writer = batch.BatchWriter(str(path), genesets, no_db=True)
+
+    assert writer.write_file() == 3
+
+    with gzip.open(str(path), 'rb') as fl:
+        data = fl.read().decode('utf-8')
+
+    out = io.BytesIO()
+
+    writer.write(out)
+
+    assert out.getvalue().decode('utf-8') == data
+    assert ': GS2' in data
+
+def test_batch_writer_write_invalid():
+
+    genesets = [make_geneset(i) for i in range(3)]
+
+    del genesets[1]['gs_name']
+
+    writer = batch.BatchWriter(None, genesets, no_db=True)
+    out = io.StringIO()
+
+    assert writer.write(out) == 2
+    assert 'GS1' not in out.getvalue()
+    assert len(writer.errors) == 1
+
+## Reference data used in place of the DB, see BatchReader.get_reference_data
+REFERENCE = (
+    {'Gene Symbol': 7, 'gene symbol': 7, 'Ensembl Gene': 2, 'ensembl gene': 2},
+    {'Mus musculus': 1, 'mus musculus': 1, 'Homo sapiens': 2, 'homo sapiens': 2},
+    PLATFORMS
+)
+
+def make_reader(filepath=None):
+
+    reader = batch.BatchReader(filepath)
+    reader._gene_types, reader._species, reader._platforms = REFERENCE
+
+    return reader
+
+def test_parse_batch_lines():
+
+    reader = make_reader()
+    genesets = reader.parse_batch_lines([
+        '# A comment',
+        'A public',
+        'T 2',
+        'U 10',
+        'D GeneWeaver',
+        'P 1234',
+        '! P-Value < 0.01',
+        '@ Mus musculus',
+        '% Gene Symbol',
+        '$ GRCm38',
+        '',
+        ': GS1',
+        '= Gene set one',
+        '+ First line',
+        '+ second line',
+        '~ GO:0001',
+        '> http://example.com',
+        'Mobp\t0.001',
+        ## Gene values can start with a header prefix if they contain a tab
+        'A gene\t0.002',
+        '',
+        ': GS2',
+        '= Gene set two',
+        '+ Inherits the sticky fields',
+        '@ Homo sapiens',
+        '% Microarray Affymetrix Human Genome U133 Plus 2.0',
+        'Ccr4\t0.5'
+    ])
+
+    assert not reader.errors
+    assert not reader.warns
+    assert len(genesets) == 2
+
+    gs = genesets[0]
+
+    assert gs['gs_abbreviation'] == 'GS1'
+    assert gs['gs_name'] == 'Gene set one'
+    assert gs['gs_description'] == 'First line second line '
+    assert gs['gs_groups'] == '0'
+    assert gs['cur_id'] == 2
+    assert gs['usr_id'] == 10
+    assert gs['at_id'] == 'GeneWeaver'
+    assert gs['pmid'] == '1234'
+    assert gs['gs_threshold_type'] == '1'
+    assert gs['gs_threshold'] == '0.01'
+    assert gs['sp_id'] == 1
+    assert gs['gs_gene_id_type'] == -7
+    assert gs['genome_build'] == 'GRCm38'
+    assert gs['annotations'] == ['GO:0001']
+    assert gs['gs_uri'] == 'http://example.com'
+    assert gs['values'] == [('Mobp', '0.001'), ('A gene', '0.002')]
+
+    gs = genesets[1]
+
+    assert gs['gs_abbreviation'] == 'GS2'
+    assert gs['gs_description'] == 'Inherits the sticky fields '
+    assert gs['cur_id'] == 2
+    assert gs['pmid'] == '1234'
+    assert gs['gs_threshold'] == '0.01'
+    assert gs['sp_id'] == 2
+    ## Expression platforms have positive gene types
+    assert gs['gs_gene_id_type'] == 2
+    assert gs['annotations'] == []
+    assert gs['gs_uri'] is None
+    assert gs['values'] == [('Ccr4', '0.5')]
+
+def test_parse_batch_lines_score_types():
+
+    for line, ttype, threshold in [
+        ('! Binary', '3', '1'),
+        ('! Q-Value < 0.1', '2', '0.1'),
+        ('! 0.40 < Correlation < 0.50', '4', '0.40,0.50'),
+        ('! 6.0 < Effect < 22.50', '5', '6.0,22.50')
+    ]:
+        reader = make_reader()
+        gs = reader.parse_batch_lines([line])[0]
+
+        assert gs['gs_threshold_type'] == ttype
+        assert gs['gs_threshold'] == threshold
+        assert not reader.warns
+
+    reader = make_reader()
+    gs = reader.parse_batch_lines(['! P-Value', '! Correlation'])[0]
+
+    assert gs['gs_threshold_type'] == '4'
+    assert gs['gs_threshold'] == '-0.75,0.75'
+    assert reader.warns == [
+        'Invalid threshold. Using p < 0.05.',
+        'Invalid threshold. Using -0.75 < Correlation < 0.75'
+    ]
+
+def test_parse_batch_lines_errors():
+
+    reader = make_reader()
+    genesets = reader.parse_batch_lines([
+        '! Something weird',
+        '@ Martian',
+        '% Nonsense',
+        '% Microarray Nothing like it',
+        'what is this',
+        ': GS1',
+        '= Gene set one',
+        '+ Missing its species and gene type',
+        'Mobp\t1',
+        'Ccr4\t1'
+    ], offset=10)
+
+    assert reader.errors == [
+        'LINE 11: An unknown score type (Something weird) was provided.',
+        'LINE 12: Martian is an invalid species',
+        'LINE 13: nonsense is an invalid gene type',
+        'LINE 14: Nothing like it is an invalid platform',
+        batch.MISSING_FIELDS_ERROR
+    ]
+    assert reader.warns == [
+        'LINE 15: Skipping line with unknown identifiers (what is this)'
+    ]
+    ## Values for incomplete sets are dropped
+    assert genesets[-1]['values'] == []
+
+def make_batch_lines(count):
+
+    lns = ['! Binary', '@ Mus musculus', '% Gene Symbol', 'A public']
+
+    for i in range(count):
+        ## Invalid sticky lines shouldn't replace the last valid ones
+        if i % 7 == 3:
+            lns.append('@ Martian')
+
+        if i % 11 == 5:
+            lns.append('% Nonsense')
+
+        if i % 13 == 8:
+            lns.append('! Something weird')
+
+        if i % 17 == 2:
+            lns.append('@ Homo sapiens' if i % 2 else '@ Mus musculus')
+
+        lns.extend([
+            ': GS%s' % i, '= Gene set %s' % i, '+ Gene set number %s' % i, '',
+        ])
+        lns.extend('Gene%s\t%s' % (j, j) for j in range(i % 4 + 1))
+        lns.append('')
+
+    return lns
+
+def test_find_batch_chunks():
+
+    lns = make_batch_lines(20)
+    chunks = batch.find_batch_chunks(lns, size=10, reader=make_reader())
+
+    assert len(chunks) > 1
+    assert sum(len(c[2]) for c in chunks) == len(lns)
+
+    for offset, inherited, chunk in chunks[1:]:
+        ## Chunks start at the header lines following a gene set's values
+        assert chunk[0][:1] in ':@%!'
+        assert '\t' in lns[offset - 2]
+        assert lns[offset:offset + len(chunk)] == chunk
+
+        for lnum, ln in inherited:
+            assert lns[lnum - 1] == ln
+            assert ln not in ('@ Martian', '% Nonsense', '! Something weird')
+
+def test_parse_batch_file_parallel(tmpdir):
+
+    path = tmpdir.join('parallel.bgf')
+    path.write('\n'.join(make_batch_lines(60)))
+
+    serial = make_reader(str(path))
+
+    assert serial.parse_batch_file() == []
+    assert serial.errors
+
+    for chunk_size in [1, 5, 17, 50]:
+        parallel = make_reader(str(path))
+
+        assert parallel.parse_batch_file(processes=4, chunk_size=chunk_size) == []
+        assert parallel.genesets == serial.genesets
+        assert parallel.errors == serial.errors
+        assert parallel.warns == serial.warns
+
+def test_geneset_fingerprint():
+
+    values = [(10, '0.01'), (20, '0.5'), (30, '1')]
+    fingerprint = batch.geneset_fingerprint(1, -7, '1', '0.05', values)
+
+    ## Equal sets, whether they're parsed or stored
+    assert batch.geneset_fingerprint(1, -7, 1, 0.05, values) == fingerprint
+    assert batch.geneset_fingerprint(
+        1, -7, '1', '0.050', [(30, 1.0), (10, 0.01), (20, '.5')]
+    ) == fingerprint
+
+    ## Different threshold types with the same threshold value
+    assert batch.geneset_fingerprint(1, -7, '2', '0.05', values) != fingerprint
+    assert batch.geneset_fingerprint(1, -7, 3, 1, values) !=\
+        batch.geneset_fingerprint(1, -7, 1, 1, values)
+
+    ## Different contents
+    assert batch.geneset_fingerprint(2, -7, '1', '0.05', values) != fingerprint
+    assert batch.geneset_fingerprint(1, -7, '1', '0.05', values[:2]) != fingerprint
+    assert batch.geneset_fingerprint(
+        1, -7, '1', '0.05', [(10, '0.01'), (20, '0.5'), (30, '2')]
+    ) != fingerprint
+
+@pytest.fixture
+def fake_db(monkeypatch):
+
+    calls = []
+
+    def record(name, result=None):
+        def call(*args):
+            calls.append((name,) + args)
+
+            return result
+
+        return call
+
+    monkeypatch.setattr(
+        db,
+        'get_geneset_values',
+        lambda gs_ids: [
+            {'gs_id': 1, 'ode_gene_id': 10, 'gsv_value': Decimal('0.0100')},
+            {'gs_id': 1, 'ode_gene_id': 20, 'gsv_value': 0.1},
+            {'gs_id': 1, 'ode_gene_id': 30, 'gsv_value': 1.0}
+        ]
+    )
+
+    for name in [
+        'delete_geneset_values', 'update_geneset_values', 'insert_geneset_values',
+        'update_geneset_size', 'update_geneset_dates', 'commit', 'rollback'
+    ]:
+        monkeypatch.setattr(db, name, record(name))
+
+    return calls
+
+def make_update(values):
+
+    return {
+        'gs_name': 'Gene set',
+        'gs_threshold': '0.05',
+        'geneset_values': [
+            ('G%s' % ode, ode, value) for ode, value in values
+        ]
+    }
+
+def test_update_geneset_unchanged(fake_db):
+
+    reader = make_reader()
+    ## Stored as a Decimal and floats
+    result = reader.update_geneset(1, make_update([
+        (10, '0.01'), (20, '0.1'), (30, '1')
+    ]))
+
+    assert result == {'added': [], 'removed': [], 'updated': []}
+    assert ('update_geneset_values', 1, []) in fake_db
+    assert ('commit',) in fake_db
+    assert not reader.errors
+
+def test_update_geneset(fake_db):
+
+    reader = make_reader()
+    result = reader.update_geneset(1, make_update([
+        (10, '0.0101'), (20, '1e-1'), (40, '0.5')
+    ]))
+
+    assert result == {'added': [40], 'removed': [30], 'updated': [10]}
+    assert ('delete_geneset_values', 1, [30]) in fake_db
+    assert ('update_geneset_values', 1, [(10, '0.0101', True)]) in fake_db
+    assert ('insert_geneset_values', [(1, 40, 0.5, 'G40', False)]) in fake_db
+    assert ('update_geneset_size', 1, 3) in fake_db
+    assert ('commit',) in fake_db
+
+def test_update_geneset_invalid(fake_db):
+
+    reader = make_reader()
+    result = reader.update_geneset(1, make_update([(10, '0.01'), (20, 'abc')]))
+
+    assert result is None
+    assert reader.errors == [
+        'The value (abc) for G20 in the set Gene set is not a number',
+        'GS1 was not updated'
+    ]
+    ## Nothing was changed
+    assert fake_db == []
+
+class FakePubMedClient(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def get_articles(self, pmids):
+        self.requests.append(sorted(pmids))
+
+        return dict((p, {'pub_pubmed': p}) for p in pmids)
+
+def test_get_geneset_pubmeds(monkeypatch):
+
+    monkeypatch.setattr(db, 'get_publications', lambda pmids: {'1': 10})
+
+    client = FakePubMedClient()
+    reader = batch.BatchReader(None, pubmed=client)
+    reader.genesets = [{'pmid': '1'}, {'pmid': '2'}, {'pmid': ''}]
+
+    ## Readers sharing another's caches also share its client
+    assert batch.BatchReader(None, shared=reader).pubmed is client
+
+    reader.get_geneset_pubmeds()
+
+    assert client.requests == [['2']]
+    assert [gs['pub_id'] for gs in reader.genesets] == [10, None, None]
+    assert [gs['pub'] for gs in reader.genesets] == [
+        '1', {'pub_pubmed': '2'}, None
+    ]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_batchindex.py
+## desc: Unit tests for batchindex.py.
+## auth: TR
+
+import pytest
+
+from gwlib import batch
+from gwlib import batchindex
+
+BATCH = '''## Test batch file
+#
+
+! Binary
+@ Mus musculus
+% Gene Symbol
+A Public
+
+: GS1
+= Gene set one
++ The first gene set
+
+Mobp\t1
+Ccr4\t1
+
+: GS2
+= Gene set two
++ The second gene set
+
+Mobp\t1
+
+@ Homo sapiens
+% Ensembl Gene
+! P-Value < 0.05
+
+: GS3
+= Gene set three
++ The third gene set
++ has two description lines
+
+ENSG00000168314\t0.01
+ENSG00000183813\t0.02
+
+: GS4
+= Gene set four
++ The fourth gene set
+
+ENSG00000168314\t0.04
+'''
+
+def make_reader(filepath):
+
+    reader = batch.BatchReader(filepath)
+    reader._gene_types = {'gene symbol': 7, 'ensembl gene': 2}
+    reader._species = {'mus musculus': 1, 'homo sapiens': 2}
+    reader._platforms = {}
+    reader._attributions = {}
+
+    return reader
+
+@pytest.fixture
+def batch_path(tmpdir):
+
+    path = tmpdir.join('test.bgf')
+    path.write_binary(BATCH.encode('utf-8'))
+
+    return str(path)
+
+def test_build_batch_index(batch_path):
+
+    index = batchindex.build_batch_index(batch_path, make_reader(batch_path))
+
+    assert len(index) == 4
+    assert [e['gs_abbreviation'] for e in index.entries] == [
+        'GS1', 'GS2', 'GS3', 'GS4'
+    ]
+    assert index.entries[0]['offset'] == 0
+    assert index.entries[1]['inherited'] == [
+        (4, '! Binary'), (5, '@ Mus musculus'), (6, '% Gene Symbol'),
+        (7, 'A Public')
+    ]
+
+    ## Blocks cover the entire file
+    for entry, following in zip(index.entries, index.entries[1:]):
+        assert entry['offset'] + entry['length'] == following['offset']
+
+    assert index.read_lines(index.entries[2])[0] == '@ Homo sapiens'
+    assert not index.is_stale()
+
+def test_read_genesets(batch_path):
+
+    reader = make_reader(batch_path)
+    expected = reader.parse_batch_lines(BATCH.split('\n'))
+    index = batchindex.build_batch_index(batch_path, make_reader(batch_path))
+
+    genesets = index.read_genesets(
+        ['GS3', 'Gene set two', 0, 3], reader=make_reader(batch_path)
+    )
+
+    assert index.errors == []
+    assert genesets == [expected[2], expected[1], expected[0], expected[3]]
+
+    index.read_genesets(['nope'], reader=make_reader(batch_path))
+
+    assert index.errors == ['No gene set matches nope']
+
+def test_read_genesets_errors(tmpdir):
+
+    path = tmpdir.join('errors.bgf')
+    path.write(BATCH.replace('@ Homo sapiens', '@ Nope'))
+
+    reader = make_reader(str(path))
+    expected = reader.parse_batch_lines(
+        BATCH.replace('@ Homo sapiens', '@ Nope').split('\n')
+    )
+
+    index = batchindex.build_batch_index(str(path), make_reader(str(path)))
+
+    ## The invalid line isn't inherited, the last valid species line is
+    assert (22, '@ Nope') not in index.entries[3]['inherited']
+    assert (5, '@ Mus musculus') in index.entries[3]['inherited']
+
+    index.read_genesets(['GS3'], reader=make_reader(str(path)))
+
+    ## Errors use the line numbers from the file
+    assert index.errors == ['LINE 22: Nope is an invalid species']
+    assert index.errors[0] in reader.errors
+
+    ## Errors from inherited lines were reported by the earlier gene set
+    genesets = index.read_genesets(['GS4'], reader=make_reader(str(path)))
+
+    assert 'LINE 22: Nope is an invalid species' not in index.errors
+    ## Same as parsing the entire file
+    assert genesets == [expected[3]]
+
+def test_read_lines(tmpdir):
+
+    path = tmpdir.join('separators.bgf')
+    ## Unicode line separators don't end batch file lines
+    path.write_binary(
+        BATCH.replace('+ The first gene set', u'+ The first\u2028gene set')
+        .encode('utf-8')
+    )
+
+    index = batchindex.build_batch_index(str(path), make_reader(str(path)))
+    lns = index.read_lines(index.entries[0])
+
+    assert u'+ The first\u2028gene set' in lns
+    assert '+ The first' not in lns
+
+    genesets = index.read_genesets(['GS1'], reader=make_reader(str(path)))
+
+    assert index.warns == []
+    assert genesets[0]['gs_description'] == u'The first\u2028gene set '
+
+def test_load_batch_index(batch_path):
+
+    index = batchindex.load_batch_index(batch_path, reader=make_reader(batch_path))
+    loaded = batchindex.load_batch_index(batch_path)
+
+    assert loaded.entries == index.entries
+    assert loaded.filepath == batch_path
+
+    with open(batch_path, 'a') as fl:
+        fl.write('\n: GS5\n= Gene set five\n+ Five\n\nMobp\t1\n')
+
+    assert loaded.is_stale()
+    assert len(batchindex.load_batch_index(
+        batch_path, reader=make_reader(batch_path)
+    )) == 5
@@ -5,6 +5,7 @@
 ## desc: Unit tests for db.py.
 ## auth: TR
 
+from decimal import Decimal
 import warnings
 
 ## Ignore binary wheel warnings from psycopg2
@@ -12,6 +13,7 @@ warnings.filterwarnings('ignore', module='psycopg2')
 
 from gwlib import config
 from gwlib import db
+from gwlib import probes
 
 config.load_config('tests/test.cfg')
 
@@ -121,6 +123,36 @@ def test_get_gene_ids_5():
 
     assert res == {}
 
+def test_get_gene_ids_join():
+
+    threshold = db.JOIN_THRESHOLD
+
+    db.reset_lookup_stats()
+    db.set_join_threshold(1)
+
+    try:
+        res = db.get_gene_ids(['MGI:108511', 'HGNC:7189', 'ENSRNOG00000018700'])
+        res_2 = db.get_gene_ids(['MOBP'], gdb_id=7, sp_id=2)
+
+    finally:
+        db.set_join_threshold(threshold)
+
+    assert res == {
+        'MGI:108511': 5105,
+        'HGNC:7189': 66945,
+        'ENSRNOG00000018700': 124272
+    }
+    assert res_2 == {'MOBP': 66945}
+
+    stats = db.get_lookup_stats()
+
+    assert stats['threshold'] == threshold
+    assert stats['lookups']['get_gene_ids']['join_calls'] == 1
+    assert stats['lookups']['get_gene_ids']['join_keys'] == 3
+    assert stats['lookups']['get_gene_ids']['in_calls'] == 1
+
+    db.rollback()
+
 def test_get_species_genes():
 
     res = db.get_species_genes(1, symbol=False)
@@ -205,6 +237,24 @@ def test_get_geneset_ids_by_attribute_3():
     assert len(res) == 1
     assert res == [270867]
 
+def test_get_genesets_by_genes():
+
+    res = db.get_genesets_by_genes([73, 323, 82788])
+
+    assert res == [(185236, 2), (270867, 1)]
+
+    res = db.get_genesets_by_genes([73, 323], match='all')
+
+    assert res == [(185236, 2)]
+
+    res = db.get_genesets_by_genes([73, 82788], match='all')
+
+    assert res == []
+
+    res = db.get_genesets_by_genes([73, 82788], sp_id=2)
+
+    assert res == [(270867, 1)]
+
 def test_get_gene_homologs():
 
     res = db.get_gene_homologs([5105, 124272, 66945])
@@ -215,6 +265,12 @@ def test_get_gene_homologs():
         66945: 32040
     }
 
+def test_get_homolog_genes():
+
+    res = db.get_homolog_genes([32040], 2)
+
+    assert res == {32040: [66945]}
+
 def test_get_publication():
 
     res = db.get_publication('17440432')
@@ -319,3 +375,141 @@ def test_insert_geneset_values():
     assert values[1]['ode_gene_id'] == 200
     assert values[1]['gsv_value'] == -1.2
 
+def test_update_geneset_values():
+
+    ## Values can be given as strings, Decimals, or floats
+    assert db.update_geneset_values(1, [
+        (100, '2.5', False),
+        (200, Decimal('-0.25'), True)
+    ]) == 2
+
+    values = db.get_geneset_values([1])
+    values = sorted(values, key=lambda g: g['ode_gene_id'])
+
+    assert values[0]['gsv_value'] == 2.5
+    assert values[1]['gsv_value'] == -0.25
+
+    ## Nothing to update
+    assert db.update_geneset_values(1, []) == 0
+    ## Genes that aren't in the set are ignored
+    assert db.update_geneset_values(1, [(300, 1.0, True)]) == 0
+
+def test_delete_geneset_values():
+
+    assert db.delete_geneset_values(1, []) == 0
+    assert db.delete_geneset_values(1, [200, 300]) == 1
+
+    values = db.get_geneset_values([1])
+
+    assert [v['ode_gene_id'] for v in values] == [100]
+
+    db.rollback()
+
+def test_format_copy_value():
+
+    assert db.format_copy_value(None) == '\\N'
+    assert db.format_copy_value(12) == '12'
+    assert db.format_copy_value(0.25) == '0.25'
+    assert db.format_copy_value('a\tb\nc\\') == 'a\\tb\\nc\\\\'
+
+def test_copy_rows_read():
+
+    rows = db.CopyRows([(1, 'Mobp'), (2, None)])
+
+    assert rows.read(4) == '1\tMo'
+    assert rows.read() == 'bp\n2\t\\N\n'
+    assert rows.read(4) == ''
+    assert rows.count == 2
+
+def test_import_platform():
+
+    probes.add_platform_index(probes.PlatformIndex(1, []))
+
+    ref2prb = db.import_platform(
+        {'pf_id': 1},
+        ['1415670_at', '1415671_at', '1415671_at'],
+        [('1415670_at', 100), ('1415671_at', 101), ('1415671_at', 102)]
+    )
+
+    assert sorted(ref2prb.keys()) == ['1415670_at', '1415671_at']
+    ## The stale cached index is removed
+    assert 1 not in probes._indexes
+
+    ref2prb_2 = db.import_platform(
+        {'pf_id': 1},
+        ['1415670_at', '1415671_at', '1415672_at'],
+        [('1415670_at', 100), ('1415671_at', 103), ('1415672_at', 104)],
+        diff=True
+    )
+
+    assert ref2prb_2['1415670_at'] == ref2prb['1415670_at']
+    assert ref2prb_2['1415671_at'] == ref2prb['1415671_at']
+
+    prb2gene = db.get_probe2gene(ref2prb_2.values())
+
+    assert prb2gene[ref2prb['1415670_at']] == [100]
+    assert prb2gene[ref2prb['1415671_at']] == [103]
+    assert prb2gene[ref2prb_2['1415672_at']] == [104]
+
+    ## Rerunning an import without diffing doesn't duplicate probes or links
+    ref2prb_3 = db.import_platform(
+        {'pf_id': 1},
+        ['1415670_at'],
+        [('1415670_at', 100), ('1415670_at', 105)]
+    )
+
+    assert ref2prb_3 == {'1415670_at': ref2prb['1415670_at']}
+
+    prb2gene = db.get_probe2gene([ref2prb['1415670_at']])
+
+    assert sorted(prb2gene[ref2prb['1415670_at']]) == [100, 105]
+
+    db.rollback()
+
+def make_variant(rsid, chrom, coord):
+    return {
+        'rsid': rsid,
+        'allele': 'A',
+        'observed': 'A/G',
+        'ma': 'G',
+        'maf': 0.25,
+        'effect': 1,
+        'clinsig': None,
+        'chrom': chrom,
+        'coord': coord,
+        'build': 1
+    }
+
+def test_load_variants():
+
+    progress = []
+    variants = (
+        make_variant(rsid, 'chr1', 100 + (rsid % 3)) for rsid in range(1, 11)
+    )
+
+    inserted = db.load_variants(
+        variants,
+        batch_size=4,
+        commit=False,
+        progress=lambda read, inserted: progress.append(read)
+    )
+
+    assert inserted == 10
+    assert progress == [4, 8, 10]
+
+    ## Variants sharing a location share a variant_info record
+    with db.PooledCursor() as cursor:
+        cursor.execute(
+            '''
+            SELECT   vi.vri_position, COUNT(DISTINCT vi.vri_id), COUNT(*)
+            FROM     extsrc.variant v
+            JOIN     extsrc.variant_info vi
+            USING    (vri_id)
+            GROUP BY vi.vri_position
+            ORDER BY vi.vri_position;
+            '''
+        )
+
+        assert cursor.fetchall() == [(100, 1, 3), (101, 1, 4), (102, 1, 3)]
+
+    db.rollback()
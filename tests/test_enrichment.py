@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_enrichment.py
+## desc: Unit tests for enrichment.py.
+## auth: TR
+
+from fractions import Fraction
+from math import exp
+from math import factorial
+
+import pytest
+
+from gwlib import db
+from gwlib import enrichment
+from gwlib import matrix
+
+def choose(n, k):
+    return factorial(n) // (factorial(k) * factorial(n - k))
+
+def exact_sf(k, population, successes, draws):
+
+    return float(sum(
+        Fraction(
+            choose(successes, x) * choose(population - successes, draws - x),
+            choose(population, draws)
+        )
+        for x in range(k, min(successes, draws) + 1)
+    ))
+
+@pytest.fixture
+def gsm():
+
+    gsm = matrix.GenesetMatrix(values=False)
+
+    gsm.append(1, list(range(0, 10)))
+    gsm.append(2, list(range(5, 30)))
+    gsm.append(3, list(range(50, 60)) + [1000])
+    gsm.append(4, [2000])
+
+    return gsm
+
+def test_hypergeometric_sf():
+
+    for k, population, successes, draws in [
+        (3, 100, 10, 5),
+        (1, 100, 10, 5),
+        (5, 100, 10, 5),
+        (8, 500, 40, 30),
+        (20, 2000, 150, 200),
+        (15, 500, 40, 300),
+        (24, 500, 40, 300),
+        (25, 500, 40, 300)
+    ]:
+        expected = exact_sf(k, population, successes, draws)
+        pvalue = enrichment.hypergeometric_sf(k, population, successes, draws)
+
+        assert abs(pvalue - expected) <= 1e-9 * max(expected, 1e-300)
+
+    assert enrichment.hypergeometric_sf(0, 100, 10, 5) == 1.0
+    assert enrichment.hypergeometric_sf(6, 100, 10, 5) == 0.0
+    ## Every draw must be a success
+    assert enrichment.hypergeometric_sf(5, 10, 8, 7) == 1.0
+
+    ## Depleted overlaps where the probability of the overlap itself underflows
+    assert enrichment.hypergeometric_sf(200, 20000, 2000, 10000) == pytest.approx(1.0)
+    assert enrichment.hypergeometric_sf(100, 20000, 5000, 5000) == pytest.approx(1.0)
+    assert enrichment.hypergeometric_sf(1, 20000, 10000, 10000) == pytest.approx(1.0)
+
+    ## Consecutive p-values differ by the probability of the overlap, on both
+    ## sides of the mode (1000)
+    for k in [950, 1000, 1001, 1050]:
+        pmf = exp(sum([
+            enrichment.log_choose(2000, k),
+            enrichment.log_choose(18000, 10000 - k),
+            -enrichment.log_choose(20000, 10000)
+        ]))
+        difference = enrichment.hypergeometric_sf(k, 20000, 2000, 10000)
+        difference -= enrichment.hypergeometric_sf(k + 1, 20000, 2000, 10000)
+
+        assert difference == pytest.approx(pmf, rel=1e-6)
+
+    assert 0 < enrichment.hypergeometric_sf(1150, 20000, 2000, 10000) < 1e-10
+
+def test_benjamini_hochberg():
+
+    qvalues = enrichment.benjamini_hochberg([0.01, 0.04, 0.03, 0.5])
+
+    assert qvalues == pytest.approx([0.04, 0.04 * 4 / 3.0, 0.04 * 4 / 3.0, 0.5])
+    assert enrichment.benjamini_hochberg([0.01], tests=10) == [0.1]
+    assert enrichment.benjamini_hochberg([]) == []
+
+def test_overlaps(gsm):
+
+    engine = enrichment.EnrichmentEngine(gsm, background=range(100))
+
+    assert engine.population == 100
+    ## Set 3's gene outside the background doesn't count towards its size
+    assert engine._sizes == [10, 25, 10, 0]
+    assert engine.overlaps([0, 5, 6, 55, 1000, 999]) == {0: 3, 1: 2, 2: 1}
+
+def test_enrich(gsm):
+
+    engine = enrichment.EnrichmentEngine(gsm, background=range(100))
+    results = engine.enrich(list(range(0, 8)))
+
+    assert [r['gs_id'] for r in results] == [1, 2]
+    assert results[0]['overlap'] == 8
+    assert results[0]['size'] == 10
+    assert results[0]['pvalue'] == pytest.approx(exact_sf(8, 100, 10, 8))
+    ## Three sets have genes in the background
+    assert results[0]['qvalue'] == pytest.approx(results[0]['pvalue'] * 3)
+    assert results[1]['pvalue'] == pytest.approx(exact_sf(3, 100, 25, 8))
+
+    assert [r['gs_id'] for r in engine.enrich(range(0, 8), min_overlap=4)] == [1]
+    assert [r['gs_id'] for r in engine.enrich(range(0, 8), alpha=0.05)] == [1]
+    assert engine.enrich([999]) == []
+
+def test_build_enrichment_engine(monkeypatch):
+
+    monkeypatch.setattr(
+        db, 'get_geneset_ids', lambda tiers, at_id, size, sp_id: [1, 2]
+    )
+    monkeypatch.setattr(
+        db,
+        'iter_geneset_value_rows',
+        lambda gs_ids, itersize: iter([
+            (1, 10, 1.0, True), (1, 11, 1.0, False), (2, 11, 1.0, True)
+        ])
+    )
+    monkeypatch.setattr(
+        db,
+        'get_species_genes',
+        lambda sp_id, gdb_id, symbol: {'A': 10, 'B': 11, 'C': 12, 'D': 12}
+    )
+
+    engine = enrichment.build_enrichment_engine(1)
+
+    assert engine.population == 3
+    assert engine.matrix.get_genes(1) == [10]
+    assert [r['gs_id'] for r in engine.enrich([11])] == [2]
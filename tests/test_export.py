@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_export.py
+## desc: Unit tests for export.py. DB queries are replaced with canned results.
+## auth: TR
+
+from decimal import Decimal
+import gzip
+import io
+import json
+
+import pytest
+
+from gwlib import db
+from gwlib import export
+
+GENESETS = {
+    1: {
+        'gs_id': 1, 'gs_name': 'Set one', 'gs_abbreviation': 'GS1',
+        'gs_description': 'First set', 'sp_id': 1, 'cur_id': 3,
+        'gs_threshold_type': 3, 'gs_threshold': '1', 'gs_gene_id_type': -7,
+        'gs_attribution': None, 'gs_groups': '0', 'pub_id': 10
+    },
+    3: {
+        'gs_id': 3, 'gs_name': 'Set three', 'gs_abbreviation': 'GS3',
+        'gs_description': 'Third set', 'sp_id': 2, 'cur_id': 3,
+        'gs_threshold_type': 3, 'gs_threshold': '1', 'gs_gene_id_type': -7,
+        'gs_attribution': None, 'gs_groups': '0', 'pub_id': None
+    }
+}
+
+VALUES = [
+    (1, 100, 'Mobp', Decimal('1.0')),
+    (1, 101, 'Ccr4', Decimal('1.0')),
+    (2, 102, 'Nope', Decimal('1.0')),
+    (3, 103, 'MOBP', Decimal('1.0'))
+]
+
+@pytest.fixture
+def fake_db(monkeypatch):
+
+    calls = []
+
+    def get_genesets(gs_ids):
+        calls.append(('get_genesets', list(gs_ids)))
+
+        return [GENESETS[i] for i in gs_ids if i in GENESETS]
+
+    def iter_geneset_values(gs_ids, itersize=None):
+        return iter([v for v in VALUES if v[0] in gs_ids])
+
+    monkeypatch.setattr(db, 'get_genesets', get_genesets)
+    monkeypatch.setattr(db, 'iter_geneset_values', iter_geneset_values)
+    monkeypatch.setattr(
+        db, 'get_geneset_pmids', lambda gs_ids: {1: '123'} if 1 in gs_ids else {}
+    )
+    monkeypatch.setattr(
+        db,
+        'get_geneset_annotations',
+        lambda gs_ids: {3: [(5, 'GO:0001'), (6, 'GO:0002')]} if 3 in gs_ids else {}
+    )
+    monkeypatch.setattr(db, 'get_publication_pmid', None)
+    monkeypatch.setattr(
+        db, 'get_species', lambda: {'Mus musculus': 1, 'Homo sapiens': 2}
+    )
+    monkeypatch.setattr(db, 'get_gene_types', lambda: {'Gene Symbol': 7})
+    monkeypatch.setattr(db, 'get_platform_names', lambda: {})
+    monkeypatch.setattr(db, 'get_attributions', lambda: {})
+
+    return calls
+
+def test_iter_export_genesets(fake_db):
+
+    genesets = list(export.iter_export_genesets([3, 2, 1], chunk_size=2))
+
+    assert [gs['gs_id'] for gs in genesets] == [1, 3]
+    assert genesets[0]['geneset_values'] == [('Mobp', 1.0), ('Ccr4', 1.0)]
+    assert genesets[0]['pmid'] == '123'
+    assert 'pub_id' not in genesets[0]
+    assert genesets[1]['geneset_values'] == [('MOBP', 1.0)]
+    assert genesets[1]['annotations'] == ['GO:0001', 'GO:0002']
+    assert fake_db == [('get_genesets', [1, 2]), ('get_genesets', [3])]
+
+def test_export_genesets(fake_db):
+
+    out = io.StringIO()
+    summary = export.export_genesets([1, 3], out)
+    data = out.getvalue()
+
+    assert summary == {'genesets': 2, 'errors': []}
+    assert '@ Mus musculus' in data
+    assert '@ Homo sapiens' in data
+    assert 'P 123' in data
+    assert '~ GO:0001' in data
+    assert ': GS3' in data
+    assert 'Ccr4\t1.0' in data
+
+PARTITION_INFO = [
+    {'gs_id': 1, 'sp_id': 1, 'gs_attribution': None, 'gs_count': 100},
+    {'gs_id': 2, 'sp_id': 2, 'gs_attribution': 8, 'gs_count': 60},
+    {'gs_id': 3, 'sp_id': 1, 'gs_attribution': 8, 'gs_count': 50},
+    {'gs_id': 4, 'sp_id': 2, 'gs_attribution': None, 'gs_count': 40},
+    {'gs_id': 5, 'sp_id': 1, 'gs_attribution': 8, 'gs_count': None}
+]
+
+def test_partition_genesets_size():
+
+    shards = export.partition_genesets(PARTITION_INFO, by='size', shards=2)
+
+    assert [s['gs_ids'] for s in shards] == [[1, 4], [2, 3, 5]]
+    assert [s['size'] for s in shards] == [140, 110]
+    assert [s['shard'] for s in shards] == [0, 1]
+
+    ## Never more shards than gene sets
+    assert len(export.partition_genesets(PARTITION_INFO, shards=10)) == 5
+
+def test_partition_genesets_species():
+
+    shards = export.partition_genesets(PARTITION_INFO, by='species')
+
+    assert [(s['key'], s['gs_ids']) for s in shards] == [
+        (1, [1, 3, 5]), (2, [2, 4])
+    ]
+
+def test_partition_genesets_attribution():
+
+    shards = export.partition_genesets(PARTITION_INFO, by='attribution')
+
+    assert sorted((str(s['key']), s['gs_ids']) for s in shards) == [
+        ('8', [2, 3, 5]), ('None', [1, 4])
+    ]
+
+    with pytest.raises(ValueError):
+        export.partition_genesets(PARTITION_INFO, by='tier')
+
+def test_concatenate_shards(tmpdir):
+
+    summaries = []
+
+    for i, data in enumerate([b'## shard zero\n', b'## shard one\n']):
+        path = tmpdir.join('shard-%s.bgf' % i)
+        path.write_binary(data)
+
+        summaries.append({
+            'shard': i, 'key': i, 'filepath': str(path), 'genesets': i + 1
+        })
+
+    out = str(tmpdir.join('all.bgf'))
+    manifest = export.concatenate_shards(summaries[::-1], out)
+
+    with open(out, 'rb') as fl:
+        data = fl.read()
+
+    assert data == b'## shard zero\n## shard one\n'
+    assert [(s['offset'], s['length']) for s in manifest['shards']] == [
+        (0, 14), (14, 13)
+    ]
+
+    with open(out + '.manifest.json') as fl:
+        assert json.load(fl) == manifest
+
+    shard = manifest['shards'][1]
+
+    assert data[shard['offset']:shard['offset'] + shard['length']] == (
+        b'## shard one\n'
+    )
+
+def test_export_genesets_parallel(fake_db, monkeypatch, tmpdir):
+
+    monkeypatch.setattr(db, 'get_connect_args', lambda: {})
+    monkeypatch.setattr(db, 'connect', lambda **kwargs: (True, ''))
+    monkeypatch.setattr(db, 'rollback', lambda: None)
+    monkeypatch.setattr(
+        db,
+        'get_geneset_partition_info',
+        lambda gs_ids: [gs for gs in PARTITION_INFO if gs['gs_id'] in gs_ids]
+    )
+
+    out = str(tmpdir.join('all.bgf.gz'))
+    manifest = export.export_genesets_parallel(
+        [1, 3],
+        str(tmpdir.join('shards')),
+        by='attribution',
+        processes=2,
+        compress=True,
+        filepath=out
+    )
+
+    assert [(s['key'], s['genesets'], s['errors']) for s in manifest['shards']] == [
+        (None, 1, []), (8, 1, [])
+    ]
+    assert tmpdir.join('shards').listdir() == []
+
+    with gzip.open(out, 'rb') as fl:
+        data = fl.read().decode('utf-8')
+
+    assert data.count('Machine generated') == 2
+    assert ': GS1' in data and ': GS3' in data
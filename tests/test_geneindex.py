@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_geneindex.py
+## desc: Unit tests for geneindex.py.
+## auth: TR
+
+import pytest
+
+from gwlib import db
+from gwlib import geneindex
+
+## gs_id, genes, cur_id, sp_id, at_id, gs_count
+GENESETS = [
+    (1, [10, 20, 30], 1, 1, 8, 3),
+    (2, [20, 30], 3, 2, None, 2),
+    (3, [30, 40, 50, 60], 1, 2, 6, 4),
+    (4, [20, 30, 40], 5, 1, None, 3)
+]
+
+@pytest.fixture
+def index():
+
+    index = geneindex.GeneIndex(complete=True)
+
+    for gs in reversed(GENESETS):
+        index.add_geneset(*gs)
+
+    return index
+
+def test_intersect_postings():
+
+    assert geneindex.intersect_postings([]) == []
+    assert geneindex.intersect_postings([[1, 3, 5, 7]]) == [1, 3, 5, 7]
+    assert geneindex.intersect_postings([
+        [1, 3, 5, 7, 9], [3, 4, 5, 9], [0, 3, 9, 10]
+    ]) == [3, 9]
+    assert geneindex.intersect_postings([[1, 2], [3, 4]]) == []
+
+def test_gene_index(index):
+
+    assert len(index) == 4
+    assert index.genes == 6
+    assert 3 in index
+    assert list(index.get_genesets(30)) == [1, 2, 3, 4]
+    assert list(index.get_genesets(99)) == []
+
+    with pytest.raises(ValueError):
+        index.add_geneset(1, [10])
+
+def test_find_genesets_all(index):
+
+    assert index.find_genesets([20, 30], min_overlap=2) == [
+        (1, 2), (2, 2), (4, 2)
+    ]
+    assert index.find_genesets([20, 99], min_overlap=2) == []
+
+def test_find_genesets_any(index):
+
+    assert index.find_genesets([20, 40, 50]) == [
+        (3, 2), (4, 2), (1, 1), (2, 1)
+    ]
+    assert index.find_genesets([20, 40, 50], min_overlap=2) == [(3, 2), (4, 2)]
+
+def test_find_genesets_filters(index):
+
+    assert index.find_genesets([30], tiers=[1]) == [(1, 1), (3, 1)]
+    assert index.find_genesets([30], at_id=6) == [(3, 1)]
+    assert index.find_genesets([30], sp_id=1) == [(1, 1), (4, 1)]
+    assert index.find_genesets([30], size=4) == [(1, 1), (2, 1), (4, 1)]
+
+def test_get_genesets_by_genes_index(index):
+
+    db.set_gene_index(index)
+
+    try:
+        assert db.get_genesets_by_genes([20, 30], match='all') == [
+            (1, 2), (2, 2), (4, 2)
+        ]
+        assert db.get_genesets_by_genes([40, 50], tiers=[5]) == [(4, 1)]
+        assert db.get_genesets_by_genes([]) == []
+
+        with pytest.raises(ValueError):
+            db.get_genesets_by_genes([20], match='some')
+
+    finally:
+        db.set_gene_index(None)
+
+def test_get_genesets_by_genes_partial_index(monkeypatch):
+
+    partial = geneindex.GeneIndex()
+    partial.add_geneset(1, [10, 20])
+
+    def cursor(*args, **kwargs):
+        raise RuntimeError('queried the DB')
+
+    monkeypatch.setattr(db, 'PooledCursor', cursor)
+    db.set_gene_index(partial)
+
+    ## Partial indexes aren't used
+    try:
+        with pytest.raises(RuntimeError):
+            db.get_genesets_by_genes([10])
+
+    finally:
+        db.set_gene_index(None)
+
+def test_build_gene_index(monkeypatch):
+
+    monkeypatch.setattr(db, 'get_geneset_ids', lambda: [1, 2])
+    monkeypatch.setattr(db, 'get_geneset_partition_info', lambda gs_ids: [
+        {'gs_id': 1, 'cur_id': 1, 'sp_id': 1, 'gs_attribution': None, 'gs_count': 2},
+        {'gs_id': 2, 'cur_id': 2, 'sp_id': 1, 'gs_attribution': None, 'gs_count': 1}
+    ])
+    monkeypatch.setattr(
+        db,
+        'iter_geneset_value_rows',
+        lambda gs_ids, itersize: iter([
+            (1, 10, 1.0, True), (1, 20, 0.5, False), (2, 20, 1.0, True)
+        ])
+    )
+
+    index = geneindex.build_gene_index(threshold=True)
+
+    assert index.threshold
+    assert index.complete
+    assert list(index.get_genesets(10)) == [1]
+    assert list(index.get_genesets(20)) == [2]
+
+    assert not geneindex.build_gene_index(gs_ids=[1]).complete
+
+    try:
+        geneindex.load_gene_index()
+
+        assert db.get_gene_index().genes == 2
+
+    finally:
+        db.set_gene_index(None)
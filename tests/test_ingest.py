@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_ingest.py
+## desc: Unit tests for ingest.py functions that don't require the DB.
+## auth: TR
+
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from gwlib import db
+from gwlib import ingest
+
+REFERENCE = ({'gene symbol': 7}, {'mus musculus': 1}, {})
+
+BATCH = '''! Binary
+@ Mus musculus
+% Gene Symbol
+
+: GS1
+= Gene set one
++ The first gene set
+
+Mobp\t1
+Ccr4\t1
+'''
+
+class FakeReader(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def insert_geneset(self, gs):
+        raise ValueError('insert failed')
+
+class FakeConnection(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+def test_find_batch_files(tmpdir):
+
+    tmpdir.join('b.bgf').write('')
+    tmpdir.join('a.bgf').write('')
+    tmpdir.join('c.txt').write('')
+    tmpdir.mkdir('d.bgf')
+
+    assert ingest.find_batch_files(str(tmpdir)) == [
+        str(tmpdir.join(fp)) for fp in ['a.bgf', 'b.bgf', 'c.txt']
+    ]
+    assert ingest.find_batch_files(str(tmpdir.join('*.bgf'))) == [
+        str(tmpdir.join(fp)) for fp in ['a.bgf', 'b.bgf']
+    ]
+    assert ingest.find_batch_files(str(tmpdir.join('missing'))) == []
+
+def test_parse_batch_file_syntax(tmpdir):
+
+    path = tmpdir.join('test.bgf')
+    path.write(BATCH)
+
+    genesets, errors, warns = ingest.parse_batch_file_syntax((str(path), REFERENCE))
+
+    assert errors == []
+    assert warns == []
+    assert len(genesets) == 1
+    assert genesets[0]['gs_abbreviation'] == 'GS1'
+    assert genesets[0]['sp_id'] == 1
+    assert genesets[0]['gs_gene_id_type'] == -7
+    assert genesets[0]['values'] == [('Mobp', '1'), ('Ccr4', '1')]
+
+    path.write(BATCH.replace('Mus musculus', 'Martian'))
+
+    genesets, errors, warns = ingest.parse_batch_file_syntax((str(path), REFERENCE))
+
+    assert errors[0] == 'LINE 2: Martian is an invalid species'
+
+def test_write_genesets_connection_failure():
+
+    ## Without a connection pool writers can't get a connection
+    queue = Queue(maxsize=1)
+    failures = []
+    thread = threading.Thread(target=ingest.write_genesets, args=(queue, failures))
+    thread.start()
+    thread.join()
+
+    assert len(failures) == 1
+    assert ingest.put_geneset(queue, 'item', [thread])
+    ## The queue is full and nothing is left to empty it
+    assert not ingest.put_geneset(queue, 'item', [thread])
+
+def test_write_genesets_rollback_failure(monkeypatch):
+
+    def rollback():
+        raise RuntimeError('connection lost')
+
+    monkeypatch.setattr(db, 'PooledConnection', FakeConnection)
+    monkeypatch.setattr(db, 'rollback', rollback)
+
+    queue = Queue()
+    failures = []
+    reader = FakeReader()
+
+    queue.put(({'ids': []}, 0, reader, {'gs_name': 'GS1'}))
+    queue.put(None)
+
+    ingest.write_genesets(queue, failures)
+
+    assert reader.errors == ['Failed to insert the set GS1: insert failed']
+    assert [str(e) for e in failures] == ['connection lost']
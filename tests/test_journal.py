@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_journal.py
+## desc: Unit tests for journal.py.
+## auth: TR
+
+from gwlib import batch
+from gwlib import journal
+
+def make_geneset(name, values):
+
+    return {
+        'gs_abbreviation': name,
+        'gs_name': name,
+        'values': values
+    }
+
+def test_geneset_key():
+
+    gs1 = make_geneset('a', [('Mobp', '1'), ('Daxx', '1')])
+    gs2 = make_geneset('a', [('Mobp', '1'), ('Daxx', '1')])
+    gs3 = make_geneset('a', [('Mobp', '1')])
+    gs4 = make_geneset('b', [('Mobp', '1'), ('Daxx', '1')])
+
+    assert journal.geneset_key(gs1) == journal.geneset_key(gs2)
+    assert journal.geneset_key(gs1) != journal.geneset_key(gs3)
+    assert journal.geneset_key(gs1) != journal.geneset_key(gs4)
+
+def test_geneset_keys():
+
+    reader = batch.BatchReader(None)
+    reader._gene_types = {'gene symbol': 7}
+    reader._species = {'mus musculus': 1}
+    reader._platforms = {}
+
+    ## The same set appears twice
+    lns = ['! Binary', '@ Mus musculus', '% Gene Symbol']
+    lns += [': a', '= a', '+ a', 'Mobp\t1', 'Daxx\t1'] * 2
+    lns += [': b', '= b', '+ b', 'Mobp\t1']
+
+    genesets = reader.parse_batch_lines(lns)
+    keys = journal.geneset_keys(genesets)
+
+    assert len(genesets) == 3
+    assert len(set(keys)) == 3
+    assert keys[0] == journal.geneset_key(genesets[0])
+    assert keys[1] == journal.geneset_key(genesets[1], 1)
+    ## Keys don't change when unrelated sets are removed
+    assert journal.geneset_keys(genesets[1:]) == [keys[0], keys[2]]
+
+def test_journal_record(tmpdir):
+
+    path = str(tmpdir.join('upload.journal'))
+
+    with journal.BatchJournal(path) as jl:
+        assert jl.get('a') is None
+
+        jl.record('a', 1)
+        jl.record('b', 2)
+
+        assert jl.get('a') == 1
+
+    with journal.BatchJournal(path) as jl:
+        assert jl.completed == {'a': 1, 'b': 2}
+
+def test_journal_partial_line(tmpdir):
+
+    path = tmpdir.join('upload.journal')
+    path.write('{"key": "a", "gs_id": 1}\n{"key": "b", "gs')
+
+    with journal.BatchJournal(str(path)) as jl:
+        assert jl.completed == {'a': 1}
+
+        jl.record('c', 3)
+
+    with journal.BatchJournal(str(path)) as jl:
+        assert jl.completed == {'a': 1, 'c': 3}
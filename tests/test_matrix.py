@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_matrix.py
+## desc: Unit tests for matrix.py.
+## auth: TR
+
+import math
+
+import pytest
+
+from gwlib import matrix
+
+ROWS = [
+    (1, 300, 0.5, True),
+    (1, 100, 1.5, False),
+    (2, 100, 2.0, True),
+    (2, 400, None, True),
+    (3, 200, 3.0, False)
+]
+
+@pytest.fixture
+def gsm():
+
+    gsm = matrix.GenesetMatrix(values=True, thresholds=True)
+
+    assert gsm.extend(ROWS) == 3
+
+    return gsm
+
+def test_geneset_matrix(gsm):
+
+    assert gsm.shape == (4, 3)
+    assert gsm.nnz == 5
+    assert gsm.genes == [300, 100, 400, 200]
+    assert gsm.gs_ids == [1, 2, 3]
+    assert list(gsm.indptr) == [0, 2, 4, 5]
+    assert list(gsm.indices) == [0, 1, 1, 2, 3]
+    assert list(gsm.mask) == [1, 0, 1, 1, 0]
+    assert gsm.get_row(400) == 2
+    assert gsm.get_column(3) == 2
+    assert gsm.get_column(4) is None
+    assert gsm.get_genes(1) == [300, 100]
+    assert gsm.get_genes(4) is None
+    assert gsm.get_values(1) == [0.5, 1.5]
+    assert math.isnan(gsm.get_values(2)[1])
+
+    with pytest.raises(ValueError):
+        gsm.append(1, [100])
+
+def test_geneset_matrix_csr(gsm):
+
+    indptr, indices, positions = gsm.to_csr()
+
+    assert list(indptr) == [0, 1, 3, 4, 5]
+    assert list(indices) == [0, 0, 1, 1, 2]
+    assert list(positions) == [0, 1, 2, 3, 4]
+    assert gsm.get_genesets(100) == [1, 2]
+    assert gsm.get_genesets(999) == []
+
+    ## Appending invalidates the cached CSR arrays
+    gsm.append(4, [200, 500], [1.0, 2.0])
+
+    assert gsm.get_genesets(200) == [3, 4]
+    assert gsm.get_genesets(500) == [4]
+    assert gsm.shape == (5, 4)
+
+def test_threshold_only(gsm):
+
+    thresh = gsm.threshold_only()
+
+    assert thresh.shape == gsm.shape
+    assert thresh.get_genes(1) == [300]
+    assert thresh.get_genes(2) == [100, 400]
+    assert thresh.get_genes(3) == []
+    assert thresh.get_genesets(100) == [2]
+
+    with pytest.raises(ValueError):
+        matrix.GenesetMatrix().threshold_only()
+
+def test_save_load(tmpdir, gsm):
+
+    path = str(tmpdir.join('matrix.gws'))
+
+    gsm.save(path)
+
+    loaded = matrix.GenesetMatrix.load(path)
+
+    assert loaded.shape == gsm.shape
+    assert loaded.gs_ids == [1, 2, 3]
+    assert sorted(loaded.get_genes(1)) == [100, 300]
+    assert loaded.get_genesets(100) == [1, 2]
+    assert loaded.threshold_only().get_genes(2) == [100, 400]
+
+    partial = matrix.GenesetMatrix.load(path, gs_ids=[3, 5])
+
+    assert partial.gs_ids == [3]
+    assert partial.get_values(3) == [3.0]
+
+def test_build_matrix(monkeypatch):
+
+    monkeypatch.setattr(
+        matrix.db, 'iter_geneset_value_rows', lambda gs_ids, itersize: iter(ROWS)
+    )
+
+    gsm = matrix.build_matrix(values=False)
+
+    assert gsm.shape == (4, 3)
+    assert gsm.values is None
+    assert gsm.mask is None
+    assert gsm.get_values(1) is None
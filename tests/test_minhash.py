@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_minhash.py
+## desc: Unit tests for minhash.py.
+## auth: TR
+
+from datetime import datetime
+import pytest
+
+from gwlib import db
+from gwlib import minhash
+
+GENESETS = {
+    1: set(range(0, 100)),
+    2: set(range(5, 100)),
+    3: set(range(20, 110)),
+    4: set(range(1000, 1100)),
+    5: set()
+}
+
+@pytest.fixture
+def index():
+
+    index = minhash.MinHashIndex(num_perm=128, bands=32)
+
+    for gs_id, genes in GENESETS.items():
+        index.add(gs_id, genes)
+
+    return index
+
+@pytest.fixture
+def fake_db(monkeypatch):
+
+    def iter_geneset_value_rows(gs_ids, itersize=100000):
+        for gs_id in sorted(gs_ids):
+            for ode in sorted(GENESETS.get(gs_id, ())):
+                yield (gs_id, ode, 1.0, ode % 2 == 0)
+
+    monkeypatch.setattr(db, 'iter_geneset_value_rows', iter_geneset_value_rows)
+    monkeypatch.setattr(db, 'get_geneset_ids', lambda: sorted(GENESETS))
+    monkeypatch.setattr(db, 'get_geneset_update_dates', lambda: dict(
+        (gs_id, datetime(2020, 1, gs_id)) for gs_id in GENESETS
+    ))
+
+def test_jaccard():
+
+    assert minhash.jaccard(set([1, 2]), set([2, 3])) == 1 / 3.0
+    assert minhash.jaccard(set(), set()) == 0.0
+
+def test_timestamp():
+
+    assert minhash._timestamp(None) == 0
+    assert minhash._timestamp(datetime(1970, 1, 1, 0, 0, 1, 5)) == 1000005
+
+def test_minhash_index(index):
+
+    with pytest.raises(ValueError):
+        minhash.MinHashIndex(num_perm=128, bands=30)
+
+    assert len(index) == 5
+    assert 3 in index
+    assert index.signature([1, 2, 3]) == index.signature([3, 2, 1, 1])
+
+    ## Estimates should be within a few standard errors (~0.04) of the exact value
+    estimate = index.estimate(index.get_signature(1), index.get_signature(3))
+
+    assert abs(estimate - minhash.jaccard(GENESETS[1], GENESETS[3])) < 0.15
+    assert index.estimate(index.get_signature(1), index.get_signature(4)) < 0.1
+    assert index.estimate(index.get_signature(5), index.get_signature(5)) == 0
+
+    assert index.remove(4)
+    assert not index.remove(4)
+    assert 4 not in index
+    assert index.find_similar(index.signature(GENESETS[4])) == []
+
+def test_find_similar(index):
+
+    found = index.find_similar(index.get_signature(1), k=2, exclude=1)
+
+    assert [gs_id for gs_id, _ in found] == [2, 3]
+    assert found[0][1] > 0.8
+
+def test_save_load(tmpdir, index):
+
+    path = str(tmpdir.join('genesets.mh'))
+    index.add(3, GENESETS[3], updated=3)
+
+    index.save(path)
+
+    loaded = minhash.MinHashIndex.load(path)
+
+    assert loaded.gs_ids == index.gs_ids
+    assert loaded.get_signature(3) == index.get_signature(3)
+    assert loaded.get_updated(3) == 3
+    assert loaded.signature([7, 8]) == index.signature([7, 8])
+    assert tmpdir.listdir() == [tmpdir.join('genesets.mh')]
+
+    tmpdir.join('bad.mh').write('nope')
+
+    with pytest.raises(ValueError):
+        minhash.MinHashIndex.load(str(tmpdir.join('bad.mh')))
+
+def test_update_minhash_index(fake_db, monkeypatch):
+
+    index = minhash.build_minhash_index(gs_ids=[1, 2])
+
+    assert index.gs_ids == [1, 2]
+    assert index.get_updated(2) == minhash._timestamp(datetime(2020, 1, 2))
+
+    summary = minhash.update_minhash_index(index)
+
+    assert summary == {'added': 3, 'updated': 0, 'removed': 0}
+    assert index.gs_ids == [1, 2, 3, 4, 5]
+
+    ## Sets missing from the list are kept
+    summary = minhash.update_minhash_index(index, gs_ids=[1, 3])
+
+    assert summary == {'added': 0, 'updated': 0, 'removed': 0}
+    assert index.gs_ids == [1, 2, 3, 4, 5]
+
+    ## Set 1 was edited and set 4 deprecated
+    monkeypatch.setitem(GENESETS, 1, set(range(1000, 1100)))
+    monkeypatch.delitem(GENESETS, 4)
+    monkeypatch.setattr(db, 'get_geneset_update_dates', lambda: {
+        1: datetime(2021, 1, 1), 2: datetime(2020, 1, 2), 3: datetime(2020, 1, 3),
+        5: datetime(2020, 1, 5)
+    })
+
+    summary = minhash.update_minhash_index(index)
+
+    assert summary == {'added': 0, 'updated': 1, 'removed': 1}
+    assert index.gs_ids == [1, 2, 3, 5]
+    assert index.get_signature(1) == index.signature(range(1000, 1100))
+
+def test_find_similar_genesets(fake_db, index):
+
+    with pytest.raises(ValueError):
+        minhash.find_similar_genesets(1)
+
+    minhash.set_minhash_index(index)
+
+    try:
+        found = minhash.find_similar_genesets(1, k=1)
+
+        assert [gs_id for gs_id, _ in found] == [2]
+
+        found = minhash.find_similar_genesets(1, k=5, exact=True)
+
+        assert found == [(2, 0.95), (3, 80 / 110.0)]
+
+        found = minhash.find_similar_genesets(list(range(1000, 1090)), exact=True)
+
+        assert found == [(4, 0.9)]
+
+        ## An empty index is searched instead of the one that was set
+        empty = minhash.MinHashIndex(num_perm=index.num_perm, bands=index.bands)
+
+        assert minhash.find_similar_genesets(
+            list(range(0, 100)), index=empty
+        ) == []
+
+    finally:
+        minhash.set_minhash_index(None)
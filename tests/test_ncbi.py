@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_ncbi.py
+## desc: Unit tests for ncbi.py. Requests are made to a local stub E-utilities
+##       server.
+## auth: TR
+
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs
+
+import pytest
+
+from gwlib import ncbi
+
+SUMMARY = {
+    '1': {
+        'title': 'Article one',
+        'fulljournalname': 'Journal one',
+        'volume': '12',
+        'pages': '1-10',
+        'pubdate': '2015 Dec 1',
+        'authors': [{'name': 'Smith J'}, {'name': 'Doe J'}]
+    },
+    '2': {
+        'title': 'Article two',
+        'fulljournalname': 'Journal two',
+        'pubdate': '2001',
+        'authors': []
+    }
+}
+
+ABSTRACTS = {
+    '1': '<AbstractText Label="BACKGROUND">Background.</AbstractText>'
+         '<AbstractText Label="RESULTS">Results.</AbstractText>',
+    '2': '<AbstractText>Abstract <i>two</i>.</AbstractText>'
+}
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode('utf-8'))
+        ids = params['id'][0].split(',')
+
+        self.server.requests.append((self.path, ids))
+
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if self.path.endswith('esummary.fcgi'):
+            found = [i for i in ids if i in SUMMARY]
+            result = dict((i, SUMMARY[i]) for i in found)
+            result['uids'] = found
+            body = json.dumps({'result': result})
+
+        else:
+            body = '<PubmedArticleSet>'
+
+            for i in ids:
+                if i in ABSTRACTS:
+                    body += (
+                        '<PubmedArticle><MedlineCitation><PMID>%s</PMID><Article>'
+                        '<Abstract>%s</Abstract></Article></MedlineCitation>'
+                        '</PubmedArticle>'
+                    ) % (i, ABSTRACTS[i])
+
+            body += '</PubmedArticleSet>'
+
+        body = body.encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+
+    httpd = HTTPServer(('127.0.0.1', 0), StubHandler)
+    httpd.requests = []
+    httpd.failures = 0
+
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+def make_client(server, **kwargs):
+
+    url = 'http://127.0.0.1:%s/eutils' % server.server_address[1]
+
+    return ncbi.PubMedClient(base_url=url, rate=1000, backoff=0.01, **kwargs)
+
+def test_parse_pubdate():
+
+    assert ncbi.parse_pubdate('2015 Dec 1') == ('2015', 'Dec')
+    assert ncbi.parse_pubdate('2015 Winter') == ('2015', '')
+    assert ncbi.parse_pubdate('') == ('', '')
+
+def test_get_articles(server):
+
+    articles = make_client(server).get_articles([1, '2', '3', None])
+
+    assert sorted(articles.keys()) == ['1', '2']
+    assert articles['1']['pub_title'] == 'Article one'
+    assert articles['1']['pub_authors'] == 'Smith J,Doe J'
+    assert articles['1']['pub_year'] == '2015'
+    assert articles['1']['pub_month'] == 'Dec'
+    assert articles['1']['pub_abstract'] == 'BACKGROUND: Background.\nRESULTS: Results.'
+    assert articles['2']['pub_abstract'] == 'Abstract two.'
+    assert articles['2']['pub_volume'] == ''
+
+def test_get_articles_batches(server):
+
+    make_client(server, batch_size=2).get_articles(['1', '2', '3'])
+
+    summaries = [ids for path, ids in server.requests if 'esummary' in path]
+
+    assert sorted(summaries) == [['1', '2'], ['3']]
+
+def test_get_articles_retry(server):
+
+    server.failures = 2
+
+    articles = make_client(server, threads=1).get_articles(['1'])
+
+    assert '1' in articles
+    assert len(server.requests) == 4
+
+def test_get_articles_retry_failure(server):
+
+    server.failures = 100
+
+    assert make_client(server, retries=2).get_articles(['1']) == {}
+    assert len(server.requests) == 3
+
+def test_get_articles_cache(server, tmpdir):
+
+    cache = str(tmpdir.join('pubmed'))
+
+    first = make_client(server, cache_dir=cache).get_articles(['1', '2'])
+    nrequests = len(server.requests)
+    second = make_client(server, cache_dir=cache).get_articles(['1', '2'])
+
+    assert first == second
+    assert len(server.requests) == nrequests
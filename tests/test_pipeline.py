@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_pipeline.py
+## desc: Unit tests for pipeline.py stages that don't require the DB.
+## auth: TR
+
+from gwlib import pipeline
+
+BATCH = '''! Binary
+@ Mus musculus
+% Gene Symbol
+
+: GS1
+= Gene set one
++ The first gene set
+
+Mobp\t1
+Ccr4\t1
+
+: GS2
+= Gene set two
++ The second gene set
+
+Mobp\t1
+'''
+
+def run_parse_stage(tmpdir, contents, chunk_size=3):
+
+    path = tmpdir.join('test.bgf')
+    path.write(contents)
+
+    bp = pipeline.BatchPipeline(str(path), chunk_size=chunk_size)
+    bp._parser._gene_types = {'gene symbol': 7}
+    bp._parser._species = {'mus musculus': 1}
+    bp._parser._platforms = {}
+
+    bp._BatchPipeline__run_stage(bp.stats[0], bp._BatchPipeline__parse_stage)
+
+    items = []
+
+    while not bp._map_queue.empty():
+        items.append(bp._map_queue.get())
+
+    return bp, items
+
+def test_parse_stage(tmpdir):
+
+    bp, items = run_parse_stage(tmpdir, BATCH)
+
+    assert bp._failure is None
+    assert not bp._parser.errors
+    assert [gs['gs_abbreviation'] for gs in items[:-1]] == ['GS1', 'GS2']
+    assert items[0]['values'] == [('Mobp', '1'), ('Ccr4', '1')]
+    assert items[-1] is pipeline.DONE
+
+    stats = bp.get_stats()[0]
+
+    assert stats['stage'] == 'parse'
+    assert stats['items'] == 2
+    ## Both gene sets and the end marker were queued
+    assert stats['max_queue_depth'] == 3
+    assert stats['queue_depth'] == 0
+    assert bp.stats[0].finished is not None
+
+def test_parse_stage_errors(tmpdir):
+
+    bp, items = run_parse_stage(
+        tmpdir, BATCH.replace('+ The second', '@ Martian\n+ The second')
+    )
+
+    assert bp._parser.errors == ['LINE 14: Martian is an invalid species']
+    ## Sets parsed before the error are passed on, later ones are only counted
+    assert [gs['gs_abbreviation'] for gs in items[:-1]] == ['GS1']
+    assert items[-1] is pipeline.DONE
+    assert bp.get_stats()[0]['items'] == 2
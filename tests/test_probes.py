@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_probes.py
+## desc: Unit tests for probes.py.
+## auth: TR
+
+import pickle
+
+from gwlib import probes
+
+ROWS = [
+    ('1415670_at', 1, 100),
+    ('1415671_at', 2, 101),
+    ('1415671_at', 2, 102),
+    ('1415672_at', 3, None),
+    ('1415673_at', 4, 103)
+]
+
+def test_platform_index():
+
+    index = probes.PlatformIndex(1, ROWS)
+
+    assert len(index) == 4
+    assert '1415670_at' in index
+    assert 'nope' not in index
+    assert index.get_probe('1415671_at') == 2
+    assert index.get_probe('nope') is None
+    assert index.get_genes('1415670_at') == [100]
+    assert index.get_genes('1415671_at') == [101, 102]
+    assert index.get_genes('1415672_at') == []
+    assert index.get_genes('1415673_at') == [103]
+    assert index.get_genes('nope') == []
+
+def test_platform_index_pickle():
+
+    index = pickle.loads(pickle.dumps(probes.PlatformIndex(1, ROWS)))
+
+    assert index.pf_id == 1
+    assert index.get_genes('1415671_at') == [101, 102]
+
+def test_platform_index_cache():
+
+    index = probes.PlatformIndex(42, ROWS)
+
+    probes.add_platform_index(index)
+
+    assert probes.get_platform_index(42) is index
+
+    probes.add_platform_index(probes.PlatformIndex(43, ROWS))
+    probes.clear_platform_index(42)
+    ## Platforms without a cached index are ignored
+    probes.clear_platform_index(44)
+
+    assert 42 not in probes._indexes
+    assert 43 in probes._indexes
+
+    probes.clear_platform_indexes()
+
+    assert 43 not in probes._indexes
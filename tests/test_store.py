@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_store.py
+## desc: Unit tests for store.py.
+## auth: TR
+
+import math
+import random
+
+import pytest
+
+from gwlib import store
+
+ROWS = [
+    (1, 300, 0.5, True),
+    (1, 100, 1.5, False),
+    (1, 200, None, True),
+    (3, 5, 2.0, True),
+    (2, 1000000, 3.0, False),
+    (2, 7, 4.0, True)
+]
+
+@pytest.fixture
+def store_path(tmpdir):
+
+    path = str(tmpdir.join('genesets.gws'))
+
+    store.write_store(path, ROWS, values=True, thresholds=True)
+
+    return path
+
+def test_varints():
+
+    numbers = sorted(random.randint(0, 2 ** 40) for _ in range(1000))
+
+    assert list(store.decode_varints(store.encode_varints(numbers))) == numbers
+    assert list(store.decode_varints(store.encode_varints([0, 0, 127, 128]))) == [
+        0, 0, 127, 128
+    ]
+
+    with pytest.raises(ValueError):
+        store.encode_varints([2, 1])
+
+def test_write_store(tmpdir, store_path):
+
+    ## Temp files are cleaned up
+    assert tmpdir.listdir() == [tmpdir.join('genesets.gws')]
+
+    ## Rows that aren't grouped by gs_id
+    with pytest.raises(ValueError):
+        store.write_store(
+            str(tmpdir.join('bad.gws')), [(1, 1, 1, 1), (2, 1, 1, 1), (1, 2, 1, 1)]
+        )
+
+    assert tmpdir.listdir() == [tmpdir.join('genesets.gws')]
+
+def test_geneset_store(store_path):
+
+    with store.GenesetStore(store_path) as gstore:
+
+        assert len(gstore) == 3
+        assert list(gstore.gs_ids) == [1, 2, 3]
+        assert 2 in gstore
+        assert 4 not in gstore
+        assert gstore.has_values and gstore.has_thresholds
+        assert gstore.get_size(1) == 3
+        assert gstore.get_size(4) is None
+        assert list(gstore.get_genes(1)) == [100, 200, 300]
+        assert list(gstore.get_genes(2)) == [7, 1000000]
+        assert list(gstore.get_genes(3)) == [5]
+        assert gstore.get_genes(4) is None
+
+        values = list(gstore.get_values(1))
+
+        assert values[0] == 1.5 and values[2] == 0.5
+        assert math.isnan(values[1])
+        assert list(gstore.get_values(2)) == [4.0, 3.0]
+        assert list(gstore.get_thresholds(1)) == [0, 1, 1]
+        assert list(gstore.get_thresholds(2)) == [1, 0]
+        assert gstore.get_values(4) is None
+
+        genesets = list(gstore.iter_genesets())
+
+        assert [gs[0] for gs in genesets] == [1, 2, 3]
+        assert list(genesets[2][1]) == [5]
+
+def test_geneset_store_without_values(tmpdir):
+
+    path = str(tmpdir.join('genes.gws'))
+
+    with store.StoreWriter(path, values=False) as writer:
+        writer.add(10, [3, 1, 2])
+        writer.add(5, [])
+
+    with store.GenesetStore(path) as gstore:
+
+        assert list(gstore.gs_ids) == [5, 10]
+        assert list(gstore.get_genes(10)) == [1, 2, 3]
+        assert list(gstore.get_genes(5)) == []
+        assert gstore.get_values(10) is None
+        assert gstore.get_thresholds(10) is None
+
+def test_empty_store(tmpdir):
+
+    path = str(tmpdir.join('empty.gws'))
+
+    assert store.write_store(path, []) == 0
+
+    with store.GenesetStore(path) as gstore:
+
+        assert len(gstore) == 0
+        assert 1 not in gstore
+        assert gstore.get_genes(1) is None
+
+def test_invalid_store(tmpdir):
+
+    path = tmpdir.join('invalid.gws')
+
+    path.write('nope')
+
+    with pytest.raises(ValueError):
+        store.GenesetStore(str(path))
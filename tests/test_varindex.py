@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## file: test_varindex.py
+## desc: Unit tests for varindex.py.
+## auth: TR
+
+import random
+
+import pytest
+
+from gwlib import varindex
+
+VARIANTS = [
+    (10, 1, 100),
+    (20, 2, None),
+    (20, 3, 101),
+    (30, 4, 102),
+    (45, 5, None)
+]
+
+ODES = [(100, 10), (101, 20), (102, 30)]
+
+@pytest.fixture
+def index_path(tmpdir):
+
+    path = str(tmpdir.join('hg38.idx'))
+
+    varindex.write_variant_index(path, VARIANTS, ODES)
+
+    return path
+
+def test_normalize_rsid():
+
+    assert varindex.normalize_rsid('rs123') == 123
+    assert varindex.normalize_rsid('RS123 ') == 123
+    assert varindex.normalize_rsid('123') == 123
+    assert varindex.normalize_rsid(123) == 123
+    assert varindex.normalize_rsid('rsnope') is None
+
+def test_write_variant_index(tmpdir, index_path):
+
+    ## Temp files are cleaned up
+    assert tmpdir.listdir() == [tmpdir.join('hg38.idx')]
+
+    with pytest.raises(ValueError):
+        varindex.write_variant_index(
+            str(tmpdir.join('bad.idx')), reversed(VARIANTS), []
+        )
+
+    assert tmpdir.listdir() == [tmpdir.join('hg38.idx')]
+
+def test_variant_index(index_path):
+
+    with varindex.VariantIndex(index_path) as index:
+
+        assert len(index) == 5
+        assert index.get_variants(['rs10', '20', 45, 'rs99', 'nope']) == {
+            10: 1, 20: 2, 45: 5
+        }
+        assert index.get_variant_odes(['rs10', 'rs20', 'rs30', 'rs45']) == {
+            10: 100, 30: 102
+        }
+        assert index.get_variant_refs([100, 102, 999]) == {100: 10, 102: 30}
+
+def test_variant_index_empty(tmpdir):
+
+    path = str(tmpdir.join('empty.idx'))
+
+    assert varindex.write_variant_index(path, [], []) == (0, 0)
+
+    with varindex.VariantIndex(path) as index:
+        assert index.get_variants(['rs1']) == {}
+        assert index.get_variant_refs([1]) == {}
+
+def test_variant_index_invalid(tmpdir):
+
+    path = tmpdir.join('bad.idx')
+    path.write('nope')
+
+    with pytest.raises(ValueError):
+        varindex.VariantIndex(str(path))
+
+def test_variant_index_random(tmpdir):
+
+    rand = random.Random(39)
+    refs = sorted(set(rand.randint(1, 10 ** 9) for _ in range(5000)))
+    variants = [
+        (ref, i, ref * 2 if ref % 3 else None) for i, ref in enumerate(refs)
+    ]
+    odes = sorted((ode, ref) for ref, _, ode in variants if ode is not None)
+    path = str(tmpdir.join('random.idx'))
+    queries = rand.sample(refs, 500) + [rand.randint(1, 10 ** 9) for _ in range(500)]
+
+    varindex.write_variant_index(path, variants, odes)
+
+    with varindex.VariantIndex(path) as index:
+        expected = dict((ref, i) for i, ref in enumerate(refs))
+
+        assert index.get_variants(queries) == dict(
+            (q, expected[q]) for q in queries if q in expected
+        )
+
+        expected = dict((ref, ode) for ref, _, ode in variants if ode)
+
+        assert index.get_variant_odes(queries) == dict(
+            (q, expected[q]) for q in queries if q in expected
+        )
+
+def test_variant_index_registry(index_path):
+
+    index = varindex.add_variant_index('hg38', index_path)
+
+    assert varindex.get_variant_index('hg38') is index
+    assert varindex.get_variant_index('mm10') is None
+
+    varindex.clear_variant_indexes()
+
+    assert varindex.get_variant_index('hg38') is None